@@ -0,0 +1,131 @@
+import time
+import queue
+import threading
+
+from basics.base import Base
+import basics.base_utils as _
+
+
+class BackgroundWorker(Base):
+    """
+
+    Executes tasks, in submission order, on a background thread with a bounded task queue.
+
+    Submitting a task is an O(1) enqueue, unless the queue is full: then submit() blocks until there is room,
+    or drops the task when block=False.
+
+    """
+    def __init__(self, max_queue_size=4, name="background-worker", **kwargs):
+        """
+
+        :param max_queue_size: maximum number of pending tasks
+        :param name: name of the worker thread
+        """
+        super().__init__(**kwargs)
+
+        self._name = name
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+
+        self._lock = threading.Lock()
+        self._num_tasks = 0
+        self._num_failed = 0
+        self._num_dropped = 0
+        self._total_latency = 0.
+        self._last_latency = 0.
+        self._max_latency = 0.
+
+    def submit(self, task, *args, block=True):
+        """
+
+        :param task: callable to execute on the background thread
+        :param args: arguments for the task
+        :param block: if False, the task is dropped when the queue is full
+        :return: True if the task was queued, False if it was dropped
+        """
+        self._start()
+
+        try:
+            self._queue.put((task, args), block=block)
+        except queue.Full:
+            with self._lock:
+                self._num_dropped += 1
+            return False
+
+        return True
+
+    def flush(self):
+        """
+        Blocks until all queued tasks are executed
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """
+        Executes all queued tasks and stops the background thread
+        """
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def is_busy(self):
+        return self._queue.unfinished_tasks > 0
+
+    def stats(self):
+        """
+
+        :return: dict with the number of executed, failed and dropped tasks, task latencies (in seconds)
+                 and the current queue depth
+        """
+        with self._lock:
+            return {
+                "num_tasks": self._num_tasks,
+                "num_failed": self._num_failed,
+                "num_dropped": self._num_dropped,
+                "last_latency": self._last_latency,
+                "mean_latency": self._total_latency / self._num_tasks if self._num_tasks > 0 else 0.,
+                "max_latency": self._max_latency,
+                "queue_depth": self._queue.qsize()
+            }
+
+    def _start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            task, args = item
+
+            start = time.time()
+            failed = False
+            try:
+                task(*args)
+            except Exception as e:
+                failed = True
+                _.log_exception(self._log, "Background task failed", e)
+            finally:
+                latency = time.time() - start
+
+                with self._lock:
+                    self._num_tasks += 1
+                    self._num_failed += 1 if failed else 0
+                    self._total_latency += latency
+                    self._last_latency = latency
+                    self._max_latency = max(self._max_latency, latency)
+
+                self._queue.task_done()
@@ -6,11 +6,21 @@ from shutil import copyfile
 
 import pickle
 
+import numpy as np
+
 from keras.callbacks import Callback
 
 from basics.base import Base
 import basics.base_utils as _
 
+from keras_callbacks.history_log import HistoryLogWriter, HistoryLogReader
+from keras_callbacks.history_columns import ColumnStore
+from keras_callbacks.background_worker import BackgroundWorker
+from keras_callbacks.history_tiers import HistoryCompactor
+
+# Columns added by the BatchMetricHistory itself
+_ROW_COLUMNS = ("epoch", "global_iter", "epoch_iter", "time_stamp", "date")
+
 
 class BatchMetricHistory(Base, Callback):
 
@@ -19,6 +29,17 @@ class BatchMetricHistory(Base, Callback):
                  base_filename=time.strftime("%d-%m-%Y_%H-%M-%S"),
                  save_period=2000,
                  history=None,
+                 append_only=False,
+                 segment_rows=65536,
+                 columnar_history=False,
+                 float_dtype='float32',
+                 async_save=False,
+                 save_queue_size=4,
+                 resume_from_history_log=False,
+                 compaction_tiers=None,
+                 keep_raw_iters=100000,
+                 history_tiers=None,
+                 metric_bus=None,
                  **kwargs):
         """
 
@@ -27,6 +48,33 @@ class BatchMetricHistory(Base, Callback):
         :param save_period:
         :param history: previously saved history
                         It is assumed that the initial epoch is given to the Keras train function
+        :param append_only: If True, the history is saved to an append-only, columnar, history log
+                            (see HistoryLogWriter), instead of re-pickling the whole history every save period.
+                            Use HistoryLogReader(...).to_dict() to read the history back.
+        :param segment_rows: Number of rows per segment of the history log (only used when append_only=True)
+        :param columnar_history: If True, the history is kept in a compact ColumnStore, with typed numpy columns,
+                                 instead of a dict of lists. The date column is derived from the time stamps.
+        :param float_dtype: dtype used to store floating point values (only used when columnar_history=True)
+        :param async_save: If True (and append_only=True), the new rows are written to the history log on a
+                           background thread. The training thread only copies the rows added since the previous save
+                           and queues the copy. Pickling the whole history can't be done incrementally, hence without
+                           append_only the history is saved synchronously.
+        :param save_queue_size: Maximum number of pending saves (only used when async_save=True),
+                                when the queue is full, saving blocks until there is room.
+        :param resume_from_history_log: If True (and append_only=True), training continues from the last row in the
+                                        existing history log, without loading the history in memory.
+                                        Only the new rows are kept in memory, the history argument is ignored.
+                                        Use HistoryLogReader to analyse the complete history.
+        :param compaction_tiers: List of (resolution, max_buckets) tuples. If given, only the raw history of the most
+                                 recent keep_raw_iters iterations is kept, older values are summarised in buckets
+                                 (min, max, mean, count) of increasing resolution, see HistoryCompactor.
+                                 Compaction happens after every save, also history log segments with only old rows
+                                 are removed. The tiers are saved to a separate .history-tiers file.
+                                 To resume an append-only history with compaction, use resume_from_history_log.
+        :param keep_raw_iters: Number of most recent iterations to keep raw values for, when compacting
+        :param history_tiers: previously saved compaction tiers (content of the .history-tiers file)
+        :param metric_bus: MetricBus to read the metrics from, instead of scanning the logs.
+                           The metrics are recorded as floats, values that are not numbers are not recorded.
         """
 
         super().__init__(**kwargs)
@@ -34,17 +82,43 @@ class BatchMetricHistory(Base, Callback):
         self._model_path = model_path
         self._base_filename = base_filename
         self._save_period = save_period
+        self._append_only = append_only
+        self._columnar_history = columnar_history
+        self._float_dtype = float_dtype
+
+        self._save_worker = None
+        if async_save and self._append_only:
+            self._save_worker = BackgroundWorker(save_queue_size, name="history-writer")
+        elif async_save:
+            self._log.error("async_save requires append_only=True, saving history synchronously")
 
-        self._history = {}
+        self._compactor = None
+        if compaction_tiers is not None:
+            self._compactor = HistoryCompactor(keep_raw_iters, compaction_tiers, history_tiers)
+
+        self._history = ColumnStore(self._float_dtype) if self._columnar_history else {}
+        self._history_log = None
 
         self._current_epoch = 0
 
         self._global_iter = -1
         self._epoch_iter = -1
 
+        self._metric_bus = metric_bus
+        self._subscription = None
+        if metric_bus is not None:
+            self._subscription = metric_bus.subscribe(lambda name: name not in _ROW_COLUMNS)
+
         self._log.info("Save history period : %d" % self._save_period)
 
-        self._set_init_history(history)
+        resume_from_history_log = resume_from_history_log and self._append_only
+        if resume_from_history_log:
+            self._set_init_history_from_log()
+        else:
+            self._set_init_history(history)
+
+        if self._append_only:
+            self._setup_history_log(segment_rows, keep_existing=resume_from_history_log)
 
     def on_epoch_begin(self, epoch, logs=None):
         self._current_epoch = epoch
@@ -55,16 +129,35 @@ class BatchMetricHistory(Base, Callback):
         self._epoch_iter += 1
 
         t = int(round(time.time() * 1000))
-        d = str(datetime.datetime.fromtimestamp(t/1000.0))
-        
-        for k, v in logs.items():
-            self._history.setdefault(k, []).append(v)
+
+        if self._subscription is not None:
+            self._metric_bus.sync(batch, logs)
+            names, values = self._subscription.updated()
+            metrics = dict(zip(names, values.tolist()))
+        else:
+            metrics = logs
+
+        num_rows = len(self._history["global_iter"]) if "global_iter" in self._history else 0
+        for k, v in metrics.items():
+            if k not in self._history:
+                # Metrics that are not logged from the first iteration on are padded at the front
+                self._history.setdefault(k, []).extend([np.nan] * num_rows)
+
+            self._history[k].append(v)
+
+        # Metrics that are not logged every iteration (see EvaluationScheduler) are padded, to keep rows aligned
+        for k in self._history.keys():
+            if (k not in metrics) and (k not in _ROW_COLUMNS):
+                self._history[k].append(np.nan)
 
         self._history.setdefault("epoch", []).append(self._current_epoch)
         self._history.setdefault("global_iter", []).append(self._global_iter)
         self._history.setdefault("epoch_iter", []).append(self._epoch_iter)
         self._history.setdefault("time_stamp", []).append(t)
-        self._history.setdefault("date", []).append(d)
+
+        if not self._columnar_history:
+            d = str(datetime.datetime.fromtimestamp(t/1000.0))
+            self._history.setdefault("date", []).append(d)
 
         if self._global_iter == 0:
             return
@@ -75,14 +168,41 @@ class BatchMetricHistory(Base, Callback):
     def on_epoch_end(self, epoch, logs=None):
         self._save_history()
 
+    def on_train_end(self, logs=None):
+        if self._save_worker is None:
+            return
+
+        self._log.debug("Waiting for pending history saves ...")
+        self._save_worker.flush()
+
+        stats = self._save_worker.stats()
+        self._log.info("History saves : %d, mean write latency : %0.3fs, max write latency : %0.3fs" %
+                       (stats["num_tasks"], stats["mean_latency"], stats["max_latency"]))
+
+    def save_stats(self):
+        """
+
+        :return: dict with write latencies (in seconds) and queue depth of the asynchronous history saves,
+                 None when not saving asynchronously
+        """
+        if self._save_worker is None:
+            return None
+
+        return self._save_worker.stats()
+
     def _set_init_history(self, history):
-        if not _.is_dict(history):
+        if not (_.is_dict(history) or isinstance(history, ColumnStore)):
             self._log.debug('No initial history given, starting with a clean slate ...')
             return
 
         self._log.debug("Using given initial history.")
         try:
-            self._history = history.copy()
+            if self._columnar_history and not isinstance(history, ColumnStore):
+                self._history = ColumnStore.from_dict(history, self._float_dtype)
+            elif not self._columnar_history and isinstance(history, ColumnStore):
+                self._history = history.to_dict()
+            else:
+                self._history = history.copy()
 
             self._current_epoch = self._history['epoch'][-1]
             self._global_iter = self._history['global_iter'][-1]
@@ -95,7 +215,49 @@ class BatchMetricHistory(Base, Callback):
         except Exception as e:
             _.log_exception(self._log, "Unable to set initial training history", e)
 
+    def _set_init_history_from_log(self):
+        try:
+            self._log.debug("Using last row of history log [%s] as initial state." % self._history_log_path())
+
+            last_row = HistoryLogReader(self._history_log_path()).last_row()
+            if last_row is None:
+                self._log.debug('History log is empty, starting with a clean slate ...')
+                return
+
+            self._current_epoch = int(last_row['epoch'])
+            self._global_iter = int(last_row['global_iter'])
+            self._epoch_iter = int(last_row['epoch_iter'])
+
+            self._log.debug("Global iter : %d" % self._global_iter)
+
+            self._log.debug("Current epoch : %d" % self._current_epoch)
+            self._log.debug("Epoch iter : %d" % self._epoch_iter)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to set initial training history from history log", e)
+
+    def _setup_history_log(self, segment_rows, keep_existing=False):
+        try:
+            self._log.info("Saving history to append-only history log [%s]" % self._history_log_path())
+
+            self._history_log = HistoryLogWriter(self._history_log_path(), segment_rows)
+            self._history_log.sync_with(self._history, keep_existing)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to setup history log", e)
+
     def _save_history(self):
+        self._save_history_rows()
+
+        if self._compactor is not None:
+            self._compact_history()
+
+    def _save_history_rows(self):
+        if self._append_only:
+            self._append_history()
+            return
+
+        self._write_history_file(self._history)
+
+    def _write_history_file(self, history):
         try:
             fname = self._history_file_name()
 
@@ -109,15 +271,68 @@ class BatchMetricHistory(Base, Callback):
             self._log.debug("Saving training history to [%s]" % fname)
             with open(fname, 'wb') as f:
                 pickle.dump({
-                    "history" : self._history
+                    "history" : history
                 }, f)
 
         except Exception as e:
             _.log_exception(self._log, "Unable to save training history", e)
 
+    def _append_history(self):
+        if self._history_log is None:
+            self._log.error("No history log available, unable to save history")
+            return
+
+        try:
+            if self._save_worker is None:
+                self._log.debug("Appending training history to [%s]" % self._history_log_path())
+                self._history_log.append(self._history)
+            else:
+                # Only the new rows are copied, they are written by the background thread
+                self._save_worker.submit(self._history_log.write_chunk, self._history_log.take_chunk(self._history))
+        except Exception as e:
+            _.log_exception(self._log, "Unable to append to training history log", e)
+
+    def _compact_history(self):
+        try:
+            dropped = self._compactor.compact(self._history, self._global_iter)
+            if self._history_log is not None:
+                for key, num_values in dropped.items():
+                    self._history_log.discard_head(key, num_values)
+
+            first_raw_iter = self._global_iter - self._compactor.keep_raw_iters
+            tiers = self._compactor.state()
+
+            if self._save_worker is None:
+                self._write_tiers_file(tiers, first_raw_iter)
+            else:
+                self._save_worker.submit(self._write_tiers_file, tiers, first_raw_iter)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to compact training history", e)
+
+    def _write_tiers_file(self, tiers, first_raw_iter):
+        try:
+            fname = self._tiers_file_name()
+
+            self._log.debug("Saving history tiers to [%s]" % fname)
+            with open("%s.tmp" % fname, 'wb') as f:
+                pickle.dump(tiers, f)
+
+            os.replace("%s.tmp" % fname, fname)
+
+            if self._history_log is not None:
+                self._history_log.remove_segments_before(first_raw_iter)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to save history tiers", e)
+
     def _history_file_name(self):
         return os.path.join(self._model_path, '%s.history' % self._base_filename)
 
+    def _tiers_file_name(self):
+        return os.path.join(self._model_path, '%s.history-tiers' % self._base_filename)
+
+    def _history_log_path(self):
+        return os.path.join(self._model_path, '%s.history-log' % self._base_filename)
+
     def _copy(self, source_fname, dest_fname):
         success = True
 
@@ -1,7 +1,12 @@
+import time
+
 from keras.callbacks import Callback
 
 from basics.base import Base
 
+from keras_callbacks.batch_prefetcher import BatchPrefetcher
+from keras_callbacks.validation_batch_pool import ValidationBatchPool
+
 
 class BatchPerformanceLoggerBase(Base, Callback):
     """
@@ -21,15 +26,65 @@ class BatchPerformanceLoggerBase(Base, Callback):
                  metrics_name_postfix="unknown",
                  inspect_period = 2000,
                  init_iter = -1,
+                 prefetch_batches=0,
+                 prefetch_processes=0,
+                 batch_generator_factory=None,
+                 evaluation_scheduler=None,
+                 cache_batches=0,
+                 cache_max_bytes=1 << 30,
+                 cache_spill_path=None,
+                 cache_shuffle_seed=None,
                  **kwargs):
+        """
+
+        :param batch_generator:
+        :param metrics_name_postfix:
+        :param inspect_period:
+        :param init_iter:
+        :param prefetch_batches: If > 0, batches are produced ahead of time, up to this number, by a background
+                                 thread (or processes, see prefetch_processes), see BatchPrefetcher.
+        :param prefetch_processes: If > 0 (and prefetch_batches > 0), number of processes producing batches, for CPU
+                                   heavy batch generators. Every process creates its own batch generator with
+                                   batch_generator_factory(worker_index), batch_generator is not used.
+        :param batch_generator_factory: Picklable function returning a batch generator, given a worker index
+        :param evaluation_scheduler: Optional EvaluationScheduler, to only evaluate at a fixed period, or adaptively
+                                     within a share of the wall clock time. In skipped iterations no metrics are
+                                     added to the logs, PerformanceAverager then repeats the last averages.
+                                     Iterations at which the data is inspected are always evaluated.
+        :param cache_batches: If > 0, the first cache_batches batches are generated once and served again from a
+                              ValidationBatchPool, for a fixed validation set
+        :param cache_max_bytes: Maximum number of bytes of the cached batches kept in memory
+        :param cache_spill_path: Directory to spill cached batches to, that don't fit in memory. Spilled batches are
+                                 removed at the end of training, the pool is then filled again if training continues
+        :param cache_shuffle_seed: If given, the cached batches are served in a seeded random order
+        """
         super().__init__(**kwargs)
 
+        self._prefetcher = None
+        if prefetch_batches > 0:
+            self._prefetcher = BatchPrefetcher(batch_generator,
+                                               batch_generator_factory,
+                                               num_prefetch=prefetch_batches,
+                                               num_processes=prefetch_processes)
+            batch_generator = self._prefetcher
+
+        self._batch_pool = None
+        if cache_batches > 0:
+            self._batch_pool = ValidationBatchPool(batch_generator,
+                                                   cache_batches,
+                                                   max_bytes=cache_max_bytes,
+                                                   spill_path=cache_spill_path,
+                                                   shuffle_seed=cache_shuffle_seed)
+            batch_generator = self._batch_pool
+
         self._batch_generator = batch_generator
         self._metrics_name_postfix = metrics_name_postfix
 
         self._inspect_period = inspect_period
         self._iter = init_iter
 
+        self._evaluation_scheduler = evaluation_scheduler
+
     def on_batch_end(self, batch, logs=None):
         self._iter += 1
         # 1) generate new batch
@@ -38,6 +93,14 @@ class BatchPerformanceLoggerBase(Base, Callback):
         # 4) log in logs object
         # 5) inspect data if inspect_period > 0 given
 
+        inspect = self._is_inspect_iter()
+
+        if (self._evaluation_scheduler is not None) and \
+           not self._evaluation_scheduler.should_evaluate(force=inspect):
+            return
+
+        start = time.time()
+
         # 1) generate new batch
         generated_batch_data = self._generate_batch()
         # 2) predict model
@@ -47,12 +110,60 @@ class BatchPerformanceLoggerBase(Base, Callback):
         # 4) log in logs object
         self._log_metrics(batch_metrics_data, logs)
 
+        if self._evaluation_scheduler is not None:
+            self._evaluation_scheduler.evaluated(time.time() - start)
+
         # 5) log data to console if log_data_period given
-        if (self._iter > 0) and \
-            (self._inspect_period > 0) and \
-            (self._iter % self._inspect_period == 0):
+        if inspect:
             self._inspect_data(generated_batch_data, predicted_batch_data, batch_metrics_data)
 
+    def on_train_end(self, logs=None):
+        if self._evaluation_scheduler is not None:
+            stats = self._evaluation_scheduler.stats()
+            self._log.info("Evaluated %d iterations, skipped %d, evaluation overhead : %0.1f%%, final period : %d" %
+                           (stats["num_evaluations"], stats["num_skipped"], 100 * stats["overhead"], stats["period"]))
+
+        if (self._batch_pool is not None) and (self._batch_pool.stats()["num_spilled"] > 0):
+            # Spilled batches are removed, the pool is filled again if training continues
+            self._batch_pool.close()
+
+        if self._prefetcher is None:
+            return
+
+        stats = self._prefetcher.stats()
+        self._log.info("Prefetched batches : %d, starved : %d times, total wait time : %0.3fs, max wait time : %0.3fs" %
+                       (stats["num_batches"], stats["num_starved"], stats["total_wait_time"], stats["max_wait_time"]))
+
+        # The prefetcher starts producing again at the next batch, if training continues
+        self._prefetcher.close()
+
+    def prefetch_stats(self):
+        """
+
+        :return: dict with the starvation counters of the batch prefetcher (see BatchPrefetcher.stats()),
+                 None when not prefetching
+        """
+        if self._prefetcher is None:
+            return None
+
+        return self._prefetcher.stats()
+
+    def cache_stats(self):
+        """
+
+        :return: dict with the hit and miss statistics of the batch pool (see ValidationBatchPool.stats()),
+                 None when not caching
+        """
+        if self._batch_pool is None:
+            return None
+
+        return self._batch_pool.stats()
+
+    def _is_inspect_iter(self):
+        return (self._iter > 0) and \
+               (self._inspect_period > 0) and \
+               (self._iter % self._inspect_period == 0)
+
     def _generate_batch(self):
         return next(self._batch_generator)
 
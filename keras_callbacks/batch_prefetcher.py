@@ -0,0 +1,249 @@
+import time
+import queue
+import itertools
+import functools
+import threading
+import multiprocessing
+
+from basics.base import Base
+
+_END = '__end_of_batches__'
+_ERROR = '__batch_generator_error__'
+
+
+def _put(batch_queue, item, stop_event):
+    """
+
+    :return: True if the item is queued, False if producing is stopped first
+    """
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _produce(generator_fn, batch_queue, stop_event, held_batches=None):
+    """
+
+    :param generator_fn: function returning the batch generator, called in the producer
+    :param batch_queue:
+    :param stop_event:
+    :param held_batches: list to add the batch to that could not be queued when producing is stopped, None to drop it
+    """
+    try:
+        for batch in generator_fn():
+            if not _put(batch_queue, batch, stop_event):
+                if held_batches is not None:
+                    held_batches.append(batch)
+
+                return
+
+        _put(batch_queue, _END, stop_event)
+    except Exception as e:
+        _put(batch_queue, (_ERROR, repr(e)), stop_event)
+
+
+def _held_then_generated(held_batches, batch_generator):
+    return itertools.chain(held_batches, batch_generator)
+
+
+class BatchPrefetcher(Base):
+    """
+
+    Iterator that produces batches ahead of time, in a bounded queue, such that the consumer only has to dequeue a
+    ready batch.
+
+    Batches are produced by a background thread, from a batch generator, or, for CPU heavy generators, by a number
+    of processes. Every process creates its own generator, with generator_factory(worker_index), the batches of the
+    processes are interleaved in order of completion.
+
+    Every time a batch is requested while the queue is empty, the consumer is starved and has to wait, these events
+    and the waiting time are counted, see stats().
+
+    close() stops the producers, they are started again when the next batch is requested (e.g. when training
+    continues). The background thread continues with the batch generator, without losing batches, processes create
+    new batch generators. Producers are also started again after the generators ended or failed, an exhausted
+    batch generator then ends again.
+
+    If all producers die without ending their generator (e.g. a process is killed), a RuntimeError is raised.
+
+    """
+    def __init__(self,
+                 batch_generator=None,
+                 generator_factory=None,
+                 num_prefetch=4,
+                 num_processes=0,
+                 mp_context=None,
+                 poll_interval=1.,
+                 **kwargs):
+        """
+
+        :param batch_generator: batch generator, consumed by a background thread (if num_processes=0)
+        :param generator_factory: picklable function that returns a batch generator, given the worker index
+                                  (only used if num_processes > 0)
+        :param num_prefetch: maximum number of batches produced ahead of time
+        :param num_processes: if > 0, number of processes producing batches
+        :param mp_context: multiprocessing start method ('fork', 'spawn', 'forkserver'), None for the default
+        :param poll_interval: interval, in seconds, to check whether the producers are alive while waiting for a batch
+        """
+        super().__init__(**kwargs)
+
+        if (num_processes > 0) and not callable(generator_factory):
+            raise ValueError("A generator_factory is required to produce batches in processes")
+
+        self._batch_generator = batch_generator
+        self._generator_factory = generator_factory
+        self._num_prefetch = num_prefetch
+        self._num_processes = num_processes
+        self._context = multiprocessing.get_context(mp_context) if num_processes > 0 else None
+        self._poll_interval = poll_interval
+
+        self._num_producers = num_processes if num_processes > 0 else 1
+        self._num_ended = 0
+
+        self._producers = []
+        self._stopped_producers = []
+        self._held_batches = []
+        self._queue = None
+        self._stop_event = None
+        self._start()
+
+        self._num_batches = 0
+        self._num_starved = 0
+        self._total_wait_time = 0.
+        self._max_wait_time = 0.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self._producers) == 0:
+            self._start()
+
+        while True:
+            try:
+                batch = self._queue.get_nowait()
+            except queue.Empty:
+                start = time.time()
+                batch = self._wait_for_batch()
+
+                wait_time = time.time() - start
+                self._num_starved += 1
+                self._total_wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+            if isinstance(batch, str) and batch == _END:
+                self._num_ended += 1
+                if self._num_ended >= self._num_producers:
+                    self.close()
+                    raise StopIteration
+
+                continue
+
+            if isinstance(batch, tuple) and (len(batch) == 2) and isinstance(batch[0], str) and batch[0] == _ERROR:
+                self.close()
+                raise RuntimeError("Batch generator failed : %s" % batch[1])
+
+            self._num_batches += 1
+
+            return batch
+
+    def _wait_for_batch(self):
+        while True:
+            try:
+                return self._queue.get(timeout=self._poll_interval)
+            except queue.Empty:
+                pass
+
+            if any(producer.is_alive() for producer in self._producers):
+                continue
+
+            # A producer might have queued its last item just before it ended
+            try:
+                return self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            exit_codes = [getattr(producer, 'exitcode', None) for producer in self._producers]
+            self.close()
+            raise RuntimeError("All batch producers died, exit codes : %s" % exit_codes)
+
+    def _start(self):
+        self._num_ended = 0
+
+        if self._num_processes > 0:
+            # Processes that are terminated can leave a multiprocessing queue in a broken state
+            self._queue = self._context.Queue(maxsize=self._num_prefetch)
+            self._stop_event = self._context.Event()
+
+            for worker_index in range(self._num_processes):
+                process = self._context.Process(target=_produce,
+                                                args=(functools.partial(self._generator_factory, worker_index),
+                                                      self._queue, self._stop_event),
+                                                name="batch-prefetcher-%d" % worker_index,
+                                                daemon=True)
+                process.start()
+                self._producers.append(process)
+        else:
+            # The batch generator can't be used by two threads at the same time
+            for thread in self._stopped_producers:
+                thread.join()
+            self._stopped_producers = []
+
+            # Batches that are produced already are kept, the held batches are queued after them
+            if self._queue is None:
+                self._queue = queue.Queue(maxsize=self._num_prefetch)
+            self._stop_event = threading.Event()
+
+            held_batches, self._held_batches = self._held_batches, []
+            thread = threading.Thread(target=_produce,
+                                      args=(functools.partial(_held_then_generated, held_batches,
+                                                              self._batch_generator),
+                                            self._queue, self._stop_event, self._held_batches),
+                                      name="batch-prefetcher",
+                                      daemon=True)
+            thread.start()
+            self._producers.append(thread)
+
+    def queue_depth(self):
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            # Not available for multiprocessing queues on some platforms
+            return -1
+
+    def stats(self):
+        """
+
+        :return: dict with the number of batches consumed, the number of times the consumer had to wait for a batch
+                 (starved), the waiting time (in seconds) and the current queue depth
+        """
+        return {
+            "num_batches": self._num_batches,
+            "num_starved": self._num_starved,
+            "total_wait_time": self._total_wait_time,
+            "mean_wait_time": self._total_wait_time / self._num_starved if self._num_starved > 0 else 0.,
+            "max_wait_time": self._max_wait_time,
+            "queue_depth": self.queue_depth()
+        }
+
+    def close(self):
+        """
+        Stops producing batches
+        """
+        self._stop_event.set()
+
+        for producer in self._producers:
+            producer.join(timeout=1.)
+            if isinstance(producer, multiprocessing.process.BaseProcess):
+                if producer.is_alive():
+                    producer.terminate()
+            elif producer.is_alive():
+                # Still generating a batch, joined before the generator is used again
+                self._stopped_producers.append(producer)
+
+        self._producers = []
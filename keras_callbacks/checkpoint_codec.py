@@ -0,0 +1,231 @@
+import os
+import bz2
+import lzma
+import zlib
+import pickle
+
+import numpy as np
+
+from basics.base import Base
+
+from keras_callbacks.weight_snapshot import WeightSnapshot
+
+_FORMAT_VERSION = 1
+
+_COMPRESSORS = {
+    None: (lambda data, level: data, lambda data: data),
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+}
+
+# Unsigned integer type holding the bit pattern of the stored values
+_BITS_DTYPE = {
+    'float32': np.dtype('uint32'),
+    'float16': np.dtype('uint16'),
+    'bfloat16': np.dtype('uint16')
+}
+
+
+def _to_bits(value, precision):
+    if precision == 'float32':
+        return value.astype('float32').view('uint32')
+
+    if precision == 'float16':
+        return value.astype('float16').view('uint16')
+
+    # bfloat16 : upper 16 bits of float32, round to nearest even
+    bits = value.astype('float32').view('uint32')
+    rounded = ((bits + np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1))) >> np.uint32(16))
+    nan_bits = (bits >> np.uint32(16)) | np.uint32(0x40)
+
+    return np.where(np.isnan(value), nan_bits, rounded).astype('uint16')
+
+
+def _from_bits(bits, precision):
+    if precision == 'float32':
+        return bits.view('float32')
+
+    if precision == 'float16':
+        return bits.view('float16').astype('float32')
+
+    return (bits.astype('uint32') << np.uint32(16)).view('float32')
+
+
+def _shuffle(bits):
+    """ Groups the bytes per significance, which compresses better """
+    return bits.view('uint8').reshape(-1, bits.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, shape):
+    planes = np.frombuffer(data, dtype='uint8').reshape(dtype.itemsize, -1)
+
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+class CheckpointCodec(Base):
+    """
+
+    Compact encoding of model weight snapshots.
+
+    * precision : floating point weights are stored as 'float32' (exact), 'float16' or 'bfloat16' (lossy)
+    * deltas : if keyframe_every > 1, only every keyframe_every-th encoded snapshot is stored completely (keyframe),
+               the others store the XOR of the bit patterns of their weights and those of the last keyframe. Weights
+               that change only slightly share most of their high bits with the keyframe, hence the XOR is mostly
+               zero bits and compresses well. Decoding is exact (up to the chosen precision).
+    * compression : None, 'zlib', 'bz2' or 'lzma' (standard library)
+
+    Delta files refer to their keyframe file, which must be kept as long as its delta files are used.
+
+    """
+    def __init__(self, precision='float32', compression='zlib', compression_level=6, keyframe_every=10, **kwargs):
+        super().__init__(**kwargs)
+
+        if precision not in _BITS_DTYPE:
+            self._log.error("Unknown precision [%s], using float32" % precision)
+            precision = 'float32'
+
+        if compression not in _COMPRESSORS:
+            self._log.error("Unknown compression [%s], using zlib" % compression)
+            compression = 'zlib'
+
+        self._precision = precision
+        self._compression = compression
+        self._compression_level = compression_level
+        self._keyframe_every = keyframe_every
+
+        self._keyframe_fname = None
+        self._keyframe_bits = None
+        self._num_since_keyframe = 0
+
+    def encode(self, snapshot, fname):
+        """
+
+        :param snapshot: WeightSnapshot
+        :param fname: file to write the encoded snapshot to
+        :return: number of bytes written
+        """
+        is_keyframe = (self._keyframe_bits is None) or \
+                      (self._keyframe_every <= 1) or \
+                      (self._num_since_keyframe + 1 >= self._keyframe_every)
+
+        compress = _COMPRESSORS[self._compression][0]
+
+        layers = []
+        bits_per_value = []
+        index = 0
+        for layer_name, weight_names, values in snapshot.layers:
+            encoded_values = []
+            for value in values:
+                value = np.asarray(value)
+
+                if value.dtype.kind != 'f':
+                    encoded_values.append({
+                        "encoding": 'raw',
+                        "dtype": value.dtype.str,
+                        "shape": value.shape,
+                        "data": compress(value.tobytes(), self._compression_level)
+                    })
+                    bits_per_value.append(None)
+                    index += 1
+                    continue
+
+                bits = _to_bits(value, self._precision).ravel()
+                bits_per_value.append(bits)
+
+                encoding = 'bits'
+                if not is_keyframe:
+                    key_bits = self._keyframe_bits[index] if index < len(self._keyframe_bits) else None
+                    if (key_bits is not None) and (key_bits.shape == bits.shape):
+                        bits = bits ^ key_bits
+                        encoding = 'xor'
+
+                encoded_values.append({
+                    "encoding": encoding,
+                    "dtype": value.dtype.str,
+                    "shape": value.shape,
+                    "data": compress(_shuffle(bits), self._compression_level)
+                })
+                index += 1
+
+            layers.append((layer_name, weight_names, encoded_values))
+
+        data = pickle.dumps({
+            "format": _FORMAT_VERSION,
+            "precision": self._precision,
+            "lossy": self._precision != 'float32',
+            "compression": self._compression,
+            "keyframe": None if is_keyframe else os.path.basename(self._keyframe_fname),
+            "layers": layers
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with open(fname, 'wb') as f:
+            f.write(data)
+
+        if is_keyframe:
+            self._keyframe_fname = fname
+            self._keyframe_bits = bits_per_value
+            self._num_since_keyframe = 0
+        else:
+            self._num_since_keyframe += 1
+
+        return len(data)
+
+    @staticmethod
+    def decode(fname):
+        """
+
+        :param fname: encoded snapshot file
+        :return: WeightSnapshot, with the weights in their original dtype
+        """
+        with open(fname, 'rb') as f:
+            encoded = pickle.load(f)
+
+        precision = encoded["precision"]
+        bits_dtype = _BITS_DTYPE[precision]
+        decompress = _COMPRESSORS[encoded["compression"]][1]
+
+        keyframe = None
+        if encoded["keyframe"] is not None:
+            keyframe = CheckpointCodec._decode_bits(os.path.join(os.path.dirname(fname), encoded["keyframe"]))
+
+        layers = []
+        index = 0
+        for layer_name, weight_names, encoded_values in encoded["layers"]:
+            values = []
+            for encoded_value in encoded_values:
+                dtype = np.dtype(encoded_value["dtype"])
+                shape = tuple(encoded_value["shape"])
+                data = decompress(encoded_value["data"])
+
+                if encoded_value["encoding"] == 'raw':
+                    values.append(np.frombuffer(data, dtype=dtype).reshape(shape).copy())
+                else:
+                    bits = _unshuffle(data, bits_dtype, (-1,))
+                    if encoded_value["encoding"] == 'xor':
+                        bits = bits ^ keyframe[index]
+
+                    values.append(_from_bits(bits, precision).astype(dtype).reshape(shape))
+
+                index += 1
+
+            layers.append((layer_name, weight_names, values))
+
+        return WeightSnapshot(layers)
+
+    @staticmethod
+    def is_lossy(fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)["lossy"]
+
+    @staticmethod
+    def _decode_bits(fname):
+        """ Bit patterns of the floating point values of a keyframe, in order """
+        with open(fname, 'rb') as f:
+            encoded = pickle.load(f)
+
+        bits_dtype = _BITS_DTYPE[encoded["precision"]]
+        decompress = _COMPRESSORS[encoded["compression"]][1]
+
+        return [_unshuffle(decompress(v["data"]), bits_dtype, (-1,)) if v["encoding"] == 'bits' else None
+                for _, _, encoded_values in encoded["layers"] for v in encoded_values]
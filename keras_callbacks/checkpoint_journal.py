@@ -0,0 +1,107 @@
+import os
+import pickle
+
+from basics.base import Base
+import basics.base_utils as _
+
+
+class CheckpointJournal(Base):
+    """
+
+    Append-only journal of checkpoint state mutations.
+
+    Instead of re-writing the complete checkpoint state on every change, only the mutation records are appended:
+        ('add', model_name, model_quality, model_iter)
+        ('remove', model_name)
+        ('state', dict with best_model, best_model_quality, earliest_good_model, earliest_good_model_iter, iter)
+
+    When compacting, the complete state is written to the state file (in the format of the checkpoint_state argument
+    of the ModelCheckpointManager) and the journal is truncated.
+
+    """
+    def __init__(self, state_fname, journal_fname, **kwargs):
+        """
+
+        :param state_fname: checkpoint state file, written when compacting
+        :param journal_fname: journal file
+        """
+        super().__init__(**kwargs)
+
+        self._state_fname = state_fname
+        self._journal_fname = journal_fname
+
+    def append(self, records):
+        """
+
+        :param records: list of mutation records
+        """
+        try:
+            with open(self._journal_fname, 'ab') as f:
+                for record in records:
+                    pickle.dump(record, f)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to append to checkpoint journal [%s]" % self._journal_fname, e)
+
+    def compact(self, state):
+        """
+        Writes the complete state to the state file, and truncates the journal
+
+        :param state: complete checkpoint state dict
+        """
+        try:
+            with open("%s.tmp" % self._state_fname, 'wb') as f:
+                pickle.dump(state, f)
+
+            os.replace("%s.tmp" % self._state_fname, self._state_fname)
+
+            # The state file now holds all mutations
+            with open(self._journal_fname, 'wb'):
+                pass
+        except Exception as e:
+            _.log_exception(self._log, "Unable to compact checkpoint journal [%s]" % self._journal_fname, e)
+
+    @staticmethod
+    def load(state_fname, journal_fname):
+        """
+        Reads the state file and replays the journal
+
+        :param state_fname:
+        :param journal_fname:
+        :return: checkpoint state dict, None if neither file exists
+        """
+        state = None
+        if os.path.isfile(state_fname):
+            with open(state_fname, 'rb') as f:
+                state = pickle.load(f)
+
+        if not os.path.isfile(journal_fname):
+            return state
+
+        state = state or {
+            "model_quality": dict(),
+            "model_iter": dict(),
+            "best_model": None,
+            "best_model_quality": None,
+            "earliest_good_model": None,
+            "earliest_good_model_iter": None,
+            "iter": -1
+        }
+
+        with open(journal_fname, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    # End of journal, or partially written last record
+                    break
+
+                if record[0] == 'add':
+                    state["model_quality"][record[1]] = record[2]
+                    state["model_iter"][record[1]] = record[3]
+                elif record[0] == 'remove':
+                    state["model_quality"].pop(record[1], None)
+                    state["model_iter"].pop(record[1], None)
+                elif record[0] == 'state':
+                    state.update(record[1])
+
+        return state
@@ -0,0 +1,254 @@
+import os
+import pickle
+import itertools
+
+import numpy as np
+
+from basics.base import Base
+
+from keras_callbacks.model_registry import ModelRegistry
+from keras_callbacks.history_log import HistoryLogReader
+from keras_callbacks.history_columns import ColumnStore
+
+
+class CheckpointPolicySimulator(Base):
+    """
+
+    Offline replay of the checkpoint retention policy of the ModelCheckpointManager, on a saved metric history.
+
+    The per iteration logic (regular checkpoints, archiving, monitoring and model improvement) is evaluated
+    vectorized over all iterations, only the model improvements are replayed through the pruning and earliest good
+    model logic. Iterations without a (finite) value of the metric to monitor are iterations at which the metric was
+    not evaluated; as in the ModelCheckpointManager, the metric is monitored at the first iteration it is available
+    at or after every monitor period boundary. This makes it possible to evaluate many settings on histories of millions of iterations, to
+    estimate the number of file operations (and bytes) a run would cause.
+
+    """
+    def __init__(self, metric_opt_mode='min', **kwargs):
+        """
+
+        :param metric_opt_mode: 'max', 'min'
+        """
+        super().__init__(**kwargs)
+
+        self._metric_opt_mode = metric_opt_mode
+
+    @staticmethod
+    def load_history(fname):
+        """
+
+        :param fname: .history file saved by BatchMetricHistory, or .history-log directory
+        :return: history dict
+        """
+        if os.path.isdir(fname):
+            return HistoryLogReader(fname).to_dict()
+
+        with open(fname, 'rb') as f:
+            history = pickle.load(f)["history"]
+
+        if isinstance(history, ColumnStore):
+            history = history.to_dict()
+
+        return history
+
+    def simulate(self,
+                 history,
+                 metric_to_monitor="mean_batch_perplexity_validation",
+                 metric_monitor_period=2000,
+                 early_good_model_delta=0.5,
+                 create_checkpoint_every=2000,
+                 archive_last_checkpoint_every=20000,
+                 model_bytes=None):
+        """
+
+        :param history: history dict (see load_history()), with one row per training iteration
+        :param metric_to_monitor:
+        :param metric_monitor_period:
+        :param early_good_model_delta: percentage
+        :param create_checkpoint_every:
+        :param archive_last_checkpoint_every:
+        :param model_bytes: optional size of a weight file, to estimate the bytes written and copied
+        :return: dict with the number of saves, copies and deletes, and their breakdown
+        """
+        global_iters, quality, num_epochs = self._prepare(history, metric_to_monitor)
+
+        return self._simulate(global_iters, quality, num_epochs,
+                              metric_monitor_period, early_good_model_delta,
+                              create_checkpoint_every, archive_last_checkpoint_every, model_bytes)
+
+    def sweep(self,
+              history,
+              metric_to_monitor="mean_batch_perplexity_validation",
+              metric_monitor_periods=(2000,),
+              early_good_model_deltas=(0.5,),
+              create_checkpoint_everys=(2000,),
+              archive_last_checkpoint_every=20000,
+              model_bytes=None):
+        """
+        Simulates all combinations of the given settings
+
+        :return: list of result dicts (see simulate()), with the settings added
+        """
+        global_iters, quality, num_epochs = self._prepare(history, metric_to_monitor)
+
+        results = []
+        for metric_monitor_period, early_good_model_delta, create_checkpoint_every in \
+                itertools.product(metric_monitor_periods, early_good_model_deltas, create_checkpoint_everys):
+            result = self._simulate(global_iters, quality, num_epochs,
+                                    metric_monitor_period, early_good_model_delta,
+                                    create_checkpoint_every, archive_last_checkpoint_every, model_bytes)
+
+            result.update({
+                "metric_monitor_period": metric_monitor_period,
+                "early_good_model_delta": early_good_model_delta,
+                "create_checkpoint_every": create_checkpoint_every
+            })
+            results.append(result)
+
+        return results
+
+    def _prepare(self, history, metric_to_monitor):
+        if metric_to_monitor not in history:
+            self._log.error("Metric to monitor [%s] not found in history" % metric_to_monitor)
+            quality = np.empty(0)
+        else:
+            # Missing values (None) become NaN, those iterations are not monitored
+            quality = np.array(history[metric_to_monitor], dtype=float)
+
+        if "global_iter" in history:
+            global_iters = np.asarray(history["global_iter"], dtype=np.int64)
+        else:
+            global_iters = np.arange(len(quality), dtype=np.int64)
+
+        if len(global_iters) != len(quality):
+            self._log.error("Metric to monitor [%s] has %d values for %d iterations, using the first values only" %
+                            (metric_to_monitor, len(quality), len(global_iters)))
+
+            n = min(len(global_iters), len(quality))
+            global_iters = global_iters[:n]
+            quality = quality[:n]
+
+        num_epochs = len(np.unique(history["epoch"])) if "epoch" in history else 1
+
+        return global_iters, quality, num_epochs
+
+    def _simulate(self, global_iters, quality, num_epochs,
+                  metric_monitor_period, early_good_model_delta,
+                  create_checkpoint_every, archive_last_checkpoint_every, model_bytes):
+
+        active = global_iters > 0
+
+        if create_checkpoint_every > 0:
+            is_checkpoint = active & (global_iters % create_checkpoint_every == 0)
+        else:
+            is_checkpoint = np.zeros(len(global_iters), dtype=bool)
+
+        num_archives = 0
+        if (archive_last_checkpoint_every > 0) and (create_checkpoint_every > 0):
+            num_archives = int(np.count_nonzero(active & (global_iters % archive_last_checkpoint_every == 0)))
+
+        monitored = active & np.isfinite(quality)
+        if (metric_monitor_period > 0) and (len(global_iters) > 0):
+            # Monitored if a period boundary passed since the previous iteration with a value
+            candidates = np.nonzero(monitored)[0]
+            candidate_iters = global_iters[candidates]
+            previous_iters = np.concatenate(([max(global_iters[0] - 1, 0)], candidate_iters[:-1]))
+
+            monitored = np.zeros(len(global_iters), dtype=bool)
+            monitored[candidates[candidate_iters // metric_monitor_period >
+                                 previous_iters // metric_monitor_period]] = True
+
+        monitored_iters = global_iters[monitored]
+        monitored_quality = quality[monitored]
+
+        # Strict improvement over the best quality so far
+        sign = -1. if self._metric_opt_mode == 'max' else 1.
+        running_best = np.minimum.accumulate(sign * monitored_quality)
+        previous_best = np.concatenate(([np.inf], running_best[:-1]))
+        improved = (sign * monitored_quality) < previous_best
+
+        improved_iters = monitored_iters[improved]
+        improved_quality = monitored_quality[improved]
+        improved_on_checkpoint = is_checkpoint[monitored][improved]
+
+        num_deletes, num_earliest_good_copies, max_models, registry = \
+            self._replay_improvements(improved_iters, improved_quality, early_good_model_delta)
+
+        num_improvements = len(improved_iters)
+        num_checkpoint_saves = int(np.count_nonzero(is_checkpoint)) + num_epochs
+        num_temp_copies = int(np.count_nonzero(improved_on_checkpoint))
+        num_temp_saves = num_improvements - num_temp_copies
+
+        num_saves = num_checkpoint_saves + num_temp_saves
+        num_copies = num_archives + num_temp_copies + num_improvements + num_earliest_good_copies
+
+        result = {
+            "num_iters": len(global_iters),
+            "num_monitored": len(monitored_iters),
+            "num_improvements": num_improvements,
+            "num_saves": num_saves,
+            "num_copies": num_copies,
+            "num_deletes": num_deletes,
+            "num_state_saves": num_improvements,
+            "num_checkpoint_saves": num_checkpoint_saves,
+            "num_temp_saves": num_temp_saves,
+            "num_temp_copies": num_temp_copies,
+            "num_best_copies": num_improvements,
+            "num_earliest_good_copies": num_earliest_good_copies,
+            "num_archives": num_archives,
+            "max_models": max_models,
+            "final_models": len(registry),
+            "best_model_quality": float(improved_quality[-1]) if num_improvements > 0 else None
+        }
+
+        if model_bytes is not None:
+            result["bytes_written"] = num_saves * model_bytes
+            result["bytes_copied"] = num_copies * model_bytes
+
+        return result
+
+    def _replay_improvements(self, improved_iters, improved_quality, early_good_model_delta):
+        """
+        Replays the pruning and earliest good model logic of the ModelCheckpointManager for every model improvement
+
+        :return: number of deletes, number of copies to the earliest good model file, max. number of registered
+                 models, final registry
+        """
+        registry = ModelRegistry(self._metric_opt_mode)
+
+        if self._metric_opt_mode == 'max':
+            boundary_factor = 1 - (early_good_model_delta / 100)
+        else:
+            boundary_factor = 1 + (early_good_model_delta / 100)
+
+        earliest_good_model = None
+        earliest_good_file_exists = False
+
+        num_deletes = 0
+        num_earliest_good_copies = 0
+        max_models = 0
+
+        for model_iter, model_quality in zip(improved_iters.tolist(), improved_quality.tolist()):
+            # Models are identified by their iteration
+            best_model = model_iter
+            registry.add(best_model, model_quality, model_iter)
+            max_models = max(max_models, len(registry))
+
+            for model in registry.not_better_than(model_quality * boundary_factor):
+                if model == best_model:
+                    continue
+
+                registry.remove(model)
+                num_deletes += 1
+
+            earliest_good_model_new = registry.earliest(exclude=best_model)
+            if earliest_good_model_new is None:
+                if earliest_good_file_exists:
+                    num_deletes += 1
+                    earliest_good_file_exists = False
+            elif earliest_good_model_new != earliest_good_model:
+                earliest_good_model = earliest_good_model_new
+                earliest_good_file_exists = True
+                num_earliest_good_copies += 1
+
+        return num_deletes, num_earliest_good_copies, max_models, registry
@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import tempfile
+from shutil import copyfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from basics.base import Base
+import basics.base_utils as _
+
+# Linux ioctl to clone (reflink) a file on copy-on-write file systems (e.g. btrfs, xfs)
+_FICLONE = 0x40049409
+
+_INDEX_FILE_NAME = 'index.json'
+
+
+class CheckpointStore(Base):
+    """
+
+    Content-addressed store for weight files.
+
+    Every weight file is stored once, as a blob named after the SHA-1 of its content. Named files (aliases) refer to
+    a blob through a hard link, a reflink when hard linking is not possible, or a copy as last resort. The store
+    counts the aliases per blob and removes a blob when its last alias is removed.
+
+    Aliases are always replaced atomically, a blob is never written in place. Hence, (over)writing an alias never
+    modifies the content of other aliases of the same blob.
+
+    """
+    def __init__(self, store_path, **kwargs):
+        super().__init__(**kwargs)
+
+        self._store_path = store_path
+        self._blob_path = os.path.join(store_path, 'blobs')
+
+        if not os.path.exists(self._blob_path):
+            os.makedirs(self._blob_path)
+
+        self._aliases = dict()
+        self._load_index()
+
+    def new_file_name(self):
+        """
+
+        :return: name of a new, empty, file in the store, to write a weight file to, before adding it with put()
+        """
+        fd, fname = tempfile.mkstemp(dir=self._store_path, suffix='.tmp')
+        os.close(fd)
+
+        return fname
+
+    def put(self, fname):
+        """
+        Moves a file in to the store
+
+        :param fname: file to add, it is moved, not copied
+        :return: blob id
+        """
+        blob_id = CheckpointStore._hash(fname)
+        blob_fname = self._blob_file_name(blob_id)
+
+        if os.path.isfile(blob_fname):
+            os.remove(fname)
+        else:
+            os.replace(fname, blob_fname)
+
+        return blob_id
+
+    def link(self, blob_id, alias):
+        """
+        Makes alias refer to the blob, an existing alias is replaced
+
+        :param blob_id:
+        :param alias: file name of the alias
+        """
+        alias = os.path.abspath(alias)
+        blob_fname = self._blob_file_name(blob_id)
+
+        if self._aliases.get(alias) == blob_id:
+            return
+
+        tmp_fname = "%s.%s.tmp" % (alias, blob_id[:8])
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+        CheckpointStore._link_file(blob_fname, tmp_fname)
+        os.replace(tmp_fname, alias)
+
+        previous_blob_id = self._aliases.get(alias)
+        self._aliases[alias] = blob_id
+        if previous_blob_id is not None:
+            self._release(previous_blob_id)
+
+        self._write_index()
+
+    def alias_of(self, fname):
+        """
+
+        :param fname:
+        :return: blob id the file refers to, None if the file is not an alias in this store
+        """
+        return self._aliases.get(os.path.abspath(fname))
+
+    def copy(self, source_fname, dest_fname):
+        """
+        Copies source_fname to dest_fname, by linking if source_fname is an alias, otherwise by adding a copy to
+        the store
+
+        :param source_fname:
+        :param dest_fname:
+        """
+        blob_id = self.alias_of(source_fname)
+        if blob_id is None:
+            tmp_fname = self.new_file_name()
+            copyfile(source_fname, tmp_fname)
+            blob_id = self.put(tmp_fname)
+
+        self.link(blob_id, dest_fname)
+
+    def remove(self, fname):
+        """
+        Removes an alias, the blob is removed when it was the last alias
+
+        :param fname:
+        """
+        alias = os.path.abspath(fname)
+
+        if os.path.isfile(alias):
+            os.remove(alias)
+
+        blob_id = self._aliases.pop(alias, None)
+        if blob_id is not None:
+            self._release(blob_id)
+            self._write_index()
+
+    def _release(self, blob_id):
+        if blob_id in self._aliases.values():
+            return
+
+        blob_fname = self._blob_file_name(blob_id)
+        self._log.debug("Removing unreferenced blob [%s]" % blob_fname)
+
+        if os.path.isfile(blob_fname):
+            os.remove(blob_fname)
+
+    def _blob_file_name(self, blob_id):
+        return os.path.join(self._blob_path, blob_id)
+
+    def _load_index(self):
+        fname = os.path.join(self._store_path, _INDEX_FILE_NAME)
+        if not os.path.isfile(fname):
+            return
+
+        try:
+            with open(fname, 'r') as f:
+                self._aliases = json.load(f)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to load checkpoint store index", e)
+
+    def _write_index(self):
+        fname = os.path.join(self._store_path, _INDEX_FILE_NAME)
+        with open("%s.tmp" % fname, 'w') as f:
+            json.dump(self._aliases, f, indent=4)
+
+        os.replace("%s.tmp" % fname, fname)
+
+    @staticmethod
+    def _link_file(source_fname, dest_fname):
+        try:
+            os.link(source_fname, dest_fname)
+            return
+        except OSError:
+            pass
+
+        if fcntl is not None:
+            try:
+                with open(source_fname, 'rb') as source, open(dest_fname, 'wb') as dest:
+                    fcntl.ioctl(dest.fileno(), _FICLONE, source.fileno())
+                return
+            except OSError:
+                if os.path.exists(dest_fname):
+                    os.remove(dest_fname)
+
+        copyfile(source_fname, dest_fname)
+
+    @staticmethod
+    def _hash(fname):
+        sha1 = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+
+        return sha1.hexdigest()
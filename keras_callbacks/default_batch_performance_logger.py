@@ -2,6 +2,8 @@ import json
 import numpy as np
 from keras import backend as K
 from keras_callbacks.batch_performance_logger_base import BatchPerformanceLoggerBase
+from keras_callbacks.numpy_metric_engine import NumpyMetricEngine
+from keras_callbacks.background_worker import BackgroundWorker
 from keras.losses import categorical_crossentropy, sparse_categorical_crossentropy
 from keras.metrics import categorical_accuracy, sparse_categorical_accuracy
 from keras.engine.training_utils import weighted_masked_objective
@@ -20,13 +22,61 @@ class DefaultBatchPerformanceLogger(BatchPerformanceLoggerBase):
                  inspector=None,
                  num_samples_to_inspect=5,
                  one_hot_encoding=True,
+                 fused_evaluation=False,
+                 metric_backend='tensorflow',
+                 max_chunk_elements=1 << 22,
+                 async_inspection=False,
                  **kwargs):
+        """
+
+        :param session:
+        :param max_seq_length:
+        :param num_symbols:
+        :param batch_generator:
+        :param metrics_name_postfix:
+        :param inspector:
+        :param num_samples_to_inspect:
+        :param one_hot_encoding:
+        :param fused_evaluation: If True, the metrics are calculated in one graph, from the model inputs to the
+                                 scalar metrics, instead of predicting the output batch and feeding it back to
+                                 calculate the metrics. Only the inputs, targets and sample weights are fed, and only
+                                 the metrics are fetched. The model output is only predicted to inspect the data.
+        :param metric_backend: 'tensorflow', or 'numpy' to calculate the metrics with NumPy, in chunks of time steps,
+                               without building a metric graph (see NumpyMetricEngine)
+        :param max_chunk_elements: maximum number of output values processed at once by the 'numpy' backend
+        :param async_inspection: If True, the inspector runs on a background thread. Only copies of
+                                 num_samples_to_inspect randomly selected samples are passed to it. When the
+                                 previous inspection is still running, the inspection is dropped.
+        """
         super().__init__(batch_generator, metrics_name_postfix, **kwargs)
 
         self._sess = session
 
         self._one_hot_encoding = one_hot_encoding
 
+        self._inspector = inspector
+        self._num_samples_to_inspect = num_samples_to_inspect
+
+        self._inspection_worker = None
+        self._num_dropped_inspections = 0
+        if async_inspection:
+            self._inspection_worker = BackgroundWorker(1, name="batch-inspector")
+            self._random = np.random.RandomState()
+
+        self._fused_evaluation = fused_evaluation
+        self._fused_ops = None
+
+        self._numpy_metrics = None
+        if metric_backend == 'numpy':
+            if self._fused_evaluation:
+                self._log.error("Fused evaluation requires the tensorflow metric backend, disabling fused evaluation")
+                self._fused_evaluation = False
+
+            self._numpy_metrics = NumpyMetricEngine(one_hot_encoding, max_chunk_elements, K.epsilon())
+            return
+        elif metric_backend != 'tensorflow':
+            self._log.error("Unknown metric backend [%s], using tensorflow" % metric_backend)
+
         if self._one_hot_encoding:
             self._target_batch_placeholder = K.placeholder((None, max_seq_length + 2, num_symbols))
         else:
@@ -47,49 +97,158 @@ class DefaultBatchPerformanceLogger(BatchPerformanceLoggerBase):
             self._output_batch_placeholder,
             self._sample_weights_batch_placeholder)
 
-        self._inspector = inspector
-        self._num_samples_to_inspect = num_samples_to_inspect
-
     def _predict_model(self, batch_data):
+        if self._fused_evaluation and not self._is_inspect_iter():
+            # The metrics are calculated from the inputs directly
+            return None
+
         inputs_batch = batch_data[0]
         return self.model.predict_on_batch(inputs_batch)
 
     def _calc_performance(self, generated_batch_data, predicted_batch_data):
+        cross_entropy, accuracy = self._calc_metric_values(generated_batch_data, predicted_batch_data)
+
+        return self._metrics_dict(self._metrics_name_postfix, cross_entropy, accuracy)
+
+    def _calc_metric_values(self, generated_batch_data, predicted_batch_data):
+        """
+
+        :param generated_batch_data: (inputs, targets, sample weights)
+        :param predicted_batch_data: output batch, None to calculate the metrics with the fused ops
+        :return: weighted cross entropy, weighted accuracy
+        """
         target_batch = generated_batch_data[1]
         sample_weights_batch = generated_batch_data[2]
 
-        output_batch = predicted_batch_data
-
-        with self._sess.as_default():
-            cross_entropy = self._weighted_categorical_cross_entropy_op.eval(
-                feed_dict={
-                    self._target_batch_placeholder: target_batch,
-                    self._output_batch_placeholder: output_batch,
-                    self._sample_weights_batch_placeholder: sample_weights_batch
-                })
+        if self._numpy_metrics is not None:
+            cross_entropy, accuracy = self._numpy_metrics.evaluate(target_batch,
+                                                                   predicted_batch_data,
+                                                                   sample_weights_batch)
+        elif predicted_batch_data is None:
+            cross_entropy, accuracy = self._calc_fused_performance(generated_batch_data[0],
+                                                                   target_batch,
+                                                                   sample_weights_batch)
+        else:
+            output_batch = predicted_batch_data
 
-            accuracy = self._weighted_categorical_accuracy_op.eval(
+            cross_entropy, accuracy = self._sess.run(
+                [self._weighted_categorical_cross_entropy_op, self._weighted_categorical_accuracy_op],
                 feed_dict={
                     self._target_batch_placeholder: target_batch,
                     self._output_batch_placeholder: output_batch,
                     self._sample_weights_batch_placeholder: sample_weights_batch
                 })
 
-        pf = self._metrics_name_postfix
+        return cross_entropy, accuracy
 
+    @staticmethod
+    def _metrics_dict(pf, cross_entropy, accuracy):
         return {
             ('batch_cross_entropy_%s' % pf): cross_entropy,
             ('batch_perplexity_%s' % pf): np.exp(cross_entropy),
             ('batch_accuracy_%s' % pf): accuracy
         }
 
+    def _calc_fused_performance(self, inputs_batch, target_batch, sample_weights_batch):
+        cross_entropy_op, accuracy_op = self._get_fused_ops()
+
+        inputs_batch = inputs_batch if isinstance(inputs_batch, (list, tuple)) else [inputs_batch]
+
+        feed_dict = dict(zip(self.model.inputs, inputs_batch))
+        feed_dict[self._target_batch_placeholder] = target_batch
+        feed_dict[self._sample_weights_batch_placeholder] = sample_weights_batch
+
+        if getattr(self.model, 'uses_learning_phase', False):
+            # Test mode, as in predict_on_batch
+            feed_dict[K.learning_phase()] = 0
+
+        return self._sess.run([cross_entropy_op, accuracy_op], feed_dict=feed_dict)
+
+    def _get_fused_ops(self):
+        """
+        Builds the metric ops on the model output, the model is only available after the callback is set up
+
+        :return: cross entropy op, accuracy op
+        """
+        if self._fused_ops is not None:
+            return self._fused_ops
+
+        output = self.model.outputs[0]
+
+        loss = categorical_crossentropy if self._one_hot_encoding else sparse_categorical_crossentropy
+        cross_entropy_op = weighted_masked_objective(loss)(
+            self._target_batch_placeholder,
+            output,
+            self._sample_weights_batch_placeholder)
+
+        metric = categorical_accuracy if self._one_hot_encoding else sparse_categorical_accuracy
+        accuracy_op = weighted_masked_objective(metric)(
+            self._target_batch_placeholder,
+            output,
+            self._sample_weights_batch_placeholder)
+
+        self._fused_ops = (cross_entropy_op, accuracy_op)
+
+        return self._fused_ops
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+
+        if self._inspection_worker is not None:
+            stats = self._inspection_worker.stats()
+            self._log.info("Inspections : %d, dropped : %d, mean inspection time : %0.3fs" %
+                           (stats["num_tasks"], self._num_dropped_inspections, stats["mean_latency"]))
+
     def _inspect_data(self, generated_batch_data, predicted_batch_data, batch_metrics_data):
+        self._inspect_samples(batch_metrics_data, [(generated_batch_data, predicted_batch_data)])
+
+    def _inspect_samples(self, batch_metrics_data, samples):
+        """
+
+        :param batch_metrics_data:
+        :param samples: list of (generated batch data, predicted batch data) tuples to inspect
+        """
         if not (hasattr(self._inspector, "inspect") and _.is_callable(self._inspector.inspect)):
             self._log.error("No valid inspector given, unable to inspect random samples")
             return
 
+        if self._inspection_worker is None:
+            self._run_inspection(batch_metrics_data, samples)
+            return
+
+        # Inspection may never slow down training
+        if self._inspection_worker.is_busy():
+            self._num_dropped_inspections += 1
+            self._log.debug("Inspector busy, dropping inspection")
+            return
+
+        samples = [self._select_samples(generated_batch_data, predicted_batch_data)
+                   for generated_batch_data, predicted_batch_data in samples]
+
+        if not self._inspection_worker.submit(self._run_inspection, dict(batch_metrics_data), samples, block=False):
+            self._num_dropped_inspections += 1
+
+    def _run_inspection(self, batch_metrics_data, samples):
         self._log.info("Current batch performance metrics : \n%s")
         for metric, value in batch_metrics_data.items():
             self._log.info("%s : %f" % (metric, value))
 
-        self._inspector.inspect(generated_batch_data, predicted_batch_data, self._num_samples_to_inspect)
+        for generated_batch_data, predicted_batch_data in samples:
+            self._inspector.inspect(generated_batch_data, predicted_batch_data, self._num_samples_to_inspect)
+
+    def _select_samples(self, generated_batch_data, predicted_batch_data):
+        """
+
+        :return: copies of num_samples_to_inspect random samples of the generated and predicted batch data
+        """
+        batch_size = len(generated_batch_data[1])
+        num_samples = min(self._num_samples_to_inspect, batch_size)
+        indices = np.sort(self._random.choice(batch_size, num_samples, replace=False))
+
+        def take(data):
+            if isinstance(data, (list, tuple)):
+                return type(data)(take(item) for item in data)
+
+            return np.asarray(data)[indices]
+
+        return take(generated_batch_data), take(predicted_batch_data)
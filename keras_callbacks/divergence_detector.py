@@ -0,0 +1,280 @@
+import os
+
+import numpy as np
+
+from keras.callbacks import Callback
+import keras.backend as K
+
+from basics.base import Base
+import basics.base_utils as _
+
+from keras_callbacks.sharded_weights import ShardedWeights
+
+
+class DivergenceDetector(Base, Callback):
+    """
+
+    Detects divergence of training, restores the weights of the last good checkpoint of a ModelCheckpointManager and
+    continues training, or stops training when it keeps diverging.
+
+    Every check_period iterations the metrics to monitor (metrics to minimise, e.g. loss, batch perplexity) are
+    tested, all at once:
+
+    * finite test : a NaN or inf value is a divergence
+    * spike test : a value higher than median + spike_threshold * scale of the last window_length values, with scale
+      1.4826 * median absolute deviation, at least min_relative_scale * |median|. Spikes in spike_patience
+      consecutive checks are a divergence. The test starts once the window is full.
+
+    On divergence, pending checkpoint operations are flushed and the weights are loaded from the latest checkpoint
+    (rollback_to='latest') or from the latest best model (rollback_to='best'). When a file is not available, or
+    contains non-finite weights, the other one is used, then the earliest good model. Non-finite optimizer weights
+    (e.g. the moment estimates of Adam) are reset to zero. If a learning rate scheduler is given, its learning rate
+    is scaled with lr_factor.
+
+    After max_rollbacks rollbacks, or when no good checkpoint is available, training is stopped.
+
+    """
+    def __init__(self,
+                 checkpoint_manager,
+                 metrics_to_monitor=("loss",),
+                 window_length=100,
+                 check_period=1,
+                 spike_threshold=10.,
+                 spike_patience=3,
+                 min_relative_scale=0.01,
+                 rollback_to='latest',
+                 max_rollbacks=3,
+                 lr_scheduler=None,
+                 lr_factor=0.5,
+                 reset_optimizer_state=True,
+                 metric_bus=None,
+                 **kwargs):
+        """
+
+        :param checkpoint_manager: ModelCheckpointManager of the model
+        :param metrics_to_monitor: names of the metrics to test, metrics to minimise
+        :param window_length: number of recent values of every metric used by the spike test
+        :param check_period: number of iterations between tests
+        :param spike_threshold: number of (robust) standard deviations above the median for a spike,
+                                None to only test for non-finite values
+        :param spike_patience: number of consecutive checks with a spike for a divergence
+        :param min_relative_scale: minimum scale of the spike test, relative to the median
+        :param rollback_to: 'latest', 'best'
+        :param max_rollbacks: maximum number of rollbacks, training is stopped at the next divergence
+        :param lr_scheduler: LearningRateScheduler to scale the learning rate of after a rollback, None to keep it
+        :param lr_factor: factor to scale the learning rate with after every rollback
+        :param reset_optimizer_state: If True, optimizer weights with non-finite values are reset to zero after a
+                                      rollback
+        :param metric_bus: MetricBus to read the metrics from, instead of the logs
+        """
+        super().__init__(**kwargs)
+
+        self._checkpoint_manager = checkpoint_manager
+        self._metrics_to_monitor = list(metrics_to_monitor)
+        self._window_length = window_length
+        self._check_period = max(1, check_period)
+        self._spike_threshold = spike_threshold
+        self._spike_patience = spike_patience
+        self._min_relative_scale = min_relative_scale
+        self._rollback_to = rollback_to
+        self._max_rollbacks = max_rollbacks
+        self._lr_scheduler = lr_scheduler
+        self._lr_factor = lr_factor
+        self._reset_optimizer_state = reset_optimizer_state
+
+        self._metric_bus = metric_bus
+        self._slots = None
+        if metric_bus is not None:
+            self._slots = np.array([metric_bus.slot(metric) for metric in self._metrics_to_monitor], dtype=np.int64)
+
+        num_metrics = len(self._metrics_to_monitor)
+
+        # Ring buffer per metric, with the finite values only
+        self._window = np.full((self._window_length, num_metrics), np.nan)
+        self._positions = np.zeros(num_metrics, dtype=np.int64)
+        self._counts = np.zeros(num_metrics, dtype=np.int64)
+
+        self._iter = -1
+        self._num_spikes = 0
+        self._num_rollbacks = 0
+        self._rollback_iters = []
+
+        self._check_settings()
+
+    def on_batch_end(self, batch, logs=None):
+        self._iter += 1
+
+        if self._iter % self._check_period != 0:
+            return
+
+        values, available = self._metric_values(batch, logs)
+        if not np.any(available):
+            return
+
+        finite = np.isfinite(values)
+        if np.any(available & ~finite):
+            self._diverged("non-finite value of %s" % self._metric_names(available & ~finite))
+            return
+
+        spikes = self._spikes(values, available)
+        if np.any(spikes):
+            self._num_spikes += 1
+            self._log.warning("Iter : %d : Spike in %s (%d / %d)" %
+                              (self._iter, self._metric_names(spikes), self._num_spikes, self._spike_patience))
+
+            if self._num_spikes >= self._spike_patience:
+                self._diverged("spikes in %s" % self._metric_names(spikes))
+                return
+        else:
+            self._num_spikes = 0
+
+        self._add(values, available)
+
+    def on_train_end(self, logs=None):
+        if self._num_rollbacks > 0:
+            self._log.info("Rollbacks : %d, at iterations : %s" % (self._num_rollbacks, self._rollback_iters))
+
+    def stats(self):
+        return {
+            "num_rollbacks": self._num_rollbacks,
+            "rollback_iters": list(self._rollback_iters)
+        }
+
+    def _metric_values(self, batch, logs):
+        """
+
+        :return: float64 values of the metrics to monitor, boolean array with the metrics available in this iteration
+        """
+        if self._metric_bus is not None:
+            self._metric_bus.sync(batch, logs)
+
+            return (self._metric_bus.values(self._slots),
+                    self._metric_bus.updated_steps(self._slots) == self._metric_bus.step)
+
+        if not _.is_dict(logs):
+            return np.zeros(0), np.zeros(0, dtype=bool)
+
+        values = np.array([logs.get(metric, np.nan) for metric in self._metrics_to_monitor], dtype=np.float64)
+        available = np.array([metric in logs for metric in self._metrics_to_monitor], dtype=bool)
+
+        return values, available
+
+    def _spikes(self, values, available):
+        """
+
+        :return: boolean array with the metrics with a spike, compared to the window
+        """
+        if self._spike_threshold is None:
+            return np.zeros(len(values), dtype=bool)
+
+        full = available & (self._counts >= self._window_length)
+        if not np.any(full):
+            return full
+
+        window = self._window[:, full]
+        median = np.median(window, axis=0)
+        scale = 1.4826 * np.median(np.abs(window - median), axis=0)
+        scale = np.maximum(scale, self._min_relative_scale * np.abs(median))
+
+        spikes = np.zeros(len(values), dtype=bool)
+        spikes[full] = values[full] > median + self._spike_threshold * scale
+
+        return spikes
+
+    def _add(self, values, available):
+        columns = np.nonzero(available)[0]
+
+        self._window[self._positions[columns], columns] = values[columns]
+        self._positions[columns] = (self._positions[columns] + 1) % self._window_length
+        self._counts[columns] += 1
+
+    def _diverged(self, reason):
+        self._log.error("Iter : %d : Training diverged : %s" % (self._iter, reason))
+
+        self._num_spikes = 0
+
+        if self._num_rollbacks >= self._max_rollbacks:
+            self._log.error("Maximum number of rollbacks (%d) reached, stopping training" % self._max_rollbacks)
+            self.model.stop_training = True
+            return
+
+        if not self._rollback():
+            self._log.error("No good checkpoint available, stopping training")
+            self.model.stop_training = True
+            return
+
+        self._num_rollbacks += 1
+        self._rollback_iters.append(self._iter)
+
+        # The window contains the values of the diverged model
+        self._window[...] = np.nan
+        self._positions[...] = 0
+        self._counts[...] = 0
+
+        if self._lr_scheduler is not None:
+            self._lr_scheduler.scale_lr(self._lr_factor)
+
+    def _rollback(self):
+        """
+        Restores the weights of the last good checkpoint
+
+        :return: True if the weights are restored
+        """
+        manager = self._checkpoint_manager
+
+        try:
+            # Pending checkpoint files need to be complete before loading
+            manager.flush()
+        except Exception as e:
+            _.log_exception(self._log, "Unable to flush pending checkpoint operations", e)
+
+        fnames = [manager.latest_model_file_name(), manager.latest_best_model_file_name()]
+        if self._rollback_to == 'best':
+            fnames.reverse()
+        fnames.append(manager.earliest_good_model_file_name())
+
+        for fname in fnames:
+            if not os.path.isfile(fname):
+                continue
+
+            try:
+                snapshot = ShardedWeights.load(fname)
+                if not all(np.all(np.isfinite(value)) for value in snapshot.values()):
+                    self._log.warning("Checkpoint [%s] contains non-finite weights, skipping" % fname)
+                    continue
+
+                self._log.info("Rolling back to checkpoint [%s]" % fname)
+                snapshot.apply_to(self.model)
+
+                if self._reset_optimizer_state:
+                    self._reset_non_finite_optimizer_weights()
+
+                return True
+            except Exception as e:
+                _.log_exception(self._log, "Unable to roll back to checkpoint [%s]" % fname, e)
+
+        return False
+
+    def _reset_non_finite_optimizer_weights(self):
+        optimizer = getattr(self.model, 'optimizer', None)
+        if optimizer is None:
+            return
+
+        weights = optimizer.weights
+        values = K.batch_get_value(weights)
+
+        reset = [(weight, np.zeros_like(value)) for weight, value in zip(weights, values)
+                 if not np.all(np.isfinite(value))]
+        if len(reset) == 0:
+            return
+
+        self._log.info("Resetting %d non-finite optimizer weights" % len(reset))
+        K.batch_set_value(reset)
+
+    def _metric_names(self, mask):
+        return ", ".join(metric for metric, selected in zip(self._metrics_to_monitor, mask) if selected)
+
+    def _check_settings(self):
+        if self._rollback_to not in ['latest', 'best']:
+            self._log.error("Unknown rollback target : [%s], using 'latest'" % self._rollback_to)
+            self._rollback_to = 'latest'
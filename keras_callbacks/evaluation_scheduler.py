@@ -0,0 +1,118 @@
+import math
+import time
+
+from basics.base import Base
+
+
+class EvaluationScheduler(Base):
+    """
+
+    Decides at which training iterations a batch level performance logger evaluates.
+
+    * fixed : every period iterations
+    * adaptive (max_overhead given) : the period is adapted such that evaluation takes at most max_overhead share of
+      the wall clock time. The time of a training step (everything between two calls of the logger) and the time of
+      an evaluation are tracked with exponential moving averages, the period is:
+
+          eval_time * (1 - max_overhead) / (max_overhead * step_time)
+
+      clipped to [min_period, max_period].
+
+    The first iteration is always evaluated.
+
+    """
+    def __init__(self, period=1, max_overhead=None, min_period=1, max_period=1000, smoothing=0.1, **kwargs):
+        """
+
+        :param period: evaluation period in fixed mode, initial period in adaptive mode
+        :param max_overhead: maximum share of the wall clock time spent on evaluation (e.g. 0.05), None for a fixed
+                             period
+        :param min_period:
+        :param max_period:
+        :param smoothing: weight of a new measurement in the moving averages of the step and evaluation time
+        """
+        super().__init__(**kwargs)
+
+        self._period = max(1, period)
+        self._max_overhead = max_overhead
+        self._min_period = max(1, min_period)
+        self._max_period = max_period
+        self._smoothing = smoothing
+
+        self._iters_since_evaluation = None
+
+        self._last_time = None
+        self._step_time = None
+        self._evaluation_time = None
+
+        self._num_evaluations = 0
+        self._num_skipped = 0
+        self._total_step_time = 0.
+        self._total_evaluation_time = 0.
+
+    @property
+    def period(self):
+        return self._period
+
+    def should_evaluate(self, force=False):
+        """
+        Called once per training iteration, before evaluating
+
+        :param force: evaluate, regardless of the period (e.g. to inspect the data)
+        :return: True if the logger should evaluate in this iteration
+        """
+        now = time.time()
+        if self._last_time is not None:
+            step_time = now - self._last_time
+            self._total_step_time += step_time
+            self._step_time = self._moving_average(self._step_time, step_time)
+
+        if (self._iters_since_evaluation is None) or force or (self._iters_since_evaluation + 1 >= self._period):
+            self._iters_since_evaluation = 0
+            self._num_evaluations += 1
+            return True
+
+        self._iters_since_evaluation += 1
+        self._num_skipped += 1
+        self._last_time = time.time()
+
+        return False
+
+    def evaluated(self, evaluation_time):
+        """
+        Called after evaluating
+
+        :param evaluation_time: duration of the evaluation in seconds
+        """
+        self._total_evaluation_time += evaluation_time
+        self._evaluation_time = self._moving_average(self._evaluation_time, evaluation_time)
+        self._last_time = time.time()
+
+        if (self._max_overhead is None) or (self._step_time is None) or (self._step_time <= 0):
+            return
+
+        period = self._evaluation_time * (1 - self._max_overhead) / (self._max_overhead * self._step_time)
+        self._period = int(min(max(math.ceil(period), self._min_period), self._max_period))
+
+    def stats(self):
+        """
+
+        :return: dict with the number of evaluated and skipped iterations, the current period and the measured share
+                 of the wall clock time spent on evaluation
+        """
+        total_time = self._total_step_time + self._total_evaluation_time
+
+        return {
+            "num_evaluations": self._num_evaluations,
+            "num_skipped": self._num_skipped,
+            "period": self._period,
+            "step_time": self._step_time,
+            "evaluation_time": self._evaluation_time,
+            "overhead": self._total_evaluation_time / total_time if total_time > 0 else 0.
+        }
+
+    def _moving_average(self, average, value):
+        if average is None:
+            return value
+
+        return (1 - self._smoothing) * average + self._smoothing * value
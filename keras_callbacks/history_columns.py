@@ -0,0 +1,295 @@
+import datetime
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class HistoryColumn():
+    """
+
+    Growable, typed, column of history values, stored in fixed size numpy chunks.
+
+    Integer values are stored as int64, floating point values as float_dtype. When a float value is appended to an
+    integer column, the column is promoted to float_dtype. Values that are not numeric are stored in a plain list.
+
+    """
+    def __init__(self, float_dtype='float32', chunk_size=4096, values=None):
+        self._float_dtype = np.dtype(float_dtype)
+        self._chunk_size = chunk_size
+
+        self._dtype = None
+        self._chunks = []
+        self._objects = None
+        self._length = 0
+
+        # Number of dropped values at the start of the first chunk
+        self._offset = 0
+
+        if values is not None:
+            self.extend(values)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self._chunks)
+
+    def append(self, value):
+        if self._dtype is None:
+            self._dtype = self._infer_dtype(value)
+        elif (self._dtype.kind in 'iu') and (self._infer_dtype(value).kind == 'f'):
+            self._promote(self._float_dtype)
+
+        if self._dtype.kind == 'O':
+            self._objects.append(value)
+            self._length += 1
+            return
+
+        index = (self._offset + self._length) % self._chunk_size
+        if index == 0:
+            self._chunks.append(np.empty((self._chunk_size,), dtype=self._dtype))
+
+        self._chunks[-1][index] = value
+        self._length += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def drop_head(self, num_values):
+        """
+        Drops the first num_values values, memory is released per chunk
+
+        :param num_values:
+        """
+        num_values = min(num_values, self._length)
+        if num_values <= 0:
+            return
+
+        self._length -= num_values
+        if self._is_object():
+            del self._objects[:num_values]
+            return
+
+        self._offset += num_values
+        num_chunks = self._offset // self._chunk_size
+        if self._length == 0:
+            num_chunks = len(self._chunks)
+            self._offset = 0
+        else:
+            self._offset -= num_chunks * self._chunk_size
+
+        del self._chunks[:num_chunks]
+
+    def to_numpy(self):
+        return self._range(0, self._length)
+
+    def tolist(self):
+        return list(self._objects) if self._is_object() else self.to_numpy().tolist()
+
+    def copy(self):
+        column = HistoryColumn(self._float_dtype, self._chunk_size)
+        column._dtype = self._dtype
+        column._chunks = [chunk.copy() for chunk in self._chunks]
+        column._objects = None if self._objects is None else list(self._objects)
+        column._length = self._length
+        column._offset = self._offset
+
+        return column
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self._is_object():
+            return iter(self._objects)
+
+        return (self[i] for i in range(self._length))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._length)
+            if self._is_object():
+                return self._objects[start:stop:step]
+
+            if step == 1:
+                return self._range(start, max(start, stop))
+
+            return self.to_numpy()[item]
+
+        index = item + self._length if item < 0 else item
+        if not (0 <= index < self._length):
+            raise IndexError("History column index out of range")
+
+        if self._is_object():
+            return self._objects[index]
+
+        index += self._offset
+
+        return self._chunks[index // self._chunk_size][index % self._chunk_size]
+
+    def __getstate__(self):
+        # Store the column compactly, as a single array
+        state = self.__dict__.copy()
+        state['_chunks'] = [] if self._is_object() else [self.to_numpy()]
+        state['_offset'] = 0
+
+        return state
+
+    def __setstate__(self, state):
+        values = state['_chunks'][0] if len(state['_chunks']) > 0 else None
+        self.__dict__.update(state)
+
+        # Restore the fixed size chunks
+        self._chunks = []
+        if values is not None:
+            for start in range(0, self._length, self._chunk_size):
+                chunk = np.empty((self._chunk_size,), dtype=self._dtype)
+                part = values[start:start + self._chunk_size]
+                chunk[:len(part)] = part
+                self._chunks.append(chunk)
+
+    def _range(self, start, stop):
+        if self._is_object():
+            return np.array(self._objects[start:stop], dtype='O')
+
+        if self._dtype is None:
+            return np.zeros((0,), dtype=self._float_dtype)
+
+        if stop <= start:
+            return np.zeros((0,), dtype=self._dtype)
+
+        start += self._offset
+        stop += self._offset
+
+        first_chunk = start // self._chunk_size
+        last_chunk = (stop - 1) // self._chunk_size
+
+        parts = []
+        for chunk_idx in range(first_chunk, last_chunk + 1):
+            chunk_start = chunk_idx * self._chunk_size
+            parts.append(self._chunks[chunk_idx][max(start - chunk_start, 0):min(stop - chunk_start, self._chunk_size)])
+
+        return np.concatenate(parts) if len(parts) > 1 else parts[0].copy()
+
+    def _promote(self, dtype):
+        self._dtype = np.dtype(dtype)
+        self._chunks = [chunk.astype(self._dtype) for chunk in self._chunks]
+
+    def _infer_dtype(self, value):
+        if isinstance(value, (bool, np.bool_)):
+            dtype = np.dtype('bool')
+        elif isinstance(value, (int, np.integer)):
+            dtype = np.dtype('int64')
+        elif isinstance(value, (float, np.floating)):
+            dtype = self._float_dtype
+        else:
+            dtype = np.dtype('O')
+
+        if (dtype.kind == 'O') and (self._objects is None):
+            self._objects = []
+
+        return dtype
+
+    def _is_object(self):
+        return (self._dtype is not None) and (self._dtype.kind == 'O')
+
+
+class DateColumn():
+    """
+
+    Read-only column with date strings, derived from a time_stamp column (milliseconds)
+
+    """
+    def __init__(self, time_stamp_column):
+        self._time_stamp_column = time_stamp_column
+
+    def tolist(self):
+        return [DateColumn.date(t) for t in self._time_stamp_column]
+
+    def __len__(self):
+        return len(self._time_stamp_column)
+
+    def __iter__(self):
+        return (DateColumn.date(t) for t in self._time_stamp_column)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [DateColumn.date(t) for t in self._time_stamp_column[item]]
+
+        return DateColumn.date(self._time_stamp_column[item])
+
+    @staticmethod
+    def date(time_stamp):
+        return str(datetime.datetime.fromtimestamp(time_stamp / 1000.0))
+
+
+class ColumnStore(Mapping):
+    """
+
+    Compact, dict-like, history backend built on HistoryColumns.
+
+    Reading works as with the dict of lists kept by the BatchMetricHistory, the date column is derived from the
+    time_stamp column when it is asked for.
+
+    """
+    def __init__(self, float_dtype='float32', chunk_size=4096):
+        self._float_dtype = float_dtype
+        self._chunk_size = chunk_size
+
+        self._columns = dict()
+
+    @staticmethod
+    def from_dict(history, float_dtype='float32', chunk_size=4096):
+        """
+
+        :param history: dict mapping column names to lists of values (e.g. a previously pickled history)
+        :param float_dtype:
+        :param chunk_size:
+        :return: ColumnStore with the same content
+        """
+        store = ColumnStore(float_dtype, chunk_size)
+        for key, values in history.items():
+            if key == 'date':
+                continue
+
+            store.setdefault(key).extend(values)
+
+        return store
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+    def setdefault(self, key, default=None):
+        if key not in self._columns:
+            self._columns[key] = HistoryColumn(self._float_dtype, self._chunk_size)
+
+        return self._columns[key]
+
+    def copy(self):
+        store = ColumnStore(self._float_dtype, self._chunk_size)
+        store._columns = {key: column.copy() for key, column in self._columns.items()}
+
+        return store
+
+    def to_dict(self):
+        return {key: self[key].tolist() for key in self}
+
+    def __getitem__(self, key):
+        if (key == 'date') and ('date' not in self._columns) and ('time_stamp' in self._columns):
+            return DateColumn(self._columns['time_stamp'])
+
+        return self._columns[key]
+
+    def __iter__(self):
+        keys = list(self._columns.keys())
+        if ('time_stamp' in self._columns) and ('date' not in self._columns):
+            keys.append('date')
+
+        return iter(keys)
+
+    def __len__(self):
+        return len(self._columns) + (1 if ('time_stamp' in self._columns) and ('date' not in self._columns) else 0)
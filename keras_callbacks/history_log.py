@@ -0,0 +1,507 @@
+import os
+import json
+import shutil
+import datetime
+
+import numpy as np
+
+from basics.base import Base
+
+_META_FILE_NAME = 'meta.json'
+
+# Column used to count the number of rows in the log
+ROW_KEY = 'global_iter'
+
+# Columns that are not stored, but derived from other columns when read
+DERIVED_COLUMNS = ('date',)
+
+
+def _segment_dir_name(segment):
+    return '%06d' % segment
+
+
+def _column_file_name(column_id):
+    return '%d.bin' % column_id
+
+
+def _date_from_time_stamp(t):
+    return str(datetime.datetime.fromtimestamp(t / 1000.0))
+
+
+def _segments(log_path):
+    if not os.path.isdir(log_path):
+        return []
+
+    return sorted(int(name) for name in os.listdir(log_path) if name.isdigit())
+
+
+class HistoryLogWriter(Base):
+    """
+
+    Append-only, columnar, on-disk history log.
+
+    The log is a directory with a small meta data file and one sub-directory per segment of segment_rows rows.
+    Each segment holds one raw binary file per column, values are appended to these files. Hence, every call to
+    append() only writes the rows added since the previous call, independent of the length of the history.
+
+    Column values are assumed to be contiguous from the first row they appear in (the first_row meta data).
+
+    """
+    def __init__(self, log_path, segment_rows=65536, **kwargs):
+        """
+
+        :param log_path: directory of the history log
+        :param segment_rows: number of rows per segment
+        """
+        super().__init__(**kwargs)
+
+        self._log_path = log_path
+        self._segment_rows = segment_rows
+
+        self._columns = dict()
+        self._disk_rows = dict()
+        self._written = dict()
+        self._skipped = set()
+
+        self._load_meta()
+
+    def sync_with(self, history, keep_existing=False):
+        """
+        Aligns the columns on disk with the given in-memory history, must be called before the first append().
+
+        :param history: dict-like history; rows on disk that are not in the history are truncated,
+                        rows in the history that are not on disk will be written by the next append()
+        :param keep_existing: if True, all rows on disk are kept and all rows in the given history are considered
+                              new rows, following the rows on disk (e.g. when resuming from the tail of the log)
+        """
+        history = history or {}
+
+        for key in list(self._columns.keys()):
+            if keep_existing:
+                self._written[key] = 0
+                continue
+
+            keep = min(self._disk_rows[key], len(history[key]) if key in history else 0)
+            self._truncate_column(key, keep)
+            self._written[key] = keep
+
+        self._write_meta()
+
+    def append(self, history):
+        """
+        Appends all rows that are added to the history since the previous call
+
+        :param history: dict-like history, mapping column names to sequences of values
+        :return: number of new rows
+        """
+        return self.write_chunk(self.take_chunk(history))
+
+    def take_chunk(self, history):
+        """
+        Copies the rows that are added to the history since the previous call. The returned chunk can be written
+        later on, using write_chunk(), chunks must be written in the order they are taken.
+
+        :param history: dict-like history, mapping column names to sequences of values
+        :return: chunk dict
+        """
+        columns = dict()
+        for key in history.keys():
+            if (key in DERIVED_COLUMNS) or (key in self._skipped):
+                continue
+
+            values = history[key]
+            offset = self._written.get(key, 0)
+            if len(values) <= offset:
+                continue
+
+            values = np.asarray(values[offset:])
+            if values.dtype.kind not in 'biuf':
+                self._log.warning("Values of column [%s] are not numeric, column will not be logged" % key)
+                self._skipped.add(key)
+                continue
+
+            columns[key] = values
+            self._written[key] = offset + len(values)
+
+        return {
+            "columns": columns
+        }
+
+    def write_chunk(self, chunk):
+        """
+        Writes a chunk taken with take_chunk()
+
+        :param chunk: chunk dict
+        :return: number of new rows
+        """
+        columns = chunk["columns"]
+
+        rows_before = self._disk_rows.get(ROW_KEY, 0)
+        if ROW_KEY in columns:
+            rows_after = rows_before + len(columns[ROW_KEY])
+        else:
+            rows_after = max([rows_before] + [len(v) for v in columns.values()])
+
+        meta_changed = False
+        for key, values in columns.items():
+            if key not in self._columns:
+                self._columns[key] = {
+                    "id": self._next_column_id(),
+                    "dtype": values.dtype.str,
+                    "first_row": rows_after - len(values)
+                }
+                self._disk_rows[key] = 0
+                meta_changed = True
+
+        if meta_changed:
+            self._write_meta()
+
+        for key, values in columns.items():
+            self._write_column(key, values)
+
+        return rows_after - rows_before
+
+    def _write_column(self, key, values):
+        column = self._columns[key]
+        values = values.astype(np.dtype(column["dtype"]), copy=False)
+
+        row = column["first_row"] + self._disk_rows[key]
+        start = 0
+        while start < len(values):
+            segment = row // self._segment_rows
+            end = start + min(len(values) - start, (segment + 1) * self._segment_rows - row)
+
+            segment_path = os.path.join(self._log_path, _segment_dir_name(segment))
+            if not os.path.isdir(segment_path):
+                os.makedirs(segment_path)
+
+            with open(os.path.join(segment_path, _column_file_name(column["id"])), 'ab') as f:
+                f.write(values[start:end].tobytes())
+
+            row += end - start
+            start = end
+
+        self._disk_rows[key] += len(values)
+
+    def _truncate_column(self, key, num_rows):
+        column = self._columns[key]
+        itemsize = np.dtype(column["dtype"]).itemsize
+        first_row = column["first_row"]
+
+        for segment in _segments(self._log_path):
+            fname = os.path.join(self._log_path, _segment_dir_name(segment), _column_file_name(column["id"]))
+            if not os.path.isfile(fname):
+                continue
+
+            segment_first_row = max(first_row, segment * self._segment_rows)
+            keep = min(max(first_row + num_rows - segment_first_row, 0), self._segment_rows)
+            if keep == 0:
+                os.remove(fname)
+            elif os.path.getsize(fname) > keep * itemsize:
+                os.truncate(fname, keep * itemsize)
+
+        if num_rows == 0:
+            self._columns.pop(key)
+            self._disk_rows.pop(key)
+        else:
+            self._disk_rows[key] = num_rows
+
+    def remove_segments_before(self, global_iter):
+        """
+        Removes all segments, except the last one, that only hold rows with a global iteration before global_iter
+
+        :param global_iter:
+        :return: number of removed segments
+        """
+        if ROW_KEY not in self._columns:
+            return 0
+
+        column = self._columns[ROW_KEY]
+        dtype = np.dtype(column["dtype"])
+
+        num_removed = 0
+        for segment in _segments(self._log_path)[:-1]:
+            segment_path = os.path.join(self._log_path, _segment_dir_name(segment))
+            fname = os.path.join(segment_path, _column_file_name(column["id"]))
+
+            count = os.path.getsize(fname) // dtype.itemsize if os.path.isfile(fname) else 0
+            if count > 0:
+                last_iter = np.fromfile(fname, dtype=dtype, count=1, offset=(count - 1) * dtype.itemsize)[0]
+                if last_iter >= global_iter:
+                    break
+
+            self._log.debug("Removing history log segment [%s]" % segment_path)
+            shutil.rmtree(segment_path)
+            num_removed += 1
+
+        return num_removed
+
+    def discard_head(self, key, num_values):
+        """
+        Must be called when the first num_values values of a column are removed from the in-memory history,
+        after they are taken by take_chunk()
+
+        :param key: column name
+        :param num_values:
+        """
+        if key in self._written:
+            self._written[key] = max(self._written[key] - num_values, 0)
+
+    def _next_column_id(self):
+        return max([c["id"] for c in self._columns.values()] + [-1]) + 1
+
+    def _load_meta(self):
+        meta = HistoryLogReader.read_meta(self._log_path)
+        if meta is None:
+            self._log.debug("No existing history log found at [%s]" % self._log_path)
+            return
+
+        self._segment_rows = meta["segment_rows"]
+        self._columns = meta["columns"]
+
+        reader = HistoryLogReader(self._log_path)
+        for key in self._columns.keys():
+            self._disk_rows[key] = reader.end_row(key) - reader.first_row(key)
+
+    def _write_meta(self):
+        if not os.path.isdir(self._log_path):
+            os.makedirs(self._log_path)
+
+        fname = os.path.join(self._log_path, _META_FILE_NAME)
+        with open("%s.tmp" % fname, 'w') as f:
+            json.dump({
+                "segment_rows": self._segment_rows,
+                "columns": self._columns
+            }, f, indent=4)
+
+        os.replace("%s.tmp" % fname, fname)
+
+
+class HistoryLogReader(Base):
+    """
+
+    Reads a history log written by the HistoryLogWriter.
+
+    Column files are memory-mapped, only the rows that are accessed are read from disk. Rows can be looked up by
+    global_iter and epoch, which are both non-decreasing, using a binary search.
+
+    """
+    def __init__(self, log_path, **kwargs):
+        super().__init__(**kwargs)
+
+        self._log_path = log_path
+
+        self._segment_rows = 1
+        self._columns = dict()
+        self._parts = dict()
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-reads the meta data and column files, e.g. to pick up rows written after the reader was created
+        """
+        meta = HistoryLogReader.read_meta(self._log_path) or {"segment_rows": 1, "columns": {}}
+
+        self._segment_rows = meta["segment_rows"]
+        self._columns = meta["columns"]
+        self._parts = dict()
+
+    def keys(self):
+        keys = list(self._columns.keys())
+        if 'time_stamp' in self._columns:
+            keys += [k for k in DERIVED_COLUMNS if k not in self._columns]
+
+        return keys
+
+    def first_row(self, key):
+        return self._columns[key]["first_row"]
+
+    def end_row(self, key):
+        """
+
+        :param key: column name
+        :return: row after the last row of the column
+        """
+        files = self._column_files(key)
+        if len(files) == 0:
+            return self.first_row(key)
+
+        _, part_first_row, count = files[-1]
+
+        return part_first_row + count
+
+    def num_rows(self):
+        if ROW_KEY not in self._columns:
+            return 0
+
+        return self.end_row(ROW_KEY)
+
+    def column(self, key):
+        """
+
+        :param key: column name
+        :return: numpy array with all values of the column
+        """
+        if (key in DERIVED_COLUMNS) and (key not in self._columns):
+            return np.array([_date_from_time_stamp(t) for t in self.column('time_stamp')])
+
+        return self.rows(key, 0, self.end_row(key))
+
+    def rows(self, key, start_row, stop_row):
+        """
+
+        :param key: column name
+        :param start_row: first row
+        :param stop_row: row after the last row
+        :return: numpy array with the column values for rows [start_row, stop_row),
+                 rows for which the column has no value are left out
+        """
+        if (key in DERIVED_COLUMNS) and (key not in self._columns):
+            return np.array([_date_from_time_stamp(t) for t in self.rows('time_stamp', start_row, stop_row)])
+
+        selected = []
+        for part_first_row, part in self._column_parts(key):
+            start = max(start_row - part_first_row, 0)
+            stop = min(stop_row - part_first_row, len(part))
+            if start < stop:
+                selected.append(part[start:stop])
+
+        if len(selected) == 0:
+            return np.zeros((0,), dtype=np.dtype(self._columns[key]["dtype"]))
+
+        return np.concatenate(selected)
+
+    def row(self, row):
+        """
+
+        :param row: row index, negative indices count from the end
+        :return: dict with the values of all columns for the given row
+        """
+        row = row + self.num_rows() if row < 0 else row
+
+        values = dict()
+        for key in self.keys():
+            value = self.rows(key, row, row + 1)
+            if len(value) > 0:
+                values[key] = value[0]
+
+        return values
+
+    def iter_rows(self, start_iter, stop_iter):
+        """
+
+        :param start_iter: first global iteration
+        :param stop_iter: global iteration after the last iteration
+        :return: (start_row, stop_row) for the rows with start_iter <= global_iter < stop_iter
+        """
+        return self._search(ROW_KEY, start_iter, 'left'), self._search(ROW_KEY, stop_iter, 'left')
+
+    def epoch_rows(self, epoch):
+        """
+
+        :param epoch:
+        :return: (start_row, stop_row) for the rows of the given epoch
+        """
+        return self._search('epoch', epoch, 'left'), self._search('epoch', epoch, 'right')
+
+    def query(self, key, start_iter, stop_iter):
+        """
+        E.g. query('loss', 1000000, 1200000) returns the loss for iterations 1M up to 1.2M
+
+        :param key: column name
+        :param start_iter: first global iteration
+        :param stop_iter: global iteration after the last iteration
+        :return: numpy array with the column values for start_iter <= global_iter < stop_iter
+        """
+        start_row, stop_row = self.iter_rows(start_iter, stop_iter)
+
+        return self.rows(key, start_row, stop_row)
+
+    def last_row(self, epoch=None):
+        """
+
+        :param epoch: if given, the last row of this epoch is returned
+        :return: dict with the values of the last row, None if there are no rows
+        """
+        if epoch is None:
+            stop_row = self.num_rows()
+        else:
+            start_row, stop_row = self.epoch_rows(epoch)
+            if stop_row <= start_row:
+                return None
+
+        if stop_row == 0:
+            return None
+
+        return self.row(stop_row - 1)
+
+    def to_dict(self):
+        """
+        Rebuilds the history dict, as kept by the BatchMetricHistory
+
+        :return: dict mapping column names to lists of values
+        """
+        return {key: list(self.column(key)) for key in self.keys()}
+
+    def _search(self, key, value, side):
+        """
+        Binary search in a non-decreasing column
+
+        :return: row index
+        """
+        parts = self._column_parts(key)
+
+        # Find the first part that can contain the value
+        lo, hi = 0, len(parts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            last_value = parts[mid][1][-1]
+            if (last_value < value) or ((side == 'right') and (last_value == value)):
+                lo = mid + 1
+            else:
+                hi = mid
+        part_idx = lo
+
+        if part_idx == len(parts):
+            return self.end_row(key) if len(parts) > 0 else 0
+
+        part_first_row, part = parts[part_idx]
+
+        return part_first_row + int(np.searchsorted(part, value, side=side))
+
+    def _column_parts(self, key):
+        if key not in self._parts:
+            dtype = np.dtype(self._columns[key]["dtype"])
+
+            self._parts[key] = [(part_first_row, np.memmap(fname, dtype=dtype, mode='r', shape=(count,)))
+                                for fname, part_first_row, count in self._column_files(key)
+                                if count > 0]
+
+        return self._parts[key]
+
+    def _column_files(self, key):
+        column = self._columns[key]
+        itemsize = np.dtype(column["dtype"]).itemsize
+
+        files = []
+        for segment in _segments(self._log_path):
+            fname = os.path.join(self._log_path, _segment_dir_name(segment), _column_file_name(column["id"]))
+            if not os.path.isfile(fname):
+                continue
+
+            part_first_row = max(column["first_row"], segment * self._segment_rows)
+
+            # Ignore a partially written value at the end of a file
+            files.append((fname, part_first_row, os.path.getsize(fname) // itemsize))
+
+        return files
+
+    @staticmethod
+    def read_meta(log_path):
+        fname = os.path.join(log_path, _META_FILE_NAME)
+        if not os.path.isfile(fname):
+            return None
+
+        with open(fname, 'r') as f:
+            return json.load(f)
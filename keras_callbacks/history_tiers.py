@@ -0,0 +1,298 @@
+import copy
+
+import numpy as np
+
+from basics.base import Base
+import basics.base_utils as _
+
+# Bookkeeping columns of the BatchMetricHistory, these are not downsampled
+_NON_METRIC_COLUMNS = ('epoch', 'global_iter', 'epoch_iter', 'time_stamp', 'date')
+
+_BUCKET_FIELDS = ('bucket', 'min', 'max', 'sum', 'count', 'num_non_finite', 'num_missing')
+
+
+def _reduce_buckets(buckets):
+    """
+    Merges entries with the same bucket index, bucket indices must be sorted
+
+    :param buckets: dict with arrays for all _BUCKET_FIELDS
+    :return: dict with merged buckets
+    """
+    if len(buckets['bucket']) == 0:
+        return buckets
+
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(buckets['bucket'])) + 1])
+
+    return {
+        'bucket': buckets['bucket'][starts],
+        # fmin and fmax ignore NaN values
+        'min': np.fmin.reduceat(buckets['min'], starts),
+        'max': np.fmax.reduceat(buckets['max'], starts),
+        'sum': np.add.reduceat(buckets['sum'], starts),
+        'count': np.add.reduceat(buckets['count'], starts),
+        'num_non_finite': np.add.reduceat(buckets['num_non_finite'], starts),
+        'num_missing': np.add.reduceat(buckets['num_missing'], starts)
+    }
+
+
+def _concat_buckets(a, b):
+    return {field: np.concatenate([a[field], b[field]]) for field in _BUCKET_FIELDS}
+
+
+def _slice_buckets(buckets, start, stop=None):
+    return {field: buckets[field][start:stop] for field in _BUCKET_FIELDS}
+
+
+class DownsamplingTier():
+    """
+
+    Summarises metric values in buckets of resolution iterations, with min, max, mean and count per bucket.
+    Infinite values are only counted (num_non_finite), they are not part of min, max and mean. NaN values are
+    counted as missing (num_missing), these are mostly the padding of metrics that are not evaluated every
+    iteration (see EvaluationScheduler).
+
+    Bucket arrays are never changed in place, adding values replaces them.
+
+    """
+    def __init__(self, resolution, max_buckets=None):
+        """
+
+        :param resolution: number of iterations per bucket
+        :param max_buckets: maximum number of buckets per metric, None for no maximum
+        """
+        self.resolution = resolution
+        self.max_buckets = max_buckets
+
+        self._buckets = dict()
+
+    def keys(self):
+        return self._buckets.keys()
+
+    def add_values(self, key, global_iters, values):
+        """
+        Adds raw values, in order of iteration
+
+        :param key: metric name
+        :param global_iters: iterations of the values
+        :param values: metric values
+        :return: buckets that overflow max_buckets, None if there are none
+        """
+        values = np.asarray(values, dtype='float64')
+        finite = np.isfinite(values)
+        missing = np.isnan(values)
+
+        return self.add_buckets(key, {
+            'bucket': np.asarray(global_iters, dtype='int64') // self.resolution,
+            'min': np.where(finite, values, np.nan),
+            'max': np.where(finite, values, np.nan),
+            'sum': np.where(finite, values, 0.),
+            'count': finite.astype('int64'),
+            'num_non_finite': (~(finite | missing)).astype('int64'),
+            'num_missing': missing.astype('int64')
+        })
+
+    def add_buckets(self, key, buckets, resolution=None):
+        """
+        Adds buckets, in order of iteration
+
+        :param key: metric name
+        :param buckets: buckets, e.g. the overflow of a tier with a finer resolution
+        :param resolution: resolution of the given buckets, if None the buckets are already at this resolution
+        :return: buckets that overflow max_buckets, None if there are none
+        """
+        if resolution is not None:
+            buckets = dict(buckets)
+            buckets['bucket'] = (buckets['bucket'] * resolution) // self.resolution
+
+        if key in self._buckets:
+            current = self._buckets[key]
+            num_current = len(current['bucket'])
+
+            # Only the last bucket can overlap the new buckets
+            buckets = _concat_buckets(_slice_buckets(current, num_current - 1), buckets)
+            buckets = _concat_buckets(_slice_buckets(current, 0, num_current - 1), _reduce_buckets(buckets))
+        else:
+            buckets = _reduce_buckets(buckets)
+
+        overflow = None
+        num_buckets = len(buckets['bucket'])
+        if (self.max_buckets is not None) and (num_buckets > self.max_buckets):
+            overflow = _slice_buckets(buckets, 0, num_buckets - self.max_buckets)
+            buckets = _slice_buckets(buckets, num_buckets - self.max_buckets)
+
+        self._buckets[key] = buckets
+
+        return overflow
+
+    def buckets(self, key):
+        """
+
+        :param key: metric name
+        :return: dict with arrays : start iteration of the buckets ('iter'), 'min', 'max', 'mean', 'count',
+                 'num_non_finite' and 'num_missing'
+        """
+        buckets = self._buckets[key]
+        count = buckets['count']
+
+        return {
+            'iter': buckets['bucket'] * self.resolution,
+            'min': buckets['min'],
+            'max': buckets['max'],
+            'mean': np.where(count > 0, buckets['sum'] / np.maximum(count, 1), np.nan),
+            'count': count,
+            'num_non_finite': buckets['num_non_finite'],
+            'num_missing': buckets['num_missing']
+        }
+
+
+class HistoryCompactor(Base):
+    """
+
+    Keeps the raw history for the most recent keep_raw_iters iterations, older values are moved in to downsampling
+    tiers of increasing resolution. When a tier holds more than its maximum number of buckets, the oldest buckets
+    are merged in to the next tier. Buckets overflowing the last tier are discarded.
+
+    """
+    def __init__(self, keep_raw_iters=100000, tiers=((100, 10000), (10000, None)), state=None, **kwargs):
+        """
+
+        :param keep_raw_iters: number of most recent iterations for which raw values are kept
+        :param tiers: list of (resolution, max_buckets) tuples, resolutions must be increasing and each resolution
+                      a multiple of the previous one
+        :param state: previously saved state, see state()
+        """
+        super().__init__(**kwargs)
+
+        self._keep_raw_iters = keep_raw_iters
+        self._tiers = [DownsamplingTier(resolution, max_buckets) for resolution, max_buckets in tiers]
+
+        self._check_settings()
+
+        self._set_state(state)
+
+    @property
+    def tiers(self):
+        return self._tiers
+
+    @property
+    def keep_raw_iters(self):
+        return self._keep_raw_iters
+
+    def compact(self, history, global_iter):
+        """
+        Moves the values of all iterations before global_iter - keep_raw_iters from the history in to the tiers
+
+        :param history: dict-like history of the BatchMetricHistory
+        :param global_iter: current global iteration
+        :return: dict with the number of values dropped per column
+        """
+        if 'global_iter' not in history:
+            return dict()
+
+        iters = np.asarray(history['global_iter'][:], dtype='int64')
+        num_rows = len(iters)
+        num_keep = num_rows - int(np.searchsorted(iters, global_iter - self._keep_raw_iters, side='left'))
+
+        dropped = dict()
+        for key in history.keys():
+            if key == 'date':
+                continue
+
+            num_values = len(history[key])
+            num_drop = num_values - num_keep
+            if num_drop <= 0:
+                continue
+
+            if key not in _NON_METRIC_COLUMNS:
+                values = np.asarray(history[key][:num_drop])
+                if values.dtype.kind in 'biuf':
+                    # Columns are contiguous up to the last row
+                    value_iters = iters[num_rows - num_values:num_rows - num_values + num_drop]
+                    self._add_values(key, value_iters, values)
+
+            dropped[key] = num_drop
+
+        for key, num_drop in dropped.items():
+            HistoryCompactor._drop_head(history[key], num_drop)
+
+        # The derived date column follows the time stamps
+        if ('date' in history) and isinstance(history['date'], list):
+            HistoryCompactor._drop_head(history['date'], len(history['date']) - len(history['time_stamp']))
+
+        return dropped
+
+    def buckets(self, key, tier=0):
+        """
+
+        :param key: metric name
+        :param tier: index of the tier
+        :return: buckets, see DownsamplingTier.buckets(), None if there are no buckets for the metric
+        """
+        if key not in self._tiers[tier].keys():
+            return None
+
+        return self._tiers[tier].buckets(key)
+
+    def state(self):
+        """
+
+        :return: state dict, to be used to resume compaction. The bucket arrays are shared with the tiers, they are
+                 never changed in place
+        """
+        return {
+            "keep_raw_iters": self._keep_raw_iters,
+            "tiers": [{
+                "resolution": tier.resolution,
+                "max_buckets": tier.max_buckets,
+                "buckets": {key: dict(buckets) for key, buckets in tier._buckets.items()}
+            } for tier in self._tiers]
+        }
+
+    def _add_values(self, key, global_iters, values):
+        overflow = self._tiers[0].add_values(key, global_iters, values)
+
+        for tier_idx in range(1, len(self._tiers)):
+            if overflow is None:
+                break
+
+            overflow = self._tiers[tier_idx].add_buckets(key, overflow, self._tiers[tier_idx - 1].resolution)
+
+    def _set_state(self, state):
+        if state is None:
+            return
+
+        try:
+            tiers = state["tiers"]
+            if [(t["resolution"], t["max_buckets"]) for t in tiers] != \
+               [(t.resolution, t.max_buckets) for t in self._tiers]:
+                self._log.error("Tiers of given compaction state differ from configured tiers, "
+                                "not using given state")
+                return
+
+            for tier, tier_state in zip(self._tiers, tiers):
+                tier._buckets = copy.deepcopy(tier_state["buckets"])
+
+                # States saved before NaN values were counted as missing
+                for buckets in tier._buckets.values():
+                    if 'num_missing' not in buckets:
+                        buckets['num_missing'] = np.zeros(len(buckets['bucket']), dtype='int64')
+        except Exception as e:
+            _.log_exception(self._log, "Unable to set compaction state", e)
+
+    def _check_settings(self):
+        for prev_tier, tier in zip(self._tiers[:-1], self._tiers[1:]):
+            if (tier.resolution <= prev_tier.resolution) or (tier.resolution % prev_tier.resolution != 0):
+                self._log.error("Tier resolutions must be increasing multiples of each other, "
+                                "only using tiers up to resolution %d" % prev_tier.resolution)
+                self._tiers = self._tiers[:self._tiers.index(tier)]
+                break
+
+    @staticmethod
+    def _drop_head(values, num_values):
+        if num_values <= 0:
+            return
+
+        if hasattr(values, 'drop_head'):
+            values.drop_head(num_values)
+        else:
+            del values[:num_values]
@@ -0,0 +1,141 @@
+import threading
+
+import numpy as np
+
+from basics.base import Base
+
+
+class IOStats(Base):
+    """
+
+    Thread safe accounting of file operations: number of operations, latency and bytes per operation type,
+    and the time the training thread was blocked.
+
+    """
+    def __init__(self, ops=(), prefix='checkpoint_', **kwargs):
+        """
+
+        :param ops: operation types that are reported from the start, such that metrics() always has the same keys
+        :param prefix: prefix of the metric names, see metrics()
+        """
+        super().__init__(**kwargs)
+
+        self._prefix = prefix
+        self._lock = threading.Lock()
+
+        self._ops = dict()
+        for op in ops:
+            self._ops[op] = self._new_op_stats()
+
+        self._bytes_written = 0
+        self._bytes_copied = 0
+
+        self._blocked_time = 0.
+        self._last_blocked_time = 0.
+        self._max_blocked_time = 0.
+        self._num_blocked = 0
+
+    def record(self, op, latency, bytes_written=0, bytes_copied=0):
+        """
+
+        :param op: operation type, e.g. 'save', 'copy', 'remove', 'state'
+        :param latency: duration of the operation in seconds
+        :param bytes_written:
+        :param bytes_copied:
+        """
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = self._new_op_stats()
+
+            stats["count"] += 1
+            stats["total_latency"] += latency
+            stats["last_latency"] = latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            stats["bytes"] += bytes_written + bytes_copied
+
+            self._bytes_written += bytes_written
+            self._bytes_copied += bytes_copied
+
+    def record_blocked(self, blocked_time):
+        """
+
+        :param blocked_time: time, in seconds, the training thread was blocked by a callback
+        """
+        with self._lock:
+            self._blocked_time += blocked_time
+            self._last_blocked_time = blocked_time
+            self._max_blocked_time = max(self._max_blocked_time, blocked_time)
+            self._num_blocked += 1
+
+    def metrics(self):
+        """
+
+        :return: dict with metrics to add to the Keras logs:
+                 <prefix>blocked_time : time the last callback blocked training
+                 <prefix>total_blocked_time
+                 <prefix>bytes_written, <prefix>bytes_copied : totals
+                 <prefix><op>_latency : latency of the last operation of every type
+        """
+        with self._lock:
+            metrics = {
+                self._prefix + "blocked_time": np.float64(self._last_blocked_time),
+                self._prefix + "total_blocked_time": np.float64(self._blocked_time),
+                self._prefix + "bytes_written": np.float64(self._bytes_written),
+                self._prefix + "bytes_copied": np.float64(self._bytes_copied)
+            }
+
+            for op, stats in self._ops.items():
+                metrics["%s%s_latency" % (self._prefix, op)] = np.float64(stats["last_latency"])
+
+        return metrics
+
+    def summary(self):
+        """
+
+        :return: dict with the totals and, per operation type, the count, total, mean and max latency and bytes
+        """
+        with self._lock:
+            ops = dict()
+            for op, stats in self._ops.items():
+                if stats["count"] == 0:
+                    continue
+
+                ops[op] = {
+                    "count": stats["count"],
+                    "total_latency": stats["total_latency"],
+                    "mean_latency": stats["total_latency"] / stats["count"],
+                    "max_latency": stats["max_latency"],
+                    "bytes": stats["bytes"]
+                }
+
+            return {
+                "ops": ops,
+                "bytes_written": self._bytes_written,
+                "bytes_copied": self._bytes_copied,
+                "blocked_time": self._blocked_time,
+                "max_blocked_time": self._max_blocked_time,
+                "num_blocked": self._num_blocked
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+
+        self._log.info("Blocked training for %.3fs in total (max. %.3fs), %d bytes written, %d bytes copied" %
+                       (summary["blocked_time"], summary["max_blocked_time"],
+                        summary["bytes_written"], summary["bytes_copied"]))
+
+        for op, stats in sorted(summary["ops"].items()):
+            self._log.info("%s : %d ops, total %.3fs, mean %.4fs, max %.4fs, %d bytes" %
+                           (op, stats["count"], stats["total_latency"], stats["mean_latency"],
+                            stats["max_latency"], stats["bytes"]))
+
+    @staticmethod
+    def _new_op_stats():
+        return {
+            "count": 0,
+            "total_latency": 0.,
+            "last_latency": 0.,
+            "max_latency": 0.,
+            "bytes": 0
+        }
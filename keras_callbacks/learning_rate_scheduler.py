@@ -11,7 +11,14 @@ class LearningRateState():
 
 
 class LearningRateScheduler(Base, Callback):
-    def __init__(self, session, init_iter = -1, log_period=2000, **kwargs):
+    def __init__(self, session, init_iter = -1, log_period=2000, lr_scale=1., **kwargs):
+        """
+
+        :param session:
+        :param init_iter:
+        :param log_period:
+        :param lr_scale: factor applied to the scheduled learning rate, see scale_lr()
+        """
         super().__init__(**kwargs)
 
         self._sess = session
@@ -20,9 +27,24 @@ class LearningRateScheduler(Base, Callback):
 
         self._log_period = log_period
 
+        self._lr_scale = lr_scale
+
         self._optimizer = None
         self._lr_state = None
 
+    @property
+    def lr_scale(self):
+        return self._lr_scale
+
+    def scale_lr(self, factor):
+        """
+        Scales the scheduled learning rate from the next iteration on, e.g. after recovering from a divergence
+
+        :param factor: factor to multiply the current learning rate scale with
+        """
+        self._lr_scale *= factor
+        self._log.info('Iter. : %d, learning rate scale : %0.3e' % (self._iter, self._lr_scale))
+
     def set_model(self, model):
         super().set_model(model)
 
@@ -40,9 +62,11 @@ class LearningRateScheduler(Base, Callback):
 
         self._lr_state = self._update_lr_state(self._lr_state)
 
-        self._optimizer.lr.load(self._lr_state.lr, self._sess)
+        lr = self._lr_state.lr * self._lr_scale
+
+        self._optimizer.lr.load(lr, self._sess)
 
-        logs['learning_rate'] = np.float32(self._lr_state.lr)
+        logs['learning_rate'] = np.float32(lr)
 
         if (self._log_period >= 0) and (self._iter % self._log_period == 0):
             self._log.info('Iter. : %d, learning rate : %0.3e' % (self._iter, self._optimizer.lr.eval(self._sess)))
@@ -0,0 +1,190 @@
+import itertools
+
+import numpy as np
+
+from basics.base import Base
+
+
+class MetricSubscription(object):
+    """
+
+    Set of metric slots of a MetricBus, with the metrics whose name matches a predicate. The slots are resolved once,
+    when a metric is registered at the bus.
+
+    """
+    def __init__(self, bus, predicate):
+        self._bus = bus
+        self._predicate = predicate
+
+        self.names = []
+        self.slots = np.zeros(0, dtype=np.int64)
+
+    def updated(self):
+        """
+
+        :return: names, float64 values of the subscribed metrics written in the current iteration
+        """
+        bus = self._bus
+        indices = np.nonzero(bus.updated_steps(self.slots) == bus.step)[0]
+
+        return [self.names[i] for i in indices], bus.values(self.slots[indices])
+
+    def not_updated(self):
+        """
+
+        :return: names of the subscribed metrics not written in the current iteration
+        """
+        bus = self._bus
+        indices = np.nonzero(bus.updated_steps(self.slots) != bus.step)[0]
+
+        return [self.names[i] for i in indices]
+
+    def _registered(self, name, slot):
+        if self._predicate(name):
+            self.names.append(name)
+            self.slots = np.append(self.slots, slot)
+
+
+class MetricBus(Base):
+    """
+
+    Shared registry of the metric values of the current training iteration, to be used by multiple callbacks
+    instead of each callback scanning the Keras logs dict.
+
+    Metric names are resolved once to integer slots. The values are stored in one preallocated float64 array, with
+    the iteration at which every slot was last written. Callbacks subscribe to the metrics they need, with a
+    predicate on the metric name, and get the slots of the metrics updated in the current iteration at once.
+
+    Callbacks call sync(batch, logs) at the start of on_batch_end. A new logs dict (or batch) starts a new iteration,
+    for the same logs dict only the keys added since the previous sync are read, using the insertion order of dicts.
+    Values of existing keys that are overwritten later in the same iteration are not seen, callbacks that do so
+    should also call update(). Values that can not be converted to float are ignored.
+
+    """
+    def __init__(self, capacity=256, **kwargs):
+        """
+
+        :param capacity: initial number of slots, grows when needed
+        """
+        super().__init__(**kwargs)
+
+        self._slots = dict()
+        self._names = []
+
+        self._values = np.full(capacity, np.nan, dtype=np.float64)
+        self._updated = np.full(capacity, -1, dtype=np.int64)
+
+        self._subscriptions = []
+
+        self._step = -1
+        self._logs = None
+        self._batch = None
+        self._num_synced = 0
+
+    @property
+    def step(self):
+        return self._step
+
+    def sync(self, batch, logs):
+        """
+        Reads the values in the logs, that were not read yet in this iteration
+
+        :param batch: batch index, as given to on_batch_end
+        :param logs: Keras logs dict
+        """
+        if logs is None:
+            return
+
+        if (logs is not self._logs) or (batch != self._batch):
+            # Keep a reference to the logs, such that a new logs dict can't have the same identity
+            self._logs = logs
+            self._batch = batch
+            self._num_synced = 0
+            self._step += 1
+
+        if len(logs) == self._num_synced:
+            return
+
+        self.update(itertools.islice(logs.items(), self._num_synced, None))
+        self._num_synced = len(logs)
+
+    def update(self, metrics):
+        """
+
+        :param metrics: dict, or iterable of (name, value) tuples, written in the current iteration
+        """
+        items = metrics.items() if isinstance(metrics, dict) else metrics
+
+        for name, value in items:
+            slot = self._slots.get(name)
+            if slot is None:
+                slot = self.slot(name)
+
+            try:
+                self._values[slot] = value
+            except (TypeError, ValueError):
+                continue
+
+            self._updated[slot] = self._step
+
+    def slot(self, name):
+        """
+
+        :param name: metric name
+        :return: slot of the metric, the metric is registered if it is new
+        """
+        slot = self._slots.get(name)
+        if slot is not None:
+            return slot
+
+        slot = len(self._names)
+        if slot == len(self._values):
+            self._values = np.append(self._values, np.full(len(self._values), np.nan))
+            self._updated = np.append(self._updated, np.full(len(self._updated), -1, dtype=np.int64))
+
+        self._slots[name] = slot
+        self._names.append(name)
+
+        for subscription in self._subscriptions:
+            subscription._registered(name, slot)
+
+        return slot
+
+    def subscribe(self, predicate):
+        """
+
+        :param predicate: function metric name -> bool
+        :return: MetricSubscription with the (current and future) metrics that match the predicate
+        """
+        subscription = MetricSubscription(self, predicate)
+        for slot, name in enumerate(self._names):
+            subscription._registered(name, slot)
+
+        self._subscriptions.append(subscription)
+
+        return subscription
+
+    def value(self, slot):
+        return self._values[slot]
+
+    def values(self, slots):
+        return self._values[slots]
+
+    def is_updated(self, slot):
+        """
+
+        :return: True if the slot was written in the current iteration
+        """
+        return self._updated[slot] == self._step
+
+    def updated_steps(self, slots):
+        return self._updated[slots]
+
+    def to_dict(self):
+        """
+
+        :return: dict with the metrics written in the current iteration
+        """
+        indices = np.nonzero(self._updated[:len(self._names)] == self._step)[0]
+
+        return {self._names[i]: self._values[i] for i in indices}
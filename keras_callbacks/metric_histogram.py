@@ -0,0 +1,90 @@
+import math
+
+import numpy as np
+
+from basics.base import Base
+
+
+class MetricHistogram(Base):
+    """
+
+    Histogram with fixed bins between low and high, linearly or logarithmically spaced, plus an underflow and an
+    overflow bin. Adding a value is O(1). Non-finite values are counted separately.
+
+    """
+    def __init__(self, low, high, num_bins=100, log_scale=False, **kwargs):
+        """
+
+        :param low: lower bound of the first bin
+        :param high: upper bound of the last bin
+        :param num_bins: number of bins between low and high
+        :param log_scale: If True, the bins are logarithmically spaced (low must be > 0)
+        """
+        super().__init__(**kwargs)
+
+        if log_scale and low <= 0:
+            raise ValueError("Logarithmic histogram requires low > 0")
+
+        self._low = low
+        self._high = high
+        self._num_bins = num_bins
+        self._log_scale = log_scale
+
+        self._scaled_low = math.log(low) if log_scale else low
+        self._bin_width = ((math.log(high) if log_scale else high) - self._scaled_low) / num_bins
+
+        # counts[0] : underflow, counts[-1] : overflow
+        self._counts = np.zeros(num_bins + 2, dtype=np.int64)
+        self._num_non_finite = 0
+
+    def add(self, value):
+        value = float(value)
+        if not math.isfinite(value):
+            self._num_non_finite += 1
+            return
+
+        if value < self._low:
+            self._counts[0] += 1
+        elif value >= self._high:
+            self._counts[-1] += 1
+        else:
+            scaled = math.log(value) if self._log_scale else value
+            self._counts[1 + min(int((scaled - self._scaled_low) / self._bin_width), self._num_bins - 1)] += 1
+
+    def bin_edges(self):
+        if self._log_scale:
+            return np.geomspace(self._low, self._high, self._num_bins + 1)
+
+        return np.linspace(self._low, self._high, self._num_bins + 1)
+
+    def counts(self):
+        """
+
+        :return: counts of the bins between low and high, underflow count, overflow count
+        """
+        return self._counts[1:-1].copy(), int(self._counts[0]), int(self._counts[-1])
+
+    def get_state(self):
+        """
+
+        :return: dict with the state of the histogram, with plain Python values (e.g. to save as JSON)
+        """
+        return {
+            "low": self._low,
+            "high": self._high,
+            "num_bins": self._num_bins,
+            "log_scale": self._log_scale,
+            "counts": self._counts.tolist(),
+            "num_non_finite": self._num_non_finite
+        }
+
+    def set_state(self, state):
+        self._counts = np.array(state["counts"], dtype=np.int64)
+        self._num_non_finite = state["num_non_finite"]
+
+    @staticmethod
+    def from_state(state):
+        histogram = MetricHistogram(state["low"], state["high"], state["num_bins"], state["log_scale"])
+        histogram.set_state(state)
+
+        return histogram
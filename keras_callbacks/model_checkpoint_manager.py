@@ -10,6 +10,15 @@ from keras.callbacks import Callback
 from basics.base import Base
 import basics.base_utils as _
 
+from keras_callbacks.background_worker import BackgroundWorker
+from keras_callbacks.weight_snapshot import WeightSnapshot
+from keras_callbacks.checkpoint_store import CheckpointStore
+from keras_callbacks.weight_snapshot_cache import WeightSnapshotCache
+from keras_callbacks.model_registry import ModelRegistry
+from keras_callbacks.checkpoint_journal import CheckpointJournal
+from keras_callbacks.io_stats import IOStats
+from keras_callbacks.sharded_weights import ShardedWeights
+
 
 class ModelCheckpointManager(Base, Callback):
 
@@ -27,6 +36,19 @@ class ModelCheckpointManager(Base, Callback):
                  simulation_mode=False,
                  debug_mode=False,
                  checkpoint_state=None,
+                 async_checkpoints=False,
+                 checkpoint_queue_size=8,
+                 link_checkpoints=False,
+                 snapshot_cache_bytes=0,
+                 journal_checkpoint_state=False,
+                 journal_compact_every=1000,
+                 archive_codec=None,
+                 instrument_io=False,
+                 worker_rank=0,
+                 num_workers=1,
+                 shard_weights=False,
+                 shard_timeout=600.,
+                 metric_bus=None,
                  **kwargs):
         """
 
@@ -35,7 +57,8 @@ class ModelCheckpointManager(Base, Callback):
         :param base_filename:
         :param metric_to_monitor:
         :param metric_opt_mode: 'max', 'min'
-        :param metric_monitor_period:
+        :param metric_monitor_period: If the metric to monitor is not available at a monitor iteration (e.g. because
+                                      evaluation was skipped), it is monitored at the next iteration it is available
         :param early_good_model_delta: earliest model that is within this percentage of current best model
         :param create_checkpoint_every: period in number of batch-wise training iterations before saving next checkpoint
                                         (will be overridden after each period)
@@ -47,6 +70,50 @@ class ModelCheckpointManager(Base, Callback):
                                 Only logs are generated to simulate the management function.
         :param debug_mode: Set to true to log all actions
         :param checkpoint_state Dict with saved checkpoint state to continue tracking latest and earliest good model
+        :param async_checkpoints: Set to true to write checkpoints on a background thread. The training thread only
+                                  takes an in-memory snapshot of the weights, all file operations (saving, copying,
+                                  removing and saving the checkpoint state) are executed on the background thread, in
+                                  order. Pending operations are flushed at the end of every epoch and of training.
+        :param checkpoint_queue_size: Maximum number of pending file operations when async_checkpoints=True
+        :param link_checkpoints: Set to true to store every weight file once, in a content-addressed CheckpointStore
+                                 (in the checkpoint-store sub-directory of model_path). All model files (latest,
+                                 best-latest, earliest-good, archived iterations, temp. models) are then hard links
+                                 (or reflinks, or copies if the file system supports neither) to the stored weights.
+                                 Copying a model only creates a link, a weight file is removed with its last link.
+        :param snapshot_cache_bytes: If > 0, improved models are kept as in-memory weight snapshots, up to this number
+                                     of bytes, instead of being written to a temp. file. Only the best-latest and
+                                     earliest-good model files are written from the snapshots. When the budget is
+                                     exceeded, the snapshots of the worst models are written to their temp. file.
+                                     All cached snapshots are written at the end of every epoch and of training,
+                                     such that the saved checkpoint state only refers to existing files.
+        :param journal_checkpoint_state: Set to true to append the changes of the checkpoint state to a journal
+                                         (-checkpoint.journal file), instead of backing up and re-writing the complete
+                                         state on every change. Use load_checkpoint_state() to read the state back.
+        :param journal_compact_every: Number of journal records after which the complete state is written to the
+                                      state file and the journal is truncated
+        :param archive_codec: Optional CheckpointCodec. If given, archived checkpoints are not copies of the latest
+                              checkpoint, but are encoded with the codec (deltas against a keyframe archive, reduced
+                              precision and/or compression), see archived_model_file_name().
+                              Use CheckpointCodec.decode(fname).apply_to(model) to load an encoded archive.
+        :param instrument_io: Set to true to measure the checkpoint file operations (see IOStats). The latency of
+                              the last operation of every type, the bytes written and copied and the time training was
+                              blocked by this callback are added to the logs, as checkpoint_* metrics, after every
+                              batch. Place this callback before the callbacks that should record these metrics
+                              (e.g. BatchMetricHistory, TensorBoard). A summary is logged at the end of training.
+        :param worker_rank: Rank of this process in data-parallel training, with one ModelCheckpointManager per
+                            process and a shared model_path. Only the coordinator (rank 0) tracks the models, writes
+                            weight files and the checkpoint state, the other workers write nothing unless
+                            shard_weights=True. Give all workers the same checkpoint_state when resuming.
+        :param num_workers: Number of processes in data-parallel training
+        :param shard_weights: Set to true (with num_workers > 1 and async_checkpoints=True) to split writing the
+                              regular checkpoints over the workers. Every worker writes the weights of its share of
+                              the layers to a shard file (in the shards sub-directory of model_path), the coordinator
+                              waits for all shards, on the background thread, and writes a manifest as weight file,
+                              see ShardedWeights.
+                              Use ShardedWeights.load(fname).apply_to(model) to load a (sharded) weight file.
+        :param shard_timeout: Maximum time, in seconds, the coordinator waits for the shards of the other workers,
+                              on time out it writes the complete weights itself.
+        :param metric_bus: MetricBus to read the metric to monitor from, its slot is resolved once
         """
 
         super().__init__(**kwargs)
@@ -64,8 +131,52 @@ class ModelCheckpointManager(Base, Callback):
         self._simulation_mode = simulation_mode
         self._debug_mode = debug_mode
 
-        self._model_quality = dict()
-        self._model_iter = dict()
+        self._worker_rank = worker_rank
+        self._num_workers = num_workers
+        self._is_coordinator = (worker_rank == 0)
+
+        self._shards = None
+        self._shard_timeout = shard_timeout
+        self._timed_out_shard_iters = []
+        if shard_weights and (num_workers > 1) and not simulation_mode:
+            if async_checkpoints:
+                self._shards = ShardedWeights(os.path.join(model_path, 'shards'), worker_rank, num_workers)
+            else:
+                # The coordinator may only wait for the shards of the other workers on the background thread
+                self._log.error("shard_weights requires async_checkpoints, disabling sharding weights ...")
+
+        if self._shards is not None and link_checkpoints:
+            self._log.error("link_checkpoints can't be used with shard_weights, disabling linking checkpoints ...")
+            link_checkpoints = False
+
+        self._io_worker = BackgroundWorker(checkpoint_queue_size, name="checkpoint-writer") \
+            if async_checkpoints and not simulation_mode else None
+
+        self._snapshot = None
+        self._snapshot_iter = None
+
+        self._link_checkpoints = link_checkpoints and not simulation_mode and self._is_coordinator
+        self._store = None
+
+        self._snapshot_cache = None
+        if (snapshot_cache_bytes > 0) and not simulation_mode and self._is_coordinator:
+            self._snapshot_cache = WeightSnapshotCache(snapshot_cache_bytes, metric_opt_mode)
+
+        self._journal = None
+        self._journal_records = []
+        self._num_journal_records = 0
+        self._journal_compact_every = journal_compact_every
+        if journal_checkpoint_state and not simulation_mode and self._is_coordinator:
+            self._journal = CheckpointJournal(self.checkpoint_state_file_name(), self.checkpoint_journal_file_name())
+
+        self._archive_codec = archive_codec
+
+        self._io_stats = None
+        if instrument_io:
+            self._io_stats = IOStats(ops=('save', 'copy', 'remove', 'state') +
+                                         (('encode',) if archive_codec is not None else ()))
+
+        self._registry = ModelRegistry(self._metric_opt_mode, journal=self._add_journal_record)
         self._best_model = None
         self._best_model_quality = float('Inf') if self._metric_opt_mode == 'min' else -float('Inf')
 
@@ -73,37 +184,81 @@ class ModelCheckpointManager(Base, Callback):
         self._earliest_good_model_iter = None
 
         self._iter = -1
+        self._monitor_pending = False
+
+        self._metric_bus = metric_bus
+        self._monitor_slot = metric_bus.slot(metric_to_monitor) if metric_bus is not None else None
 
         self._log.info("Metric monitor period : %d" % self._metric_monitor_period)
         self._log.info("Archive last checkpoint every %d iterations" % self._archive_last_checkpoint_every)
 
-        self._setup_temp_model_path()
+        if self._is_coordinator:
+            self._setup_temp_model_path()
+
+            if self._shards is not None:
+                self._shards.find_manifests(self._manifest_paths())
+
+        if self._link_checkpoints:
+            self._setup_checkpoint_store()
 
         self._check_settings()
 
         self._set_state(checkpoint_state)
 
+        if self._journal is not None:
+            # Start the journal from the initial state
+            self._run_io(self._compact_journal, self._checkpoint_state())
+
     def on_batch_end(self, batch, logs=None):
+        if self._io_stats is None:
+            self._on_batch_end(batch, logs)
+            return
+
+        start = time.time()
+        self._on_batch_end(batch, logs)
+        self._io_stats.record_blocked(time.time() - start)
+
+        if logs is not None:
+            logs.update(self._io_stats.metrics())
+
+    def _on_batch_end(self, batch, logs=None):
         self._iter += 1
 
+        # Release the weight snapshot of the previous iteration
+        self._snapshot = None
+
         if self._iter == 0:
             return
 
+        if not self._is_coordinator:
+            # Workers only write their shard of the regular checkpoints
+            if (self._create_checkpoint_every > 0) and (self._iter % self._create_checkpoint_every == 0):
+                self._save_checkpoint()
+
+            return
+
         checkpoint_fname = None
         if (self._create_checkpoint_every > 0) and (self._iter % self._create_checkpoint_every == 0):
             checkpoint_fname = self._save_checkpoint()
 
         if (self._archive_last_checkpoint_every > 0) and (self._iter % self._archive_last_checkpoint_every == 0):
-            self._copy(self.latest_model_file_name(), self.current_model_file_name())
+            self._archive_checkpoint()
 
-        if (self._metric_monitor_period > 0) and (self._iter % self._metric_monitor_period != 0):
+        is_monitor_iter = (self._metric_monitor_period <= 0) or (self._iter % self._metric_monitor_period == 0)
+        if not (is_monitor_iter or self._monitor_pending):
             return
 
-        if self._metric_to_monitor not in logs:
-            self._log.info("Metric to monitor [%s] not found, unable to create model checkpoints" % self._metric_to_monitor)
+        model_quality = self._monitored_metric(batch, logs)
+        if model_quality is None:
+            if is_monitor_iter and (self._simulation_mode or self._debug_mode):
+                self._log.debug("Metric to monitor [%s] not available, monitoring at the next iteration it is "
+                                "available" % self._metric_to_monitor)
+
+            # The metric is not evaluated every iteration, monitor at the next iteration it is available
+            self._monitor_pending = True
             return
 
-        model_quality = logs[self._metric_to_monitor].item()
+        self._monitor_pending = False
 
         model_improved = ((self._metric_opt_mode == 'min') and (model_quality < self._best_model_quality)) or \
                          ((self._metric_opt_mode == 'max') and (model_quality > self._best_model_quality))
@@ -114,12 +269,11 @@ class ModelCheckpointManager(Base, Callback):
                                                                             self._metric_to_monitor,
                                                                             model_quality))
 
-            model_fname = self._save_current_model_as_temp(checkpoint_fname)
+            model_fname = self._save_current_model_as_temp(checkpoint_fname, model_quality)
             if model_fname:
                 self._best_model = model_fname
                 self._best_model_quality = model_quality
-                self._model_quality[model_fname] = model_quality
-                self._model_iter[model_fname] = self._iter
+                self._registry.add(model_fname, model_quality, self._iter)
 
                 self._copy(model_fname, self.latest_best_model_file_name())
 
@@ -146,18 +300,72 @@ class ModelCheckpointManager(Base, Callback):
                 self._log.error("Unable to save improved model to temp. file, "
                                 "model not incorporated in analysis and no checkpoint created.")
 
+    def _monitored_metric(self, batch, logs):
+        """
+
+        :return: value of the metric to monitor in this iteration, None if not available
+        """
+        if self._metric_bus is not None:
+            self._metric_bus.sync(batch, logs)
+            if not self._metric_bus.is_updated(self._monitor_slot):
+                return None
+
+            return float(self._metric_bus.value(self._monitor_slot))
+
+        if self._metric_to_monitor not in logs:
+            return None
+
+        return logs[self._metric_to_monitor].item()
+
     def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+
         self._save_checkpoint()
+        self._spill_snapshot_cache()
+        self.flush()
+
+        if self._io_stats is not None:
+            self._io_stats.record_blocked(time.time() - start)
+
+    def on_train_end(self, logs=None):
+        start = time.time()
+
+        self._spill_snapshot_cache()
+        self.flush()
+
+        if self._io_stats is not None:
+            self._io_stats.record_blocked(time.time() - start)
+            self._io_stats.log_summary()
+
+    def io_stats(self):
+        """
+
+        :return: summary of the checkpoint file operations (see IOStats.summary()), None if instrument_io=False
+        """
+        return self._io_stats.summary() if self._io_stats is not None else None
+
+    def flush(self):
+        """
+        Blocks until all pending checkpoint file operations are executed (only relevant when async_checkpoints=True)
+        """
+        if self._io_worker is None:
+            return
+
+        if self._simulation_mode or self._debug_mode:
+            self._log.debug("Waiting for pending checkpoint file operations ...")
+
+        self._io_worker.flush()
+        self._snapshot = None
+        self._snapshot_iter = None
 
     def reset(self):
         if self._simulation_mode or self._debug_mode:
             self._log.debug("Resetting ...")
 
-        for fname in self._model_quality.keys():
+        for fname in self._registry:
             self._remove_model(fname)
 
-        self._model_quality = dict()
-        self._model_iter = dict()
+        self._registry.clear()
         self._best_model = None
         self._best_model_quality = float('Inf') if self._metric_opt_mode == 'min' else -float('Inf')
 
@@ -167,9 +375,30 @@ class ModelCheckpointManager(Base, Callback):
     def checkpoint_state_file_name(self):
         return os.path.join(self._model_path, '%s-checkpoint.state' % self._base_filename)
 
+    def checkpoint_journal_file_name(self):
+        return os.path.join(self._model_path, '%s-checkpoint.journal' % self._base_filename)
+
+    @staticmethod
+    def load_checkpoint_state(model_path, base_filename):
+        """
+        Loads the checkpoint state, from the state file and, if available, the checkpoint journal
+
+        :param model_path:
+        :param base_filename:
+        :return: checkpoint state dict, to be used as checkpoint_state argument, None if not available
+        """
+        return CheckpointJournal.load(os.path.join(model_path, '%s-checkpoint.state' % base_filename),
+                                      os.path.join(model_path, '%s-checkpoint.journal' % base_filename))
+
     def current_model_file_name(self):
         return os.path.join(self._model_path, '%s-%s.model' % (self._base_filename, str(self._iter)))
 
+    def archived_model_file_name(self):
+        if self._archive_codec is None:
+            return self.current_model_file_name()
+
+        return os.path.join(self._model_path, '%s-%s.model.codec' % (self._base_filename, str(self._iter)))
+
     def latest_model_file_name(self):
         return os.path.join(self._model_path, '%s-latest.model' % self._base_filename)
 
@@ -187,6 +416,13 @@ class ModelCheckpointManager(Base, Callback):
         except Exception as e:
             _.log_exception(self._log, "Unable to use temp. model path: %s" % self._temp_model_path, e)
 
+    def _setup_checkpoint_store(self):
+        store_path = os.path.join(self._model_path, 'checkpoint-store')
+        try:
+            self._store = CheckpointStore(store_path)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to use checkpoint store path: %s" % store_path, e)
+
     def _set_state(self, checkpoint_state):
         if not _.is_dict(checkpoint_state):
             if self._simulation_mode or self._debug_mode:
@@ -196,14 +432,29 @@ class ModelCheckpointManager(Base, Callback):
         if self._simulation_mode or self._debug_mode:
             self._log.debug("Using given initial checkpoint state: \n\n%s" % json.dumps(checkpoint_state, indent=4))
 
+        if not self._is_coordinator:
+            # Workers only need to know the iteration, to write shards of the same checkpoints as the coordinator
+            self._iter = checkpoint_state.get('iter', self._iter)
+            return
+
         try:
-            self._model_quality = checkpoint_state['model_quality']
-            self._model_iter = checkpoint_state['model_iter']
+            model_quality = checkpoint_state['model_quality']
+            model_iter = checkpoint_state['model_iter']
             self._best_model = checkpoint_state['best_model']
             self._best_model_quality = checkpoint_state['best_model_quality']
             self._earliest_good_model = checkpoint_state['earliest_good_model']
             self._earliest_good_model_iter = checkpoint_state['earliest_good_model_iter']
             self._iter = checkpoint_state['iter']
+
+            # Models that were only cached in memory when the state was saved, can't be used
+            for fname in list(model_quality.keys()):
+                if (fname != self._best_model) and not os.path.isfile(fname):
+                    self._log.warning("Model file [%s] does not exist, removing model from checkpoint state" % fname)
+                    model_quality.pop(fname)
+                    model_iter.pop(fname)
+
+            self._registry = ModelRegistry(self._metric_opt_mode, model_quality, model_iter,
+                                           journal=self._add_journal_record)
         except Exception as e:
             _.log_exception(self._log, "Unable to set checkpoint state", e)
 
@@ -217,66 +468,24 @@ class ModelCheckpointManager(Base, Callback):
             good_model_boundary = self._best_model_quality*(1 - (self._early_good_model_delta/100))
         else:
             self._log.error("Unknown metric optimization mode : [%s]. Unable to prune models" % self._metric_opt_mode)
-            return None
+            return None, None
 
         if self._simulation_mode or self._debug_mode:
             self._log.debug("Good model boundary : %3e " % good_model_boundary)
 
-        earliest_good_model_new = None
-        earliest_good_model_iter_new = None
-
-        model_quality_new = self._model_quality.copy()
-        model_iter_new = self._model_iter.copy()
-
-        def __pop(model_name):
-            self._log.debug("Removing model : %s" % model_name)
-
-            model_quality_new.pop(model_name)
-            model_iter_new.pop(model_name)
-            self._remove_model(model_name)
-
-        for fname, q in self._model_quality.items():
+        for fname in self._registry.not_better_than(good_model_boundary):
             if fname == self._best_model:
                 # always keep the best model
                 continue
 
-            if self._simulation_mode or self._debug_mode:
-                self._log.debug("Analyzing model : %s " % fname)
-                self._log.debug("Model quality : %3e " % q)
-
-            model_is_good = ((self._metric_opt_mode == 'min') and (q < good_model_boundary)) or \
-                            ((self._metric_opt_mode == 'max') and (q > good_model_boundary))
+            self._log.debug("Removing model : %s" % fname)
 
-            new_earliest_good_model = False
-            if model_is_good:
-                if self._simulation_mode or self._debug_mode:
-                    self._log.debug("Model is good.")
-
-                if earliest_good_model_new is None:
-                    earliest_good_model_new = fname
-                    earliest_good_model_iter_new = self._model_iter[fname]
-
-                    new_earliest_good_model = True
-                else:
-                    model_iter = self._model_iter[fname]
-                    if model_iter < earliest_good_model_iter_new:
-                        if self._simulation_mode or self._debug_mode:
-                            self._log.debug("Model is earliest, remove previous earliest model")
-
-                        earliest_good_model_new = fname
-                        earliest_good_model_iter_new = model_iter
-
-                        new_earliest_good_model = True
-                    else:
-                        if self._simulation_mode or self._debug_mode:
-                            self._log.debug("Model is not earliest")
-
-                if new_earliest_good_model and (self._simulation_mode or self._debug_mode):
-                    self._log.debug("New earliest good model : %s" % earliest_good_model_new)
-                    self._log.debug("New earliest good model iter : %s" % earliest_good_model_iter_new)
+            self._registry.remove(fname)
+            self._remove_model(fname)
 
-            else:
-                __pop(fname)
+        # All remaining models are good
+        earliest_good_model_new = self._registry.earliest(exclude=self._best_model)
+        earliest_good_model_iter_new = None
 
         if earliest_good_model_new is None:
             earliest_good_fname = self.earliest_good_model_file_name()
@@ -284,56 +493,118 @@ class ModelCheckpointManager(Base, Callback):
                 self._log.debug("No earliest good model found, removing ...")
 
             self._remove_model(earliest_good_fname)
-
-        self._model_quality = model_quality_new
-        self._model_iter = model_iter_new
+        else:
+            earliest_good_model_iter_new = self._registry.iteration(earliest_good_model_new)
 
         if self._simulation_mode or self._debug_mode:
             self._log.debug("Models registered:")
-            for fname, q in self._model_quality.items():
+            for fname in self._registry:
                 self._log.debug("%s: %d: %3e" % (fname,
-                                                 self._model_iter[fname],
-                                                 q))
+                                                 self._registry.iteration(fname),
+                                                 self._registry.quality(fname)))
 
         return earliest_good_model_new, earliest_good_model_iter_new
 
+    def _checkpoint_state(self):
+        return {
+            "model_quality": self._registry.model_quality(),
+            "model_iter": self._registry.model_iter(),
+            "best_model": self._best_model,
+            "best_model_quality": self._best_model_quality,
+            "earliest_good_model": self._earliest_good_model,
+            "earliest_good_model_iter": self._earliest_good_model_iter,
+            "iter": self._iter
+        }
+
     def _save_checkpoint_state(self):
+        if self._simulation_mode or self._debug_mode:
+            self._log.debug("Saving checkpoint state to [%s]" % self.checkpoint_state_file_name())
+
+        if self._simulation_mode:
+            return
+
+        if self._journal is not None:
+            self._save_checkpoint_journal()
+            return
+
+        self._run_io(self._write_checkpoint_state, self._checkpoint_state())
+
+    def _add_journal_record(self, record):
+        if self._journal is not None:
+            self._journal_records.append(record)
+
+    def _save_checkpoint_journal(self):
+        self._add_journal_record(('state', {
+            "best_model": self._best_model,
+            "best_model_quality": self._best_model_quality,
+            "earliest_good_model": self._earliest_good_model,
+            "earliest_good_model_iter": self._earliest_good_model_iter,
+            "iter": self._iter
+        }))
+
+        records = self._journal_records
+        self._journal_records = []
+        self._num_journal_records += len(records)
+
+        if self._num_journal_records > self._journal_compact_every:
+            if self._debug_mode:
+                self._log.debug("Compacting checkpoint journal ...")
+
+            self._num_journal_records = 0
+            self._run_io(self._compact_journal, self._checkpoint_state())
+        else:
+            self._run_io(self._append_journal, records)
+
+    def _append_journal(self, records):
+        start = time.time()
+        size = self._file_size(self.checkpoint_journal_file_name())
+
+        self._journal.append(records)
+
+        self._record_io('state', start, self._file_size(self.checkpoint_journal_file_name()) - size)
+
+    def _compact_journal(self, state):
+        start = time.time()
+
+        self._journal.compact(state)
+
+        self._record_io('state', start, self._file_size(self.checkpoint_state_file_name()))
+
+    def _write_checkpoint_state(self, state):
+        start = time.time()
+
         try:
             fname = self.checkpoint_state_file_name()
 
             # only backup if exists
             if os.path.isfile(fname):
-                backup_success = self._copy(fname, "%s.backup" % fname)
+                backup_success = self._copy_file(fname, "%s.backup" % fname, is_model=False)
                 if not backup_success:
                     self._log.error("Backing up checkpoint state unsuccessful, "
                                     "will not override checkpoint state file with new state.")
                     return
 
-            if self._simulation_mode or self._debug_mode:
-                self._log.debug("Saving checkpoint state to [%s]" % fname)
+            with open(fname, 'wb') as f:
+                pickle.dump(state, f)
 
-            if not self._simulation_mode:
-                with open(fname, 'wb') as f:
-                    pickle.dump({
-                        "model_quality": self._model_quality,
-                        "model_iter": self._model_iter,
-                        "best_model": self._best_model,
-                        "best_model_quality": self._best_model_quality,
-                        "earliest_good_model": self._earliest_good_model,
-                        "earliest_good_model_iter": self._earliest_good_model_iter,
-                        "iter": self._iter
-                    }, f)
+            self._record_io('state', start, self._file_size(fname))
         except Exception as e:
             _.log_exception(self._log, "Unable to save checkpoint state", e)
 
     def _save_checkpoint(self):
+        if not self._is_coordinator and self._shards is None:
+            return None
+
         try:
             fname = self.latest_model_file_name()
             if self._simulation_mode or self._debug_mode:
                 self._log.debug("Saving checkpoint as [%s]" % fname)
 
             if not self._simulation_mode:
-                self._model.save_weights(fname)
+                if self._shards is not None:
+                    self._save_sharded_weights(fname)
+                else:
+                    self._save_weights(fname)
 
             return fname
         except Exception as e:
@@ -341,32 +612,252 @@ class ModelCheckpointManager(Base, Callback):
 
         return None
 
-    def _copy(self, source_fname, dest_fname):
+    def _archive_checkpoint(self):
+        fname = self.archived_model_file_name()
+        if self._archive_codec is None:
+            self._copy(self.latest_model_file_name(), fname)
+            return
+
+        if self._simulation_mode or self._debug_mode:
+            self._log.debug("Encoding archive [%s]" % fname)
+
+        if self._simulation_mode:
+            return
+
+        try:
+            self._run_io(self._encode_snapshot, self._take_snapshot(), fname)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to archive current model", e)
+
+    def _encode_snapshot(self, snapshot, fname):
         success = True
 
         try:
-            if self._simulation_mode or self._debug_mode:
-                self._log.debug("Copying model: [%s] ==> [%s]" % (source_fname, dest_fname))
+            start = time.time()
+            nbytes = self._archive_codec.encode(snapshot, fname)
+            self._record_io('encode', start, nbytes)
 
-            if not self._simulation_mode:
+            if self._debug_mode:
+                self._log.debug("Encoded archive [%s] : %d bytes, raw %d bytes" % (fname, nbytes, snapshot.nbytes))
+        except Exception as e:
+            _.log_exception(self._log, "Unable to encode model weights snapshot to [%s]" % fname, e)
+            success = False
+
+        return success
+
+    def _take_snapshot(self):
+        # All weight files written in the same iteration share a snapshot
+        if self._snapshot_iter != self._iter:
+            self._snapshot = WeightSnapshot.take(self._model)
+            self._snapshot_iter = self._iter
+
+        return self._snapshot
+
+    def _save_sharded_weights(self, fname):
+        if not self._is_coordinator:
+            snapshot = WeightSnapshot.take(self._model, self._shards.layers(self._model))
+            self._run_io(self._write_shard, snapshot, self._iter)
+            return
+
+        self._run_io(self._write_sharded_weights, self._take_snapshot(), fname, self._iter)
+
+    def _write_shard(self, snapshot, iteration):
+        success = True
+
+        try:
+            start = time.time()
+            shard_fname = self._shards.write_shard(snapshot, self._base_filename, iteration)
+            self._record_io('save', start, self._file_size(shard_fname))
+        except Exception as e:
+            _.log_exception(self._log, "Unable to write weight shard of iteration %d" % iteration, e)
+            success = False
+
+        return success
+
+    def _write_sharded_weights(self, snapshot, fname, iteration):
+        """
+        Writes the shard of the coordinator, waits for the shards of the other workers and writes the manifest
+
+        :param snapshot: snapshot of all weights, saved completely if not all shards are written in time
+        :param fname: weight file name
+        :param iteration:
+        """
+        success = True
+
+        try:
+            start = time.time()
+            shard_fname = self._shards.write_shard(self._shards.select(self._model, snapshot),
+                                                   self._base_filename, iteration)
+            size = self._file_size(shard_fname)
+
+            shard_fnames = self._shards.wait_for_shards(self._base_filename, iteration, self._shard_timeout)
+            if shard_fnames is None:
+                self._log.error("Not all shards of iteration %d available, saving complete weights to [%s]" %
+                                (iteration, fname))
+                self._store_weights(snapshot.save, fname)
+
+                # Shards of workers that are late are removed at the next sharded save
+                self._timed_out_shard_iters.append(iteration)
+                self._release_timed_out_shards()
+                return success
+
+            replaced_shard_fnames = self._shards.write_manifest(fname, self._model, iteration, shard_fnames)
+            self._record_io('save', start, size + self._file_size(fname))
+
+            self._shards.release(replaced_shard_fnames)
+            self._release_timed_out_shards()
+        except Exception as e:
+            _.log_exception(self._log, "Unable to save sharded weights to [%s]" % fname, e)
+            success = False
+
+        return success
+
+    def _release_timed_out_shards(self):
+        """
+        Removes the shards of iterations for which the coordinator timed out, they are not referred to by a manifest
+        """
+        for iteration in self._timed_out_shard_iters:
+            self._shards.release(self._shards.iteration_shard_file_names(self._base_filename, iteration))
+
+    def _release_replaced_shards(self, fname):
+        """
+        Removes the shards only referred to by a manifest, after it is overwritten by a regular weight file or removed
+
+        :param fname: weight file
+        """
+        if self._shards is None:
+            return
+
+        shard_fnames = self._shards.forget(fname)
+        if len(shard_fnames) > 0:
+            self._shards.release(shard_fnames)
+
+    def _manifest_paths(self):
+        return [self._model_path, self._temp_model_path]
+
+    def _save_weights(self, fname):
+        if self._io_worker is None:
+            self._store_weights(self._model.save_weights, fname)
+            return
+
+        self._io_worker.submit(self._write_snapshot, self._take_snapshot(), fname)
+
+    def _write_snapshot(self, snapshot, fname):
+        success = True
+
+        try:
+            self._store_weights(snapshot.save, fname)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to save model weights snapshot to [%s]" % fname, e)
+            success = False
+
+        return success
+
+    def _store_weights(self, save, fname):
+        """
+
+        :param save: function that saves weights to the given file name
+        :param fname: file name of the weights
+        """
+        start = time.time()
+
+        if self._store is None:
+            save(fname)
+            self._record_io('save', start, self._file_size(fname))
+
+            self._release_replaced_shards(fname)
+            return
+
+        tmp_fname = self._store.new_file_name()
+        save(tmp_fname)
+        size = self._file_size(tmp_fname)
+
+        self._store.link(self._store.put(tmp_fname), fname)
+        self._record_io('save', start, size)
+
+    def _record_io(self, op, start, bytes_written=0, bytes_copied=0):
+        if self._io_stats is not None:
+            self._io_stats.record(op, time.time() - start, bytes_written, bytes_copied)
+
+    @staticmethod
+    def _file_size(fname):
+        return os.path.getsize(fname) if os.path.isfile(fname) else 0
+
+    def _run_io(self, task, *args):
+        """
+        Executes a file operation, on the background thread when async_checkpoints=True
+
+        :return: result of the task, or True if the task is queued
+        """
+        if self._io_worker is None:
+            return task(*args)
+
+        self._io_worker.submit(task, *args)
+
+        return True
+
+    def _copy(self, source_fname, dest_fname):
+        if self._simulation_mode or self._debug_mode:
+            self._log.debug("Copying model: [%s] ==> [%s]" % (source_fname, dest_fname))
+
+        if self._simulation_mode:
+            return True
+
+        snapshot = self._snapshot_cache.get(source_fname) if self._snapshot_cache is not None else None
+        if snapshot is not None:
+            return self._run_io(self._write_snapshot, snapshot, dest_fname)
+
+        return self._run_io(self._copy_file, source_fname, dest_fname)
+
+    def _copy_file(self, source_fname, dest_fname, is_model=True):
+        """
+
+        :param source_fname:
+        :param dest_fname:
+        :param is_model: If True, the file is a weight file, copied using the checkpoint store (if any)
+        :return: True on success
+        """
+        success = True
+        start = time.time()
+
+        try:
+            if is_model and (self._store is not None):
+                # The destination can be a (hard linked) alias of a blob, it must never be written in place
+                is_alias = self._store.alias_of(source_fname) is not None
+                self._store.copy(source_fname, dest_fname)
+                # Only links are created for an alias
+                self._record_io('copy', start, bytes_copied=0 if is_alias else self._file_size(dest_fname))
+            elif (self._shards is not None) and self._shards.is_tracked_manifest(source_fname):
+                # A sharded weight file is copied by copying its manifest only
+                replaced_shard_fnames = self._shards.copy_manifest(source_fname, dest_fname)
+                self._record_io('copy', start, bytes_copied=self._file_size(dest_fname))
+
+                self._shards.release(replaced_shard_fnames)
+            else:
                 copyfile(source_fname, dest_fname)
+                self._record_io('copy', start, bytes_copied=self._file_size(dest_fname))
+
+                self._release_replaced_shards(dest_fname)
         except Exception as e:
             _.log_exception(self._log, "Unable to copy [%s]" % source_fname, e)
             success = False
 
         return success
 
-    def _save_current_model_as_temp(self, checkpoint_fname):
+    def _save_current_model_as_temp(self, checkpoint_fname, model_quality=None):
+        if self._snapshot_cache is not None:
+            return self._cache_current_model(model_quality)
+
         try:
-            fname = tempfile.mkstemp(dir=self._temp_model_path)
-            fname = fname[1]
+            fd, fname = tempfile.mkstemp(dir=self._temp_model_path)
+            os.close(fd)
 
             if checkpoint_fname is None:
                 if self._simulation_mode or self._debug_mode:
                     self._log.debug("Saving current model weights to temp. file [%s]" % fname)
 
                 if not self._simulation_mode:
-                    self._model.save_weights(fname)
+                    self._save_weights(fname)
 
                 return fname
             else:
@@ -385,19 +876,69 @@ class ModelCheckpointManager(Base, Callback):
             _.log_exception(self._log, "Unable to save or copy current model as temp. model", e)
             return None
 
-    def _remove_model(self, model_fname):
+    def _cache_current_model(self, model_quality):
         try:
-            if self._simulation_mode or self._debug_mode:
-                self._log.debug("Removing model: [%s]" % model_fname)
+            fname = os.path.join(self._temp_model_path, '%s-%d.model' % (self._base_filename, self._iter))
+            if self._debug_mode:
+                self._log.debug("Caching current model weights as [%s]" % fname)
+
+            # The current model is the new best model
+            evicted = self._snapshot_cache.put(fname, self._take_snapshot(), model_quality,
+                                               protected=(fname, self._earliest_good_model))
 
+            for evicted_fname, snapshot in evicted:
+                if self._debug_mode:
+                    self._log.debug("Evicted model [%s] from snapshot cache, saving to file" % evicted_fname)
+
+                self._run_io(self._write_snapshot, snapshot, evicted_fname)
+
+            return fname
+        except Exception as e:
+            _.log_exception(self._log, "Unable to cache current model", e)
+            return None
+
+    def _spill_snapshot_cache(self):
+        if self._snapshot_cache is None:
+            return
+
+        for fname, snapshot in self._snapshot_cache.items():
+            if self._debug_mode:
+                self._log.debug("Saving cached model [%s] to file" % fname)
+
+            self._snapshot_cache.pop(fname)
+            self._run_io(self._write_snapshot, snapshot, fname)
+
+    def _remove_model(self, model_fname):
+        if self._simulation_mode or self._debug_mode:
+            self._log.debug("Removing model: [%s]" % model_fname)
+
+        if self._simulation_mode:
+            return
+
+        if (self._snapshot_cache is not None) and (self._snapshot_cache.pop(model_fname) is not None):
+            # Model was never written to disk
+            return
+
+        self._run_io(self._remove_file, model_fname)
+
+    def _remove_file(self, model_fname):
+        start = time.time()
+
+        try:
             if not os.path.isfile(model_fname):
-                if self._simulation_mode or self._debug_mode:
+                if self._debug_mode:
                     self._log.debug("File does not exists, will not remove ...")
 
                 return
 
-            if not self._simulation_mode:
+            if (self._store is not None) and (self._store.alias_of(model_fname) is not None):
+                self._store.remove(model_fname)
+            else:
                 os.remove(model_fname)
+
+                self._release_replaced_shards(model_fname)
+
+            self._record_io('remove', start)
         except Exception as e:
             _.log_exception(self._log, "Unable to remove file [%s]" % model_fname, e)
 
@@ -0,0 +1,121 @@
+from bisect import bisect_left, insort
+
+
+class ModelRegistry():
+    """
+
+    Registry of saved models, with their quality and training iteration.
+
+    Models are indexed by quality and by iteration, in sorted lists, such that the models outside a quality boundary
+    and the earliest model are found with a binary search, instead of scanning all models.
+
+    When a journal is given (see CheckpointJournal), every mutation of the registry is appended to it.
+
+    """
+    def __init__(self, metric_opt_mode='min', model_quality=None, model_iter=None, journal=None):
+        """
+
+        :param metric_opt_mode: 'max', 'min'
+        :param model_quality: initial dict mapping model names to model quality
+        :param model_iter: initial dict mapping model names to model iteration
+        :param journal: function that is called with a record for every mutation
+        """
+        self._metric_opt_mode = metric_opt_mode
+
+        self._quality = dict()
+        self._iter = dict()
+
+        # Sorted from best to worst
+        self._by_quality = []
+        # Sorted from earliest to latest
+        self._by_iter = []
+
+        self._journal = None
+
+        model_quality = model_quality or dict()
+        model_iter = model_iter or dict()
+        for fname, quality in model_quality.items():
+            self.add(fname, quality, model_iter[fname])
+
+        self._journal = journal
+
+    def __contains__(self, fname):
+        return fname in self._quality
+
+    def __len__(self):
+        return len(self._quality)
+
+    def __iter__(self):
+        return iter(list(self._quality.keys()))
+
+    def quality(self, fname):
+        return self._quality[fname]
+
+    def iteration(self, fname):
+        return self._iter[fname]
+
+    def add(self, fname, quality, iteration):
+        if fname in self._quality:
+            self.remove(fname)
+
+        self._quality[fname] = quality
+        self._iter[fname] = iteration
+
+        insort(self._by_quality, (self._sort_key(quality), fname))
+        insort(self._by_iter, (iteration, fname))
+
+        if self._journal is not None:
+            self._journal(('add', fname, quality, iteration))
+
+    def remove(self, fname):
+        quality = self._quality.pop(fname)
+        iteration = self._iter.pop(fname)
+
+        self._by_quality.pop(bisect_left(self._by_quality, (self._sort_key(quality), fname)))
+        self._by_iter.pop(bisect_left(self._by_iter, (iteration, fname)))
+
+        if self._journal is not None:
+            self._journal(('remove', fname))
+
+    def clear(self):
+        for fname in list(self._quality.keys()):
+            self.remove(fname)
+
+    def not_better_than(self, boundary):
+        """
+
+        :param boundary: quality boundary
+        :return: names of the models with a quality that is not better than the boundary, from best to worst
+        """
+        index = bisect_left(self._by_quality, (self._sort_key(boundary),))
+
+        return [fname for _, fname in self._by_quality[index:]]
+
+    def earliest(self, exclude=None):
+        """
+
+        :param exclude: model name to skip
+        :return: name of the model with the earliest iteration, None if there is none
+        """
+        for _, fname in self._by_iter[:2]:
+            if fname != exclude:
+                return fname
+
+        return None
+
+    def model_quality(self):
+        """
+
+        :return: dict mapping model names to model quality (a copy)
+        """
+        return self._quality.copy()
+
+    def model_iter(self):
+        """
+
+        :return: dict mapping model names to model iteration (a copy)
+        """
+        return self._iter.copy()
+
+    def _sort_key(self, quality):
+        return -quality if self._metric_opt_mode == 'max' else quality
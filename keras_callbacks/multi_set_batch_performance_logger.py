@@ -0,0 +1,158 @@
+import numpy as np
+
+from keras_callbacks.default_batch_performance_logger import DefaultBatchPerformanceLogger
+
+# Options of BatchPerformanceLoggerBase that wrap the single batch generator
+_SINGLE_GENERATOR_KWARGS = ("prefetch_batches", "prefetch_processes", "batch_generator_factory", "cache_batches",
+                            "cache_max_bytes", "cache_spill_path", "cache_shuffle_seed")
+
+
+def _concatenate(batches):
+    """
+
+    :param batches: list of arrays, or of lists of arrays (multiple inputs)
+    :return: array, or list of arrays, concatenated along the batch axis
+    """
+    if isinstance(batches[0], (list, tuple)):
+        return [np.concatenate(arrays, axis=0) for arrays in zip(*batches)]
+
+    return np.concatenate(batches, axis=0)
+
+
+def _slice(outputs, start, end):
+    """
+
+    :param outputs: array, or list of arrays (multiple outputs)
+    :return: array, or list of arrays, with the samples start to end of every output
+    """
+    if isinstance(outputs, (list, tuple)):
+        return [output[start:end] for output in outputs]
+
+    return outputs[start:end]
+
+
+class MultiSetBatchPerformanceLogger(DefaultBatchPerformanceLogger):
+    """
+
+    Logs batch level metrics for multiple validation sets, with a single predict call for all sets.
+
+    Every iteration, a batch is taken from the generator of every set. The inputs of all sets are concatenated and
+    predicted at once, the outputs are split per set to calculate the metrics of every set, with the postfix of the
+    set (e.g. batch_perplexity_<postfix>).
+
+    With accumulate_batches = K > 1, the batches of K iterations are accumulated and predicted at once, every K-th
+    iteration. The metrics then are calculated over the K batches of every set, in the other iterations no metrics are
+    logged (PerformanceAverager repeats the last averages).
+
+    Prefetching and caching of batches (prefetch_batches, cache_batches, ...) are not supported, wrap the batch
+    generators of the sets in a BatchPrefetcher or ValidationBatchPool instead.
+
+    """
+    def __init__(self,
+                 session,
+                 max_seq_length,
+                 num_symbols,
+                 batch_generators,
+                 accumulate_batches=1,
+                 inspector=None,
+                 num_samples_to_inspect=5,
+                 one_hot_encoding=True,
+                 metric_backend='tensorflow',
+                 **kwargs):
+        """
+
+        :param session:
+        :param max_seq_length:
+        :param num_symbols:
+        :param batch_generators: dict mapping metrics name postfix to batch generator, batches are
+                                 (inputs, targets, sample weights) tuples
+        :param accumulate_batches: number of iterations to accumulate batches for, before predicting
+        :param inspector:
+        :param num_samples_to_inspect:
+        :param one_hot_encoding:
+        :param metric_backend: 'tensorflow', 'numpy', see DefaultBatchPerformanceLogger
+        """
+        ignored_kwargs = [key for key in _SINGLE_GENERATOR_KWARGS if key in kwargs]
+        for key in ignored_kwargs:
+            kwargs.pop(key)
+
+        super().__init__(session,
+                         max_seq_length,
+                         num_symbols,
+                         None,
+                         metrics_name_postfix="_".join(batch_generators.keys()),
+                         inspector=inspector,
+                         num_samples_to_inspect=num_samples_to_inspect,
+                         one_hot_encoding=one_hot_encoding,
+                         metric_backend=metric_backend,
+                         **kwargs)
+
+        if len(ignored_kwargs) > 0:
+            self._log.error("%s not supported for multiple validation sets, ignoring. Wrap the batch generators in a "
+                            "BatchPrefetcher or ValidationBatchPool instead" % ", ".join(ignored_kwargs))
+
+        self._batch_generators = batch_generators
+        self._accumulate_batches = max(1, accumulate_batches)
+
+        self._accumulated = {pf: [] for pf in self._batch_generators.keys()}
+
+    def _generate_batch(self):
+        """
+
+        :return: dict mapping postfix to (inputs, targets, sample weights) of the accumulated batches,
+                 None if still accumulating
+        """
+        for pf, batch_generator in self._batch_generators.items():
+            self._accumulated[pf].append(next(batch_generator))
+
+        if len(next(iter(self._accumulated.values()))) < self._accumulate_batches:
+            return None
+
+        batch_data = dict()
+        for pf, batches in self._accumulated.items():
+            batch_data[pf] = tuple(_concatenate(list(arrays)) for arrays in zip(*batches))
+
+            self._accumulated[pf] = []
+
+        return batch_data
+
+    def _predict_model(self, batch_data):
+        """
+
+        :return: dict mapping postfix to output batch
+        """
+        if batch_data is None:
+            return None
+
+        postfixes = list(batch_data.keys())
+
+        inputs = _concatenate([batch_data[pf][0] for pf in postfixes])
+        outputs = self.model.predict_on_batch(inputs)
+
+        predicted_batch_data = dict()
+        start = 0
+        for pf in postfixes:
+            num_samples = len(batch_data[pf][1])
+            predicted_batch_data[pf] = _slice(outputs, start, start + num_samples)
+            start += num_samples
+
+        return predicted_batch_data
+
+    def _calc_performance(self, generated_batch_data, predicted_batch_data):
+        if generated_batch_data is None:
+            return dict()
+
+        metrics = dict()
+        for pf, batch_data in generated_batch_data.items():
+            cross_entropy, accuracy = self._calc_metric_values(batch_data, predicted_batch_data[pf])
+            metrics.update(self._metrics_dict(pf, cross_entropy, accuracy))
+
+        return metrics
+
+    def _inspect_data(self, generated_batch_data, predicted_batch_data, batch_metrics_data):
+        if generated_batch_data is None:
+            # Still accumulating
+            return
+
+        self._inspect_samples(batch_metrics_data, [(batch_data, predicted_batch_data[pf])
+                                                   for pf, batch_data in generated_batch_data.items()])
@@ -0,0 +1,94 @@
+import numpy as np
+
+from basics.base import Base
+
+
+class NumpyMetricEngine(Base):
+    """
+
+    NumPy implementation of the weighted masked cross entropy and accuracy, as calculated by
+    weighted_masked_objective(categorical_crossentropy) (and the sparse and accuracy variants) of Keras, without a
+    TensorFlow graph.
+
+    The output batch (batch, seq_length, num_symbols) is processed in chunks of rows (time steps), every chunk is
+    converted to float32, such that the memory used is bounded by max_chunk_elements, also for large vocabularies
+    and float16 outputs.
+
+    """
+    def __init__(self, one_hot_encoding=True, max_chunk_elements=1 << 22, epsilon=1e-7, **kwargs):
+        """
+
+        :param one_hot_encoding: True for one-hot targets (batch, seq_length, num_symbols), False for sparse targets
+                                 (batch, seq_length, 1) with symbol indices
+        :param max_chunk_elements: maximum number of output values processed at once
+        :param epsilon: fuzz factor, as K.epsilon()
+        """
+        super().__init__(**kwargs)
+
+        self._one_hot_encoding = one_hot_encoding
+        self._max_chunk_elements = max_chunk_elements
+        self._epsilon = np.float32(epsilon)
+
+    def evaluate(self, target_batch, output_batch, sample_weights_batch):
+        """
+
+        :param target_batch:
+        :param output_batch: probabilities (batch, seq_length, num_symbols)
+        :param sample_weights_batch: (batch, seq_length)
+        :return: weighted cross entropy, weighted accuracy (float32)
+        """
+        output_batch = np.asarray(output_batch)
+        num_symbols = output_batch.shape[-1]
+
+        outputs = output_batch.reshape(-1, num_symbols)
+        targets = np.asarray(target_batch).reshape(outputs.shape[0], -1)
+
+        cross_entropy = np.empty(outputs.shape[0], dtype=np.float32)
+        correct = np.empty(outputs.shape[0], dtype=np.float32)
+
+        chunk_rows = max(1, self._max_chunk_elements // num_symbols)
+        for start in range(0, outputs.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, outputs.shape[0])
+
+            if self._one_hot_encoding:
+                self._categorical_scores(targets[start:stop], outputs[start:stop],
+                                         cross_entropy[start:stop], correct[start:stop])
+            else:
+                self._sparse_categorical_scores(targets[start:stop], outputs[start:stop],
+                                                cross_entropy[start:stop], correct[start:stop])
+
+        weights = np.asarray(sample_weights_batch, dtype=np.float32).reshape(-1)
+
+        return self._weighted_mean(cross_entropy, weights), self._weighted_mean(correct, weights)
+
+    def _categorical_scores(self, targets, outputs, cross_entropy, correct):
+        correct[:] = np.argmax(targets, axis=-1) == np.argmax(outputs, axis=-1)
+
+        # As categorical_crossentropy : scale to sum 1, clip, -sum(target * log(output))
+        probs = outputs.astype(np.float32)
+        probs /= probs.sum(axis=-1, keepdims=True)
+        np.clip(probs, self._epsilon, 1 - self._epsilon, out=probs)
+        np.log(probs, out=probs)
+
+        cross_entropy[:] = -np.einsum('ij,ij->i', targets.astype(np.float32), probs)
+
+    def _sparse_categorical_scores(self, targets, outputs, cross_entropy, correct):
+        labels = targets[:, 0].astype(np.int64)
+
+        correct[:] = np.argmax(outputs, axis=-1) == labels
+
+        # As sparse_categorical_crossentropy : softmax cross entropy on the log of the clipped output,
+        # -log(clipped_output[label] / sum(clipped_output))
+        probs = outputs.astype(np.float32)
+        np.clip(probs, self._epsilon, 1 - self._epsilon, out=probs)
+
+        label_probs = probs[np.arange(len(labels)), labels]
+        cross_entropy[:] = np.log(probs.sum(axis=-1)) - np.log(label_probs)
+
+    @staticmethod
+    def _weighted_mean(scores, weights):
+        # As weighted_masked_objective : weight the scores, normalise by the share of non-zero weights, average
+        scores = scores * weights
+        scores /= np.mean((weights != 0).astype(np.float32))
+
+        return np.mean(scores, dtype=np.float32)
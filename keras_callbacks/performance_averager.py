@@ -7,6 +7,8 @@ from basics.base import Base
 
 from utils.sliding_window import SlidingWindow
 
+from keras_callbacks.ring_buffer_window import RingBufferWindow
+
 import basics.base_utils as _
 
 
@@ -16,7 +18,22 @@ class PerformanceAverager(Base, Callback):
     Calculates averages of performance values with certain name postfix
 
     """
-    def __init__(self, window_length, metrics_name_postfix="unknown", window_values=None, **kwargs):
+    def __init__(self,
+                 window_length,
+                 metrics_name_postfix="unknown",
+                 window_values=None,
+                 incremental_window=False,
+                 metric_bus=None,
+                 **kwargs):
+        """
+
+        :param window_length:
+        :param metrics_name_postfix:
+        :param window_values: dict mapping metric names to initial window values
+        :param incremental_window: If True, a RingBufferWindow is used, with O(1) updates of the mean, instead of
+                                   recalculating the mean over the SlidingWindow every iteration
+        :param metric_bus: MetricBus to read the metrics from, instead of scanning the logs
+        """
         super().__init__(**kwargs)
 
         self._log.debug("Averaging performance for %s metrics over %d iterations" % (metrics_name_postfix, window_length))
@@ -25,34 +42,54 @@ class PerformanceAverager(Base, Callback):
         self._metrics_name_postfix = metrics_name_postfix
 
         self._window_values = window_values
+        self._window_class = RingBufferWindow if incremental_window else SlidingWindow
 
         self._window = dict()
 
+        self._metric_bus = metric_bus
+        self._subscription = None
+        if metric_bus is not None:
+            self._subscription = metric_bus.subscribe(lambda name: name.endswith(metrics_name_postfix))
+
     def on_batch_end(self, batch, logs=None):
         if not _.is_dict(logs):
             self._log.error("No logs dict given, unable to average metrics")
             return
 
-        average = dict()
-        for metric, value in logs.items():
-            if not metric.endswith(self._metrics_name_postfix):
-                continue
+        if self._subscription is not None:
+            self._metric_bus.sync(batch, logs)
+            metric_values = list(zip(*self._subscription.updated()))
+        else:
+            metric_values = [(metric, value) for metric, value in logs.items()
+                             if metric.endswith(self._metrics_name_postfix)]
 
+        average = dict()
+        for metric, value in metric_values:
             if metric not in self._window:
                 self._log.debug("Creating sliding window for metric [%s]" % metric)
                 has_init_values = _.is_dict(self._window_values) and metric in self._window_values
                 init_window_values = self._window_values[metric] if has_init_values else None
-                self._window[metric] = SlidingWindow(self._window_length, init_window_values)
+                self._window[metric] = self._window_class(self._window_length, init_window_values)
                 
             self._window[metric].slide(value)
 
             m = PerformanceAverager.average(self._window[metric])
             if not (m is None):
-                if m == math.inf or m == math.nan:
+                if not math.isfinite(m):
                     self._log.warn("Mean value for %s is %s" % (metric, m))
                     self._log.warn("Window values : \n%s\n\n" % str(self._window[metric].get_window()))
                 average['mean_%s' % metric] = m
 
+        # Metrics that were not evaluated in this iteration (see EvaluationScheduler), keep their last average
+        evaluated = set(metric for metric, value in metric_values)
+        for metric, window in self._window.items():
+            if metric in evaluated:
+                continue
+
+            m = PerformanceAverager.average(window)
+            if not (m is None):
+                average['mean_%s' % metric] = m
+
         logs.update(average)
 
     @staticmethod
@@ -60,6 +97,9 @@ class PerformanceAverager(Base, Callback):
         if sliding_window.is_empty():
             return None
 
+        if isinstance(sliding_window, RingBufferWindow):
+            return np.float32(sliding_window.mean())
+
         # Needs to be at least float32 because mean() can lead to inf for float16 input values
         window = np.array(sliding_window.get_window(), dtype='float32')
 
@@ -2,6 +2,8 @@ from keras.callbacks import Callback
 
 from basics.base import Base
 
+from keras_callbacks.validation_batch_pool import ValidationBatchPool
+
 
 class PerformanceLoggerBase(Base, Callback):
     """
@@ -17,9 +19,31 @@ class PerformanceLoggerBase(Base, Callback):
                  generator,
                  metrics_name_postfix="unknown",
                  inspect_period=-1,
+                 cache_batches=0,
+                 cache_max_bytes=1 << 30,
+                 cache_spill_path=None,
                  **kwargs):
+        """
+
+        :param generator:
+        :param metrics_name_postfix:
+        :param inspect_period:
+        :param cache_batches: If > 0, the first cache_batches batches of the generator are generated once and served
+                              again, in the same order, from a ValidationBatchPool. Set to the number of batches used
+                              per evaluation, for a fixed validation set.
+        :param cache_max_bytes: Maximum number of bytes of the cached batches kept in memory
+        :param cache_spill_path: Directory to spill cached batches to, that don't fit in memory
+        """
         super().__init__(**kwargs)
 
+        self._batch_pool = None
+        if cache_batches > 0:
+            self._batch_pool = ValidationBatchPool(generator,
+                                                   cache_batches,
+                                                   max_bytes=cache_max_bytes,
+                                                   spill_path=cache_spill_path)
+            generator = self._batch_pool
+
         self._generator = generator
         self._metrics_name_postfix = metrics_name_postfix
 
@@ -36,6 +60,17 @@ class PerformanceLoggerBase(Base, Callback):
             (epoch % self._inspect_period == 0):
             self._inspect()
 
+    def cache_stats(self):
+        """
+
+        :return: dict with the hit and miss statistics of the batch pool (see ValidationBatchPool.stats()),
+                 None when not caching
+        """
+        if self._batch_pool is None:
+            return None
+
+        return self._batch_pool.stats()
+
     def _calc_metrics(self):
         self._log.error("Please implement this method")
 
@@ -0,0 +1,248 @@
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from keras.callbacks import Callback
+
+from basics.base import Base
+import basics.base_utils as _
+
+_ERROR = '__evaluation_error__'
+
+
+def _evaluate_in_process(model_factory, generator_factory, metrics_fn, num_batches,
+                         shm_name, layout, task_queue, result_queue):
+    shm = shared_memory.SharedMemory(name=shm_name)
+
+    try:
+        model = model_factory()
+        batch_generator = generator_factory()
+
+        while True:
+            iteration = task_queue.get()
+            if iteration is None:
+                return
+
+            try:
+                # Copy the weights out of shared memory, the trainer may publish new weights when the result is sent
+                model.set_weights([np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy()
+                                   for shape, dtype, offset in layout])
+
+                totals = dict()
+                for _i in range(num_batches):
+                    for metric, value in metrics_fn(model, next(batch_generator)).items():
+                        totals[metric] = totals.get(metric, 0.) + float(value)
+
+                result_queue.put((iteration, {metric: np.float32(total / num_batches)
+                                              for metric, total in totals.items()}))
+            except Exception as e:
+                result_queue.put((iteration, (_ERROR, repr(e))))
+    finally:
+        shm.close()
+
+
+class ProcessBatchPerformanceLogger(Base, Callback):
+    """
+
+    Evaluates the model in a separate worker process, such that training never waits for validation.
+
+    The worker process builds its own copy of the model, with model_factory(), and its own batch generator, with
+    generator_factory(). Every evaluation_period iterations, if the worker is idle, the current weights are copied
+    to shared memory and the worker evaluates num_batches batches with metrics_fn(model, batch_data), which returns a
+    dict with metric values (e.g. using NumpyMetricEngine). If the worker is still busy, the evaluation is skipped.
+
+    The mean metrics are added to the logs of the first iteration after they are available, together with
+    evaluation_iter_<metrics_name_postfix>, the iteration of the evaluated weights. With republish_metrics=True, the
+    last metrics are added to the logs of every iteration.
+
+    If the worker process dies, the evaluation counts as failed and a new worker is started at the next evaluation,
+    at most max_worker_restarts times. The worker is stopped at the end of training, call close() when training is
+    interrupted.
+
+    """
+    def __init__(self,
+                 model_factory,
+                 generator_factory,
+                 metrics_fn,
+                 metrics_name_postfix="unknown",
+                 evaluation_period=100,
+                 num_batches=1,
+                 republish_metrics=False,
+                 init_iter=-1,
+                 mp_context='spawn',
+                 max_worker_restarts=3,
+                 **kwargs):
+        """
+
+        :param model_factory: picklable function that builds the model in the worker process (e.g. on CPU)
+        :param generator_factory: picklable function that returns the validation batch generator
+        :param metrics_fn: picklable function (model, batch_data) -> dict mapping metric names to values
+        :param metrics_name_postfix:
+        :param evaluation_period: number of iterations between evaluations
+        :param num_batches: number of batches to average the metrics over per evaluation
+        :param republish_metrics: If True, the last metrics are added to the logs every iteration, otherwise only
+                                  when new metrics are available
+        :param init_iter:
+        :param mp_context: multiprocessing start method ('spawn', 'forkserver', 'fork'), None for the platform
+                           default. Forking a process with a running TensorFlow session is unsafe.
+        :param max_worker_restarts: number of times a new worker is started after the worker died, after that
+                                    evaluation is disabled
+        """
+        super().__init__(**kwargs)
+
+        self._model_factory = model_factory
+        self._generator_factory = generator_factory
+        self._metrics_fn = metrics_fn
+        self._metrics_name_postfix = metrics_name_postfix
+        self._evaluation_period = evaluation_period
+        self._num_batches = num_batches
+        self._republish_metrics = republish_metrics
+        self._iter = init_iter
+        self._max_worker_restarts = max_worker_restarts
+
+        self._context = multiprocessing.get_context(mp_context)
+        self._process = None
+        self._shm = None
+        self._layout = None
+        self._task_queue = None
+        self._result_queue = None
+
+        self._busy = False
+        self._last_metrics = None
+
+        self._num_evaluations = 0
+        self._num_skipped = 0
+        self._num_failed = 0
+        self._num_worker_deaths = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self._iter += 1
+
+        self._collect_results()
+
+        if (self._evaluation_period > 0) and (self._iter % self._evaluation_period == 0):
+            if self._busy:
+                self._num_skipped += 1
+            elif self._num_worker_deaths <= self._max_worker_restarts:
+                self._publish_weights()
+
+        if (logs is not None) and (self._last_metrics is not None):
+            logs.update(self._last_metrics)
+
+            if not self._republish_metrics:
+                self._last_metrics = None
+
+    def on_train_end(self, logs=None):
+        self._log.info("Evaluations : %d, skipped (worker busy) : %d, failed : %d" %
+                       (self._num_evaluations, self._num_skipped, self._num_failed))
+
+        self.close()
+
+    def stats(self):
+        return {
+            "num_evaluations": self._num_evaluations,
+            "num_skipped": self._num_skipped,
+            "num_failed": self._num_failed,
+            "num_worker_deaths": self._num_worker_deaths,
+            "busy": self._busy
+        }
+
+    def close(self):
+        """
+        Stops the worker process and releases the shared memory
+        """
+        if self._process is not None:
+            if self._process.is_alive():
+                self._task_queue.put(None)
+                self._process.join(timeout=10.)
+                if self._process.is_alive():
+                    self._process.terminate()
+
+            self._process = None
+            self._task_queue = None
+            self._result_queue = None
+
+        self._busy = False
+
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _publish_weights(self):
+        try:
+            weights = self.model.get_weights()
+
+            if self._process is None:
+                self._start(weights)
+
+            for value, (shape, dtype, offset) in zip(weights, self._layout):
+                np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)[...] = value
+
+            self._task_queue.put(self._iter)
+            self._busy = True
+        except Exception as e:
+            _.log_exception(self._log, "Unable to publish weights for evaluation", e)
+
+    def _start(self, weights):
+        layout = []
+        offset = 0
+        for value in weights:
+            value = np.asarray(value)
+            # Align every weight on 64 bytes
+            offset = (offset + 63) // 64 * 64
+            layout.append((value.shape, value.dtype.str, offset))
+            offset += value.nbytes
+
+        self._layout = layout
+        self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+
+        self._task_queue = self._context.Queue()
+        self._result_queue = self._context.Queue()
+
+        self._process = self._context.Process(target=_evaluate_in_process,
+                                              args=(self._model_factory, self._generator_factory, self._metrics_fn,
+                                                    self._num_batches, self._shm.name, self._layout,
+                                                    self._task_queue, self._result_queue),
+                                              name="evaluator-%s" % self._metrics_name_postfix,
+                                              daemon=True)
+        self._process.start()
+
+    def _collect_results(self):
+        if self._result_queue is None:
+            return
+
+        while True:
+            try:
+                iteration, metrics = self._result_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            self._busy = False
+
+            if isinstance(metrics, tuple) and (metrics[0] == _ERROR):
+                self._num_failed += 1
+                self._log.error("Evaluation of iteration %d failed : %s" % (iteration, metrics[1]))
+                continue
+
+            self._num_evaluations += 1
+
+            metrics['evaluation_iter_%s' % self._metrics_name_postfix] = np.float32(iteration)
+            self._last_metrics = metrics
+
+        if not self._process.is_alive():
+            self._worker_died()
+
+    def _worker_died(self):
+        self._num_worker_deaths += 1
+        if self._busy:
+            self._num_failed += 1
+
+        self._log.error("Evaluation worker process died, exit code : %s" % self._process.exitcode)
+
+        self.close()
+
+        if self._num_worker_deaths > self._max_worker_restarts:
+            self._log.error("Evaluation worker died %d times, disabling evaluation" % self._num_worker_deaths)
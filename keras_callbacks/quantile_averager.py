@@ -0,0 +1,258 @@
+import json
+
+import numpy as np
+
+from keras.callbacks import Callback
+
+from basics.base import Base
+
+from keras_callbacks.quantile_sketch import QuantileSketch
+from keras_callbacks.metric_histogram import MetricHistogram
+
+import basics.base_utils as _
+
+
+def _quantile_prefix(q):
+    return 'p%g' % (q * 100)
+
+
+class QuantileAverager(Base, Callback):
+    """
+
+    Companion of PerformanceAverager, that tracks the distribution of performance values with certain name postfix,
+    instead of the mean over a window.
+
+    Every metric is added to a QuantileSketch, and, if histogram_range is given, to a MetricHistogram. Every batch the
+    estimated quantiles and the maximum are added to the logs, e.g. p50_<metric>, p95_<metric> and max_<metric>.
+
+    Without window_length, the sketches cover all values since the start of training. With window_length, two
+    sketches are kept per metric, that are rotated every window_length values; the quantiles then cover the last
+    window_length to 2 * window_length values. A third sketch with the values of both is kept up to date, such that
+    the sketches only have to be merged at rotation.
+
+    Estimating a quantile is O(max_bins), hence the published quantiles are estimated again every estimate_every
+    values of a metric, and at rotation. In between the last estimates are published, the maximum is always exact.
+
+    The state of the sketches and histograms can be saved with save_state() and restored with the sketch_states
+    argument, to resume training.
+
+    """
+    def __init__(self,
+                 metrics_name_postfix="unknown",
+                 quantiles=(0.5, 0.95),
+                 publish_max=True,
+                 relative_accuracy=0.01,
+                 max_bins=2048,
+                 window_length=None,
+                 histogram_range=None,
+                 histogram_bins=100,
+                 histogram_log_scale=False,
+                 sketch_states=None,
+                 metric_bus=None,
+                 estimate_every=10,
+                 **kwargs):
+        """
+
+        :param metrics_name_postfix:
+        :param quantiles: quantiles to publish, 0 <= q <= 1
+        :param publish_max: If True, max_<metric> is published
+        :param relative_accuracy: relative accuracy of the quantile sketches
+        :param max_bins: maximum number of buckets of the quantile sketches
+        :param window_length: number of values after which the sketches are rotated, None to keep all values
+        :param histogram_range: (low, high) of the histograms, None for no histograms
+        :param histogram_bins:
+        :param histogram_log_scale:
+        :param sketch_states: state as returned by get_state(), to resume from
+        :param metric_bus: MetricBus to read the metrics from, instead of scanning the logs
+        :param estimate_every: number of values of a metric after which the published quantiles are estimated again,
+                               1 to estimate every value
+        """
+        super().__init__(**kwargs)
+
+        self._metrics_name_postfix = metrics_name_postfix
+        self._quantiles = [(_quantile_prefix(q), q) for q in quantiles]
+        self._publish_max = publish_max
+        self._relative_accuracy = relative_accuracy
+        self._max_bins = max_bins
+        self._window_length = window_length
+        self._histogram_range = histogram_range
+        self._histogram_bins = histogram_bins
+        self._histogram_log_scale = histogram_log_scale
+        self._estimate_every = max(1, estimate_every)
+
+        self._output_prefixes = tuple(['%s_' % prefix for prefix, q in self._quantiles] + ['max_', 'mean_'])
+
+        # metric -> [current sketch, previous sketch or None, number of values in current sketch,
+        #            sketch with the values of the current and previous sketch, or None]
+        self._sketches = dict()
+        self._histograms = dict()
+        self._last_published = dict()
+        self._num_since_estimate = dict()
+
+        if _.is_dict(sketch_states):
+            self._set_state(sketch_states)
+
+        self._metric_bus = metric_bus
+        self._subscription = None
+        if metric_bus is not None:
+            self._subscription = metric_bus.subscribe(self._is_input_metric)
+
+    def on_batch_end(self, batch, logs=None):
+        if not _.is_dict(logs):
+            self._log.error("No logs dict given, unable to calculate quantiles")
+            return
+
+        if self._subscription is not None:
+            self._metric_bus.sync(batch, logs)
+            metric_values = list(zip(*self._subscription.updated()))
+        else:
+            metric_values = [(metric, value) for metric, value in logs.items() if self._is_input_metric(metric)]
+
+        published = dict()
+        for metric, value in metric_values:
+            rotated = self._add(metric, value)
+
+            if rotated or (self._num_since_estimate[metric] >= self._estimate_every):
+                self._last_published[metric] = self._estimate(metric)
+                self._num_since_estimate[metric] = 0
+            elif self._publish_max and (len(self._last_published[metric]) > 0):
+                self._last_published[metric]['max_%s' % metric] = np.float32(self.sketch(metric).max())
+
+            published.update(self._last_published[metric])
+
+        # Metrics that were not evaluated in this iteration (see EvaluationScheduler), keep their last values
+        evaluated = set(metric for metric, value in metric_values)
+        for metric, values in self._last_published.items():
+            if metric not in evaluated:
+                published.update(values)
+
+        logs.update(published)
+
+    def sketch(self, metric):
+        """
+
+        :param metric:
+        :return: QuantileSketch with the values of the metric (in the current window), None if unknown
+        """
+        if metric not in self._sketches:
+            return None
+
+        current, previous, num_values, merged = self._sketches[metric]
+
+        return current if merged is None else merged
+
+    def histogram(self, metric):
+        """
+
+        :param metric:
+        :return: MetricHistogram of the metric, None if unknown or no histogram_range given
+        """
+        return self._histograms.get(metric)
+
+    def get_state(self):
+        """
+
+        :return: dict with the state of the sketches and histograms, with plain Python values
+        """
+        state = dict()
+        for metric, (current, previous, num_values, merged) in self._sketches.items():
+            state[metric] = {
+                "current": current.get_state(),
+                "previous": previous.get_state() if previous is not None else None,
+                "num_values": num_values,
+                "histogram": self._histograms[metric].get_state() if metric in self._histograms else None
+            }
+
+        return state
+
+    def save_state(self, fname):
+        try:
+            with open(fname, 'w') as f:
+                json.dump(self.get_state(), f)
+        except Exception as e:
+            _.log_exception(self._log, "Unable to save quantile sketch state to %s" % fname, e)
+
+    @staticmethod
+    def load_state(fname):
+        """
+
+        :param fname:
+        :return: state to pass as sketch_states
+        """
+        with open(fname, 'r') as f:
+            return json.load(f)
+
+    def _is_input_metric(self, metric):
+        return metric.endswith(self._metrics_name_postfix) and not metric.startswith(self._output_prefixes)
+
+    def _set_state(self, sketch_states):
+        for metric, state in sketch_states.items():
+            current = QuantileSketch.from_state(state["current"])
+            previous = QuantileSketch.from_state(state["previous"]) if state["previous"] is not None else None
+            self._sketches[metric] = [current, previous, state["num_values"], self._merged(current, previous)]
+
+            if state["histogram"] is not None:
+                self._histograms[metric] = MetricHistogram.from_state(state["histogram"])
+
+            self._last_published[metric] = self._estimate(metric)
+            self._num_since_estimate[metric] = 0
+
+    def _add(self, metric, value):
+        """
+
+        :return: True if the sketches of the metric are rotated, or new
+        """
+        rotated = False
+
+        if metric not in self._sketches:
+            self._log.debug("Creating quantile sketch for metric [%s]" % metric)
+            self._sketches[metric] = [self._new_sketch(), None, 0, None]
+            self._num_since_estimate[metric] = 0
+            rotated = True
+
+            if self._histogram_range is not None:
+                low, high = self._histogram_range
+                self._histograms[metric] = MetricHistogram(low, high, self._histogram_bins, self._histogram_log_scale)
+
+        sketches = self._sketches[metric]
+        if (self._window_length is not None) and (sketches[2] >= self._window_length):
+            sketches[:] = [self._new_sketch(), sketches[0], 0, sketches[0].copy()]
+            rotated = True
+
+        sketches[0].add(value)
+        sketches[2] += 1
+        if sketches[3] is not None:
+            sketches[3].add(value)
+
+        self._num_since_estimate[metric] += 1
+
+        if metric in self._histograms:
+            self._histograms[metric].add(value)
+
+        return rotated
+
+    @staticmethod
+    def _merged(current, previous):
+        if previous is None:
+            return None
+
+        merged = previous.copy()
+        merged.merge(current)
+
+        return merged
+
+    def _estimate(self, metric):
+        sketch = self.sketch(metric)
+        if sketch.count == 0:
+            return dict()
+
+        estimates = sketch.quantiles([q for prefix, q in self._quantiles])
+        values = {'%s_%s' % (prefix, metric): np.float32(estimate)
+                  for (prefix, q), estimate in zip(self._quantiles, estimates)}
+        if self._publish_max:
+            values['max_%s' % metric] = np.float32(sketch.max())
+
+        return values
+
+    def _new_sketch(self):
+        return QuantileSketch(self._relative_accuracy, self._max_bins)
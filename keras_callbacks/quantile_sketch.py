@@ -0,0 +1,319 @@
+import math
+
+import numpy as np
+
+from basics.base import Base
+
+
+class _BucketStore(object):
+    """
+
+    Dense bucket counts for consecutive bucket indices, with at most max_bins buckets. When the range of indices
+    gets larger, the lowest buckets are collapsed into one.
+
+    """
+    def __init__(self, max_bins, initial_bins=64):
+        self.max_bins = max_bins
+        self.initial_bins = initial_bins
+
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.offset = 0
+        self.count = 0
+
+    def add(self, index, count=1):
+        index = self._fit(index)
+        self.counts[index - self.offset] += count
+        self.count += count
+
+    def merge(self, other):
+        non_zero = np.nonzero(other.counts)[0]
+        if len(non_zero) == 0:
+            return
+
+        # Add the highest bucket first, such that it is kept when the store is extended downwards
+        self.add(other.offset + int(non_zero[-1]), int(other.counts[non_zero[-1]]))
+
+        non_zero = non_zero[:-1]
+        if len(non_zero) == 0:
+            return
+
+        self._fit(other.offset + int(non_zero[0]))
+
+        indices = np.maximum(other.offset + non_zero, self.offset)
+        np.add.at(self.counts, indices - self.offset, other.counts[non_zero])
+        self.count += int(other.counts[non_zero].sum())
+
+    def index_at_rank(self, rank):
+        """
+
+        :param rank: 0 <= rank < count
+        :return: index of the bucket with the value of the given rank
+        """
+        return self.indices_at_ranks([rank])[0]
+
+    def indices_at_ranks(self, ranks):
+        """
+
+        :param ranks: ranks, 0 <= rank < count
+        :return: indices of the buckets with the values of the given ranks
+        """
+        positions = np.searchsorted(np.cumsum(self.counts), ranks, side='right')
+
+        return (self.offset + np.minimum(positions, len(self.counts) - 1)).tolist()
+
+    def copy(self):
+        store = _BucketStore(self.max_bins, self.initial_bins)
+        store.counts = self.counts.copy()
+        store.offset = self.offset
+        store.count = self.count
+
+        return store
+
+    def get_state(self):
+        return {"offset": self.offset, "count": self.count, "counts": self.counts.tolist()}
+
+    def set_state(self, state):
+        self.offset = state["offset"]
+        self.count = state["count"]
+        self.counts = np.array(state["counts"], dtype=np.int64)
+
+    def _fit(self, index):
+        """
+        Makes sure the store covers the index
+
+        :return: index of the bucket to use, can be higher than the given index when the lowest buckets are collapsed
+        """
+        size = len(self.counts)
+
+        if self.offset <= index < self.offset + size:
+            return index
+
+        occupied = np.nonzero(self.counts)[0]
+        if len(occupied) == 0:
+            size = min(self.initial_bins, self.max_bins)
+            self.counts = np.zeros(size, dtype=np.int64)
+            self.offset = index - size // 2
+            return index
+
+        # Only the occupied buckets are kept, unused buckets don't count for the maximum number of buckets
+        counts = self.counts[occupied[0]:occupied[-1] + 1]
+        offset = self.offset + int(occupied[0])
+
+        low = min(offset, index)
+        high = max(offset + len(counts) - 1, index)
+        new_size = min(max(high - low + 1, 2 * size), self.max_bins)
+
+        if index > offset:
+            new_offset = max(low, high - new_size + 1)
+        else:
+            new_offset = high - new_size + 1
+
+        self.counts = np.zeros(new_size, dtype=np.int64)
+        shift = offset - new_offset
+        if shift >= 0:
+            self.counts[shift:shift + len(counts)] = counts
+        elif -shift >= len(counts):
+            self.counts[0] = counts.sum()
+        else:
+            self.counts[0] = counts[:1 - shift].sum()
+            self.counts[1:len(counts) + shift] = counts[1 - shift:]
+
+        self.offset = new_offset
+
+        return max(index, new_offset)
+
+
+class QuantileSketch(Base):
+    """
+
+    Streaming quantile sketch with relative accuracy guarantees (as DDSketch) and bounded memory.
+
+    Values are counted in logarithmically spaced buckets, bucket i holds the values in (gamma^(i-1), gamma^i], with
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy). A quantile is estimated with a relative error of at most
+    relative_accuracy, as long as the number of buckets stays below max_bins; beyond that, the buckets of the smallest
+    (absolute) values are collapsed. Adding a value is O(1), estimating quantiles is O(max_bins), for any number of
+    quantiles at once, see quantiles().
+
+    The minimum, maximum and sum are exact. Non-finite values are counted, but not added to the sketch.
+
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9, **kwargs):
+        """
+
+        :param relative_accuracy: maximum relative error of the estimated quantiles
+        :param max_bins: maximum number of buckets, for the positive and negative values each
+        :param min_value: values with absolute value below min_value are counted as 0
+        """
+        super().__init__(**kwargs)
+
+        self._relative_accuracy = relative_accuracy
+        self._max_bins = max_bins
+        self._min_value = min_value
+
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+        self._positive = _BucketStore(max_bins)
+        self._negative = _BucketStore(max_bins)
+        self._zero_count = 0
+
+        self._count = 0
+        self._min = math.inf
+        self._max = -math.inf
+        self._sum = 0.
+        self._num_non_finite = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def num_non_finite(self):
+        return self._num_non_finite
+
+    def add(self, value):
+        value = float(value)
+        if not math.isfinite(value):
+            self._num_non_finite += 1
+            return
+
+        if value > self._min_value:
+            self._positive.add(self._index(value))
+        elif value < -self._min_value:
+            self._negative.add(self._index(-value))
+        else:
+            self._zero_count += 1
+
+        self._count += 1
+        self._sum += value
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+
+    def quantile(self, q):
+        """
+
+        :param q: 0 <= q <= 1
+        :return: estimated q-quantile, None if no values were added
+        """
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        """
+        Estimates multiple quantiles at once, the buckets are only scanned once
+
+        :param qs: quantiles, 0 <= q <= 1
+        :return: list with the estimated quantiles, None if no values were added
+        """
+        if self._count == 0:
+            return [None] * len(qs)
+
+        ranks = [q * (self._count - 1) for q in qs]
+        num_negative = self._negative.count
+        num_non_positive = num_negative + self._zero_count
+
+        negative_ranks = [num_negative - 1 - rank for rank in ranks if rank < num_negative]
+        positive_ranks = [rank - num_non_positive for rank in ranks if rank >= num_non_positive]
+
+        negative_indices = iter(self._negative.indices_at_ranks(negative_ranks) if negative_ranks else [])
+        positive_indices = iter(self._positive.indices_at_ranks(positive_ranks) if positive_ranks else [])
+
+        values = []
+        for rank in ranks:
+            if rank < num_negative:
+                value = -self._value(next(negative_indices))
+            elif rank < num_non_positive:
+                value = 0.
+            else:
+                value = self._value(next(positive_indices))
+
+            values.append(min(max(value, self._min), self._max))
+
+        return values
+
+    def min(self):
+        return self._min if self._count > 0 else None
+
+    def max(self):
+        return self._max if self._count > 0 else None
+
+    def mean(self):
+        return self._sum / self._count if self._count > 0 else None
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch, with the same relative accuracy
+
+        :param other: QuantileSketch
+        """
+        if other._gamma != self._gamma:
+            raise ValueError("Unable to merge sketches with different relative accuracy")
+
+        self._positive.merge(other._positive)
+        self._negative.merge(other._negative)
+        self._zero_count += other._zero_count
+
+        self._count += other._count
+        self._sum += other._sum
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        self._num_non_finite += other._num_non_finite
+
+    def copy(self):
+        sketch = QuantileSketch(self._relative_accuracy, self._max_bins, self._min_value)
+        sketch._positive = self._positive.copy()
+        sketch._negative = self._negative.copy()
+        sketch._zero_count = self._zero_count
+        sketch._count = self._count
+        sketch._min = self._min
+        sketch._max = self._max
+        sketch._sum = self._sum
+        sketch._num_non_finite = self._num_non_finite
+
+        return sketch
+
+    def get_state(self):
+        """
+
+        :return: dict with the state of the sketch, with plain Python values (e.g. to save as JSON)
+        """
+        return {
+            "relative_accuracy": self._relative_accuracy,
+            "max_bins": self._max_bins,
+            "min_value": self._min_value,
+            "positive": self._positive.get_state(),
+            "negative": self._negative.get_state(),
+            "zero_count": self._zero_count,
+            "count": self._count,
+            "min": self._min,
+            "max": self._max,
+            "sum": self._sum,
+            "num_non_finite": self._num_non_finite
+        }
+
+    def set_state(self, state):
+        """
+
+        :param state: state as returned by get_state(), of a sketch with the same relative accuracy
+        """
+        self._positive.set_state(state["positive"])
+        self._negative.set_state(state["negative"])
+        self._zero_count = state["zero_count"]
+        self._count = state["count"]
+        self._min = state["min"]
+        self._max = state["max"]
+        self._sum = state["sum"]
+        self._num_non_finite = state["num_non_finite"]
+
+    @staticmethod
+    def from_state(state):
+        sketch = QuantileSketch(state["relative_accuracy"], state["max_bins"], state["min_value"])
+        sketch.set_state(state)
+
+        return sketch
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        # Value in the bucket with the lowest maximum relative error
+        return 2 * self._gamma ** index / (self._gamma + 1)
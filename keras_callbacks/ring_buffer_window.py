@@ -0,0 +1,198 @@
+import math
+
+import numpy as np
+
+from basics.base import Base
+
+
+def _neumaier_add(total, compensation, value):
+    """
+    Neumaier (improved Kahan) summation step
+
+    :return: new total, new compensation
+    """
+    t = total + value
+    if abs(total) >= abs(value):
+        compensation += (total - t) + value
+    else:
+        compensation += (value - t) + total
+
+    return t, compensation
+
+
+class RingBufferWindow(Base):
+    """
+
+    Sliding window over the last length values, with O(1) mean and variance, as an alternative for SlidingWindow
+    (slide(), get_window(), is_empty()).
+
+    The values are stored in a preallocated float64 ring buffer. Running sums of the finite values, shifted by a
+    reference value, and of their squares are kept with compensated (Neumaier) summation. NaN and +/-inf values are
+    counted separately, such that the mean is the same as np.mean() over the window:
+
+    * NaN in the window, or both +inf and -inf : NaN
+    * +inf (or -inf) in the window : +inf (or -inf)
+
+    To bound the accumulated rounding error, the sums are recalculated exactly from the buffer every length slides,
+    which is O(1) amortised.
+
+    """
+    def __init__(self, length, window_values=None, **kwargs):
+        """
+
+        :param length: window length
+        :param window_values: initial values of the window, only the last length values are used
+        """
+        super().__init__(**kwargs)
+
+        self._length = max(1, int(length))
+        self._buffer = np.zeros(self._length, dtype=np.float64)
+        self._start = 0
+        self._size = 0
+
+        self._num_slides = 0
+        self._reset_sums()
+
+        if window_values is not None:
+            values = np.asarray(window_values, dtype=np.float64).reshape(-1)[-self._length:]
+            self._buffer[:len(values)] = values
+            self._size = len(values)
+
+            self._refresh()
+
+    def __len__(self):
+        return self._size
+
+    def slide(self, value):
+        value = float(value)
+
+        if self._size == self._length:
+            index = self._start
+            self._update(self._buffer[index], -1)
+            self._start = (self._start + 1) % self._length
+        else:
+            index = (self._start + self._size) % self._length
+            self._size += 1
+
+        self._buffer[index] = value
+        self._update(value, 1)
+
+        self._num_slides += 1
+        if self._num_slides >= self._length:
+            self._refresh()
+
+    def get_window(self):
+        """
+
+        :return: list with the values in the window, oldest first
+        """
+        stop = self._start + self._size
+        if stop <= self._length:
+            return self._buffer[self._start:stop].tolist()
+
+        return np.concatenate((self._buffer[self._start:], self._buffer[:stop - self._length])).tolist()
+
+    def is_empty(self):
+        return self._size == 0
+
+    def mean(self):
+        """
+
+        :return: mean of the values in the window, None if empty
+        """
+        if self._size == 0:
+            return None
+
+        non_finite = self._non_finite_result()
+        if non_finite is not None:
+            return non_finite
+
+        num_finite = self._size - self._num_nan - self._num_pos_inf - self._num_neg_inf
+
+        return self._shift + (self._sum + self._sum_compensation) / num_finite
+
+    def variance(self):
+        """
+
+        :return: (population) variance of the values in the window, None if empty
+        """
+        if self._size == 0:
+            return None
+
+        if self._non_finite_result() is not None:
+            return math.nan
+
+        num_finite = self._size - self._num_nan - self._num_pos_inf - self._num_neg_inf
+
+        mean = (self._sum + self._sum_compensation) / num_finite
+        mean_square = (self._sum_sq + self._sum_sq_compensation) / num_finite
+
+        return max(mean_square - mean * mean, 0.)
+
+    def _non_finite_result(self):
+        if (self._num_nan > 0) or ((self._num_pos_inf > 0) and (self._num_neg_inf > 0)):
+            return math.nan
+
+        if self._num_pos_inf > 0:
+            return math.inf
+
+        if self._num_neg_inf > 0:
+            return -math.inf
+
+        return None
+
+    def _update(self, value, sign):
+        """
+
+        :param value: value added to (sign = 1) or removed from (sign = -1) the window
+        :param sign:
+        """
+        if math.isnan(value):
+            self._num_nan += sign
+        elif value == math.inf:
+            self._num_pos_inf += sign
+        elif value == -math.inf:
+            self._num_neg_inf += sign
+        else:
+            if self._shift is None:
+                self._shift = value
+
+            # Shifting reduces cancellation in the variance
+            delta = value - self._shift
+            self._sum, self._sum_compensation = _neumaier_add(self._sum, self._sum_compensation, sign * delta)
+            self._sum_sq, self._sum_sq_compensation = _neumaier_add(self._sum_sq, self._sum_sq_compensation,
+                                                                    sign * delta * delta)
+
+    def _reset_sums(self):
+        self._shift = None
+        self._sum = 0.
+        self._sum_compensation = 0.
+        self._sum_sq = 0.
+        self._sum_sq_compensation = 0.
+
+        self._num_nan = 0
+        self._num_pos_inf = 0
+        self._num_neg_inf = 0
+
+    def _refresh(self):
+        """
+        Recalculates the sums exactly from the buffer
+        """
+        self._reset_sums()
+        self._num_slides = 0
+
+        values = np.asarray(self.get_window(), dtype=np.float64)
+
+        self._num_nan = int(np.count_nonzero(np.isnan(values)))
+        self._num_pos_inf = int(np.count_nonzero(values == math.inf))
+        self._num_neg_inf = int(np.count_nonzero(values == -math.inf))
+
+        finite = values[np.isfinite(values)]
+        if len(finite) == 0:
+            return
+
+        self._shift = math.fsum(finite) / len(finite)
+
+        deltas = finite - self._shift
+        self._sum = math.fsum(deltas)
+        self._sum_sq = math.fsum(deltas * deltas)
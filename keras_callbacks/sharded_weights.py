@@ -0,0 +1,296 @@
+import os
+import json
+import time
+
+from basics.base import Base
+
+from keras_callbacks.weight_snapshot import WeightSnapshot
+
+_MANIFEST_FORMAT = 'keras-callbacks-sharded-weights'
+
+
+class ShardedWeights(Base):
+    """
+
+    Weight files split in shards, written in parallel by the workers of a data-parallel training run.
+
+    The layers of the model are assigned to the workers, balanced by number of parameters. Every worker writes the
+    weights of its layers to a shard file, named after the iteration and the rank, in the shard path. The coordinator
+    (rank 0) waits for all shards of an iteration and writes a manifest, a small JSON file with the layer order and
+    the shard file names, in place of the weight file.
+
+    Shard files are never overwritten by a later iteration, hence copying a sharded weight file only copies the
+    manifest, all copies refer to the same shards. The shard file names in a manifest are relative to the directory
+    of the manifest, use copy_manifest() to copy a manifest to another directory. A shard is removed with the last
+    manifest referring to it.
+
+    The coordinator keeps track of the manifests it writes and copies, with the shards they refer to, such that
+    weight files never have to be read to release shards. Manifests of a previous run are found with
+    find_manifests(), call forget() when a manifest is overwritten by a regular weight file or removed.
+
+    """
+    def __init__(self, shard_path, rank, num_workers, **kwargs):
+        """
+
+        :param shard_path: directory for the shard files, shared by all workers
+        :param rank: rank of this worker, the coordinator has rank 0
+        :param num_workers: total number of workers
+        """
+        super().__init__(**kwargs)
+
+        self._shard_path = shard_path
+        self._rank = rank
+        self._num_workers = num_workers
+
+        self._layer_ranks = None
+
+        # manifest file name -> shard file names it refers to
+        self._manifests = dict()
+
+        if not os.path.exists(self._shard_path):
+            os.makedirs(self._shard_path, exist_ok=True)
+
+    def layers(self, model):
+        """
+
+        :param model: Keras model
+        :return: the layers of the model of which this worker writes the weights
+        """
+        layer_ranks = self._assign_layers(model)
+
+        return [layer for layer in model.layers if layer_ranks[layer.name] == self._rank]
+
+    def select(self, model, snapshot):
+        """
+
+        :param model: Keras model
+        :param snapshot: WeightSnapshot of all layers of the model
+        :return: WeightSnapshot with the layers of which this worker writes the weights
+        """
+        layer_ranks = self._assign_layers(model)
+
+        return WeightSnapshot([layer for layer in snapshot.layers if layer_ranks[layer[0]] == self._rank])
+
+    def shard_file_name(self, base_filename, iteration, rank):
+        return os.path.join(self._shard_path,
+                            '%s-%d.shard-%d-of-%d' % (base_filename, iteration, rank, self._num_workers))
+
+    def iteration_shard_file_names(self, base_filename, iteration):
+        """
+
+        :return: shard file names of all workers for the iteration, in order of rank
+        """
+        return [self.shard_file_name(base_filename, iteration, rank) for rank in range(self._num_workers)]
+
+    def write_shard(self, snapshot, base_filename, iteration):
+        """
+
+        :param snapshot: WeightSnapshot with the layers of this worker
+        :param base_filename:
+        :param iteration:
+        :return: shard file name
+        """
+        fname = self.shard_file_name(base_filename, iteration, self._rank)
+
+        # The coordinator must never see a partially written shard
+        tmp_fname = "%s.tmp" % fname
+        snapshot.save(tmp_fname)
+        os.replace(tmp_fname, fname)
+
+        return fname
+
+    def wait_for_shards(self, base_filename, iteration, timeout=600., poll_interval=0.05):
+        """
+
+        :param base_filename:
+        :param iteration:
+        :param timeout: maximum time to wait, in seconds
+        :param poll_interval:
+        :return: list with the shard file names of all workers, in order of rank, None on time out
+        """
+        fnames = self.iteration_shard_file_names(base_filename, iteration)
+
+        deadline = time.time() + timeout
+        while not all(os.path.isfile(fname) for fname in fnames):
+            if time.time() > deadline:
+                missing = [fname for fname in fnames if not os.path.isfile(fname)]
+                self._log.error("Timed out waiting for shards : %s" % missing)
+                return None
+
+            time.sleep(poll_interval)
+
+        return fnames
+
+    def write_manifest(self, fname, model, iteration, shard_fnames):
+        """
+
+        :param fname: weight file name, the manifest replaces the weight file
+        :param model: Keras model
+        :param iteration:
+        :param shard_fnames: shard file names, in order of rank
+        :return: shard file names referred to by the replaced manifest, to release with release()
+        """
+        previous_shard_fnames = self.manifest_shards(fname)
+
+        manifest = {
+            "format": _MANIFEST_FORMAT,
+            "iter": iteration,
+            "layer_names": [layer.name for layer in model.layers],
+            "shards": shard_fnames
+        }
+
+        self._write_tracked_manifest(fname, manifest)
+
+        return previous_shard_fnames
+
+    def copy_manifest(self, source_fname, dest_fname):
+        """
+        Copies a manifest, the shard file names are made relative to the directory of the copy
+
+        :param source_fname:
+        :param dest_fname:
+        :return: shard file names referred to by the replaced manifest, to release with release()
+        """
+        previous_shard_fnames = self.manifest_shards(dest_fname)
+
+        manifest = ShardedWeights.read_manifest(source_fname)
+        manifest["shards"] = ShardedWeights.shard_file_names(source_fname)
+
+        self._write_tracked_manifest(dest_fname, manifest)
+
+        return previous_shard_fnames
+
+    def find_manifests(self, paths):
+        """
+        Keeps track of the manifests in the given paths, e.g. written by a previous run
+
+        :param paths: directories with weight files
+        """
+        for path in paths:
+            if not os.path.isdir(path):
+                continue
+
+            for name in os.listdir(path):
+                fname = os.path.join(path, name)
+                if ShardedWeights.is_manifest(fname):
+                    self._manifests[os.path.abspath(fname)] = ShardedWeights.shard_file_names(fname)
+
+    def is_tracked_manifest(self, fname):
+        return os.path.abspath(fname) in self._manifests
+
+    def manifest_shards(self, fname):
+        """
+
+        :param fname: weight file
+        :return: shard file names the weight file refers to, empty if it is not a (tracked) manifest
+        """
+        return self._manifests.get(os.path.abspath(fname), [])
+
+    def forget(self, fname):
+        """
+        Stops tracking a manifest, after it is overwritten by a regular weight file or removed
+
+        :param fname: weight file
+        :return: shard file names the manifest referred to, to release with release()
+        """
+        return self._manifests.pop(os.path.abspath(fname), [])
+
+    def release(self, shard_fnames):
+        """
+        Removes the shards that are not referred to by any tracked manifest
+
+        :param shard_fnames: candidate shard files to remove
+        """
+        shard_fnames = set(os.path.abspath(fname) for fname in shard_fnames)
+        if len(shard_fnames) == 0:
+            return
+
+        for referenced_shard_fnames in self._manifests.values():
+            shard_fnames.difference_update(referenced_shard_fnames)
+
+        for fname in shard_fnames:
+            if os.path.isfile(fname):
+                self._log.debug("Removing unreferenced shard [%s]" % fname)
+                os.remove(fname)
+
+    def _write_tracked_manifest(self, fname, manifest):
+        ShardedWeights._write_manifest(fname, manifest)
+
+        self._manifests[os.path.abspath(fname)] = [os.path.abspath(shard_fname) for shard_fname in manifest["shards"]]
+
+    @staticmethod
+    def is_manifest(fname):
+        if not os.path.isfile(fname):
+            return False
+
+        with open(fname, 'rb') as f:
+            return f.read(1) == b'{'
+
+    @staticmethod
+    def read_manifest(fname):
+        with open(fname, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def shard_file_names(fname):
+        """
+
+        :param fname: manifest
+        :return: absolute shard file names
+        """
+        path = os.path.dirname(os.path.abspath(fname))
+
+        return [os.path.normpath(os.path.join(path, shard_fname))
+                for shard_fname in ShardedWeights.read_manifest(fname)["shards"]]
+
+    @staticmethod
+    def load(fname):
+        """
+        Loads a sharded weight file
+
+        :param fname: manifest, or regular weight file
+        :return: WeightSnapshot, with the layers in the order of the model
+        """
+        if not ShardedWeights.is_manifest(fname):
+            return WeightSnapshot.load(fname)
+
+        manifest = ShardedWeights.read_manifest(fname)
+
+        layers = dict()
+        for shard_fname in ShardedWeights.shard_file_names(fname):
+            for layer in WeightSnapshot.load(shard_fname).layers:
+                layers[layer[0]] = layer
+
+        return WeightSnapshot([layers[layer_name] for layer_name in manifest["layer_names"]])
+
+    @staticmethod
+    def _write_manifest(fname, manifest):
+        """
+
+        :param fname:
+        :param manifest: manifest dict, with absolute (or working directory relative) shard file names
+        """
+        path = os.path.dirname(os.path.abspath(fname))
+        manifest = dict(manifest, shards=[os.path.relpath(os.path.abspath(shard_fname), path)
+                                          for shard_fname in manifest["shards"]])
+
+        with open("%s.tmp" % fname, 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+        os.replace("%s.tmp" % fname, fname)
+
+    def _assign_layers(self, model):
+        if self._layer_ranks is not None:
+            return self._layer_ranks
+
+        # Largest layers first, to the worker with the least parameters assigned
+        num_params = [0] * self._num_workers
+        layer_ranks = dict()
+        for layer in sorted(model.layers, key=lambda l: (-l.count_params(), l.name)):
+            rank = num_params.index(min(num_params))
+            layer_ranks[layer.name] = rank
+            num_params[rank] += layer.count_params()
+
+        self._layer_ranks = layer_ranks
+
+        return layer_ranks
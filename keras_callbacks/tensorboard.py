@@ -7,17 +7,33 @@ import basics.validation_utils as _u
 
 
 class TensorBoard(Base, KerasTensorBoard):
-    def __init__(self, metric_mapping=None, init_iter=-1, batch_level=True, **kwargs):
+    def __init__(self, metric_mapping=None, init_iter=-1, batch_level=True, metric_bus=None, **kwargs):
+        """
+
+        :param metric_mapping: dict mapping metric names to the names to log, None to log all metrics
+        :param init_iter:
+        :param batch_level:
+        :param metric_bus: MetricBus to read the batch level metrics from, instead of scanning the logs
+        """
         super().__init__(**kwargs)
         self._metric_mapping = metric_mapping
         self._iter = init_iter
 
         self._batch_level = batch_level
 
+        self._metric_bus = metric_bus
+        self._subscription = None
+        if metric_bus is not None:
+            self._subscription = metric_bus.subscribe(self._is_logged_metric)
+
     def on_batch_end(self, batch, logs=None):
         if self._batch_level:
             self._iter += 1
-            self._write_mapped_logs(self._iter, logs)
+            if self._subscription is not None:
+                self._metric_bus.sync(batch, logs)
+                self._write_subscribed_metrics(self._iter)
+            else:
+                self._write_mapped_logs(self._iter, logs)
 
         return super().on_batch_end(batch, logs)
 
@@ -53,4 +69,25 @@ class TensorBoard(Base, KerasTensorBoard):
             self.writer.add_summary(summary, iter)
         self.writer.flush()
 
+    def _is_logged_metric(self, name):
+        if name in ['batch', 'size']:
+            return False
+
+        return (not _u.is_dict(self._metric_mapping)) or (self._metric_mapping.get(name) is not None)
+
+    def _write_subscribed_metrics(self, iter):
+        names, values = self._subscription.updated()
+        if len(names) == 0:
+            return
+
+        # One summary with all metrics of the iteration
+        summary = tf.Summary()
+        for name, value in zip(names, values.tolist()):
+            summary_value = summary.value.add()
+            summary_value.simple_value = value
+            summary_value.tag = self._metric_mapping[name] if _u.is_dict(self._metric_mapping) else name
+
+        self.writer.add_summary(summary, iter)
+        self.writer.flush()
+
 
@@ -0,0 +1,218 @@
+import os
+import shutil
+import weakref
+import tempfile
+
+import numpy as np
+
+from basics.base import Base
+
+from keras_callbacks.batch_prefetcher import BatchPrefetcher
+
+
+def _flatten(batch):
+    """
+
+    :param batch: array, or (nested) list or tuple of arrays
+    :return: list of leaves, structure to rebuild the batch with _unflatten()
+    """
+    if isinstance(batch, (list, tuple)):
+        leaves = []
+        structure = []
+        for item in batch:
+            item_leaves, item_structure = _flatten(item)
+            leaves += item_leaves
+            structure.append(item_structure)
+
+        return leaves, (type(batch), structure)
+
+    return [batch], None
+
+
+def _unflatten(leaves, structure):
+    if structure is None:
+        return next(leaves)
+
+    kind, items = structure
+
+    return kind([_unflatten(leaves, item) for item in items])
+
+
+class ValidationBatchPool(Base):
+    """
+
+    Iterator over a fixed set of validation batches, that are generated once.
+
+    The first num_batches batches are taken from the batch generator and stored in memory, up to max_bytes. Batches
+    that don't fit are spilled, as .npy files, to a new directory in spill_path, and served memory-mapped. Without
+    spill_path, the pool is limited to the batches that fit in memory.
+
+    When all batches are taken, the pool serves them again, in the same order, or in a new random order every pass,
+    from a seeded random generator. The served arrays are shared between passes, they must not be modified.
+
+    If the batch generator ends before num_batches batches are taken, the pool is limited to the batches taken. Once
+    the pool is complete, the batch generator is not used anymore, a BatchPrefetcher is closed.
+
+    close() removes the batches and the spilled files, the pool is filled again when it is used after close().
+
+    """
+    def __init__(self, batch_generator, num_batches, max_bytes=1 << 30, spill_path=None, shuffle_seed=None, **kwargs):
+        """
+
+        :param batch_generator: generator of batches: arrays, or (nested) lists or tuples of arrays
+        :param num_batches: number of batches in the pool
+        :param max_bytes: maximum number of bytes of the batches kept in memory
+        :param spill_path: directory for batches that don't fit in memory, None to not spill
+        :param shuffle_seed: if given, the batches are served in a random order, seeded with shuffle_seed
+        """
+        super().__init__(**kwargs)
+
+        self._batch_generator = batch_generator
+        self._num_batches = num_batches
+        self._max_bytes = max_bytes
+        self._spill_path = spill_path
+
+        self._random = np.random.RandomState(shuffle_seed) if shuffle_seed is not None else None
+
+        self._batches = []
+        self._complete = False
+        self._order = None
+        self._position = 0
+
+        self._nbytes = 0
+        self._spilled_nbytes = 0
+        self._num_spilled = 0
+        self._num_hits = 0
+        self._num_misses = 0
+
+        # Directory of the spilled batches of this pool, removed on close(), or when the pool is garbage collected
+        self._spill_dir = None
+        self._remove_spill_dir = None
+
+        if (self._spill_path is not None) and not os.path.exists(self._spill_path):
+            os.makedirs(self._spill_path)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._complete:
+            try:
+                return self._take_batch()
+            except StopIteration:
+                self._log.warning("Batch generator ended after %d batches, "
+                                  "serving these batches only" % len(self._batches))
+                self._set_complete()
+
+        if len(self._batches) == 0:
+            raise StopIteration
+
+        if self._position == 0:
+            self._order = self._random.permutation(len(self._batches)) if self._random is not None else None
+
+        index = self._order[self._position] if self._order is not None else self._position
+        self._position = (self._position + 1) % len(self._batches)
+
+        self._num_hits += 1
+        structure, leaves = self._batches[index]
+
+        return _unflatten(iter(leaves), structure)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def stats(self):
+        """
+
+        :return: dict with the number of cache hits and misses, number of batches in the pool, number of spilled
+                 batches and the bytes in memory and on disk
+        """
+        return {
+            "num_hits": self._num_hits,
+            "num_misses": self._num_misses,
+            "num_batches": len(self._batches),
+            "num_spilled": self._num_spilled,
+            "nbytes": self._nbytes,
+            "spilled_nbytes": self._spilled_nbytes
+        }
+
+    def _take_batch(self):
+        batch = next(self._batch_generator)
+        self._num_misses += 1
+
+        if not self._add(batch):
+            self._log.warning("Validation batch pool is full after %d batches, "
+                              "serving these batches only" % len(self._batches))
+            self._set_complete()
+        elif len(self._batches) >= self._num_batches:
+            self._set_complete()
+
+        return batch
+
+    def close(self):
+        """
+        Removes the batches and the spilled files
+        """
+        self._batches = []
+        self._complete = False
+        self._order = None
+        self._position = 0
+
+        self._nbytes = 0
+        self._spilled_nbytes = 0
+        self._num_spilled = 0
+
+        if self._remove_spill_dir is not None:
+            self._remove_spill_dir()
+            self._spill_dir = None
+            self._remove_spill_dir = None
+
+    def _set_complete(self):
+        self._complete = True
+
+        # Batches produced ahead of time would not be used
+        if isinstance(self._batch_generator, BatchPrefetcher):
+            self._batch_generator.close()
+
+    def _add(self, batch):
+        """
+
+        :param batch:
+        :return: True if the batch was added to the pool
+        """
+        leaves, structure = _flatten(batch)
+
+        # The generator might re-use its buffers
+        leaves = [np.array(leaf, copy=True) if isinstance(leaf, np.ndarray) else leaf for leaf in leaves]
+        nbytes = sum(leaf.nbytes for leaf in leaves if isinstance(leaf, np.ndarray))
+
+        if self._nbytes + nbytes <= self._max_bytes:
+            self._nbytes += nbytes
+        elif self._spill_path is not None:
+            leaves = self._spill(len(self._batches), leaves)
+            self._spilled_nbytes += nbytes
+            self._num_spilled += 1
+        else:
+            return False
+
+        self._batches.append((structure, leaves))
+
+        return True
+
+    def _spill(self, index, leaves):
+        if self._spill_dir is None:
+            # Pools can share the spill path, and files of a pool can be memory-mapped until the pool is closed
+            self._spill_dir = tempfile.mkdtemp(prefix='batch-pool-', dir=self._spill_path)
+            self._remove_spill_dir = weakref.finalize(self, shutil.rmtree, self._spill_dir, ignore_errors=True)
+
+        spilled = []
+        for i, leaf in enumerate(leaves):
+            if not isinstance(leaf, np.ndarray) or leaf.dtype.hasobject:
+                spilled.append(leaf)
+                continue
+
+            fname = os.path.join(self._spill_dir, 'batch-%06d-%d.npy' % (index, i))
+            np.save(fname, leaf)
+            spilled.append(np.load(fname, mmap_mode='r'))
+
+        return spilled
@@ -0,0 +1,116 @@
+import numpy as np
+import h5py
+
+from keras import __version__ as keras_version
+from keras import backend as K
+
+
+class WeightSnapshot():
+    """
+
+    In-memory copy of the weights of a model, grouped per layer.
+
+    Taking a snapshot only copies the weight values from the backend, save() writes the snapshot in the same HDF5
+    format as model.save_weights(), such that it can be loaded with model.load_weights(). Hence, a snapshot can be
+    saved on another thread, while training continues.
+
+    """
+    def __init__(self, layers):
+        """
+
+        :param layers: list of (layer_name, weight_names, weight_values) tuples
+        """
+        self.layers = layers
+
+    @staticmethod
+    def take(model, layers=None):
+        """
+
+        :param model: Keras model
+        :param layers: optional subset of the layers of the model to take the weights of
+        :return: WeightSnapshot with a copy of the current weights of the model
+        """
+        layers = model.layers if layers is None else layers
+
+        symbolic_weights = [w for layer in layers for w in layer.weights]
+        values = K.batch_get_value(symbolic_weights)
+
+        snapshot_layers = []
+        index = 0
+        for layer in layers:
+            num_weights = len(layer.weights)
+
+            weight_names = []
+            for i, w in enumerate(layer.weights):
+                weight_names.append(str(w.name) if (hasattr(w, 'name') and w.name) else 'param_%d' % i)
+
+            snapshot_layers.append((layer.name, weight_names, values[index:index + num_weights]))
+            index += num_weights
+
+        return WeightSnapshot(snapshot_layers)
+
+    @property
+    def nbytes(self):
+        return sum(value.nbytes for _, _, values in self.layers for value in values)
+
+    def values(self):
+        """
+
+        :return: flat list with all weight values, in order of the layers
+        """
+        return [value for _, _, values in self.layers for value in values]
+
+    def save(self, fname):
+        """
+        Saves the snapshot in the HDF5 format of model.save_weights()
+
+        :param fname:
+        """
+        with h5py.File(fname, 'w') as f:
+            f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in self.layers]
+            f.attrs['backend'] = K.backend().encode('utf8')
+            f.attrs['keras_version'] = str(keras_version).encode('utf8')
+
+            for layer_name, weight_names, values in self.layers:
+                g = f.create_group(layer_name)
+                g.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+
+                for name, value in zip(weight_names, values):
+                    dataset = g.create_dataset(name, value.shape, dtype=value.dtype)
+                    if not value.shape:
+                        dataset[()] = value
+                    else:
+                        dataset[:] = value
+
+            f.flush()
+
+    def apply_to(self, model):
+        """
+        Sets the weights of the model to the weights of the snapshot, the model must have the same layers
+
+        :param model: Keras model
+        """
+        symbolic_weights = [w for layer in model.layers for w in layer.weights]
+
+        K.batch_set_value(list(zip(symbolic_weights, self.values())))
+
+    @staticmethod
+    def load(fname):
+        """
+        Loads a snapshot from a file in the HDF5 format of model.save_weights()
+
+        :param fname:
+        :return: WeightSnapshot
+        """
+        layers = []
+        with h5py.File(fname, 'r') as f:
+            for layer_name in f.attrs['layer_names']:
+                layer_name = layer_name.decode('utf8') if isinstance(layer_name, bytes) else layer_name
+
+                g = f[layer_name]
+                weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in g.attrs['weight_names']]
+                values = [np.asarray(g[name]) for name in weight_names]
+
+                layers.append((layer_name, weight_names, values))
+
+        return WeightSnapshot(layers)
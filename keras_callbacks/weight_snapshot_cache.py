@@ -0,0 +1,103 @@
+from basics.base import Base
+
+
+class WeightSnapshotCache(Base):
+    """
+
+    In-memory cache of candidate model weight snapshots, with a byte budget.
+
+    When the budget is exceeded, the snapshots of the worst quality models are evicted first. Protected snapshots
+    (e.g. of the best and earliest good model) are only evicted when no other snapshot is left.
+
+    """
+    def __init__(self, max_bytes, metric_opt_mode='min', **kwargs):
+        """
+
+        :param max_bytes: maximum total size of the cached snapshots
+        :param metric_opt_mode: 'max', 'min', determines which quality values are worst
+        """
+        super().__init__(**kwargs)
+
+        self._max_bytes = max_bytes
+        self._metric_opt_mode = metric_opt_mode
+
+        self._snapshots = dict()
+        self._quality = dict()
+        self._nbytes = 0
+
+        self._num_hits = 0
+        self._num_evictions = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __contains__(self, key):
+        return key in self._snapshots
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def put(self, key, snapshot, quality, protected=()):
+        """
+
+        :param key: model name
+        :param snapshot: WeightSnapshot
+        :param quality: model quality, used to decide what to evict
+        :param protected: model names that are only evicted when nothing else is left
+        :return: list of evicted (key, snapshot) tuples, to be saved to disk by the caller
+        """
+        self.pop(key)
+
+        self._snapshots[key] = snapshot
+        self._quality[key] = quality
+        self._nbytes += snapshot.nbytes
+
+        evicted = []
+        while self._nbytes > self._max_bytes:
+            evict_key = self._worst(protected)
+            evicted.append((evict_key, self.pop(evict_key)))
+            self._num_evictions += 1
+
+        return evicted
+
+    def get(self, key):
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            self._num_hits += 1
+
+        return snapshot
+
+    def pop(self, key):
+        """
+
+        :param key: model name
+        :return: the removed snapshot, None if not cached
+        """
+        snapshot = self._snapshots.pop(key, None)
+        if snapshot is not None:
+            self._quality.pop(key)
+            self._nbytes -= snapshot.nbytes
+
+        return snapshot
+
+    def items(self):
+        return list(self._snapshots.items())
+
+    def stats(self):
+        return {
+            "num_snapshots": len(self._snapshots),
+            "nbytes": self._nbytes,
+            "num_hits": self._num_hits,
+            "num_evictions": self._num_evictions
+        }
+
+    def _worst(self, protected):
+        candidates = [k for k in self._snapshots.keys() if k not in protected]
+        if len(candidates) == 0:
+            candidates = list(self._snapshots.keys())
+
+        if self._metric_opt_mode == 'max':
+            return min(candidates, key=lambda k: self._quality[k])
+
+        return max(candidates, key=lambda k: self._quality[k])
@@ -0,0 +1,27 @@
+import numpy as np
+
+import pytest
+
+
+def build_model(seed=0):
+    """
+
+    :return: small Keras model, to save and load checkpoints of
+    """
+    from keras.models import Sequential
+    from keras.layers import Dense
+
+    np.random.seed(seed)
+    model = Sequential([Dense(8, input_shape=(4,)), Dense(8), Dense(2)])
+    model.compile(optimizer='sgd', loss='mse')
+
+    return model
+
+
+def perturb(model, scale=0.01):
+    model.set_weights([w + scale * np.random.randn(*w.shape).astype(w.dtype) for w in model.get_weights()])
+
+
+@pytest.fixture
+def model():
+    return build_model()
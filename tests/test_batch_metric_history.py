@@ -0,0 +1,85 @@
+import os
+import pickle
+
+import numpy as np
+
+from keras_callbacks.batch_metric_history import BatchMetricHistory
+from keras_callbacks.history_log import HistoryLogReader
+
+
+def _record(path, num_epochs=2, iters_per_epoch=700, **history_kwargs):
+    """
+    Records a loss every iteration and a validation metric every 10 iterations, from iteration 150 on
+
+    :return: BatchMetricHistory
+    """
+    history = BatchMetricHistory(model_path=path, base_filename='run', save_period=100, **history_kwargs)
+
+    for epoch in range(num_epochs):
+        history.on_epoch_begin(epoch)
+        for batch in range(iters_per_epoch):
+            it = epoch * iters_per_epoch + batch
+
+            logs = {"loss": np.float32(1. / (1 + it))}
+            if (it >= 150) and (it % 10 == 0):
+                logs["perplexity_validation"] = np.float32(it)
+
+            history.on_batch_end(batch, logs)
+
+        history.on_epoch_end(epoch)
+
+    history.on_train_end()
+
+    return history
+
+
+def _load_pickled(path):
+    with open(os.path.join(path, 'run.history'), 'rb') as f:
+        history = pickle.load(f)["history"]
+
+    return history if isinstance(history, dict) else history.to_dict()
+
+
+def _load_log(path):
+    return HistoryLogReader(os.path.join(path, 'run.history-log')).to_dict()
+
+
+def test_metric_logged_from_mid_run_is_aligned(tmpdir):
+    for name, kwargs in [("dict", dict()), ("columnar", dict(columnar_history=True))]:
+        path = str(tmpdir.mkdir(name))
+        _record(path, **kwargs)
+        history = _load_pickled(path)
+
+        iters = np.asarray(history["global_iter"])
+        values = np.asarray(history["perplexity_validation"])
+        assert len(values) == len(iters)
+
+        logged = np.isfinite(values)
+        np.testing.assert_array_equal(values[logged], iters[logged])
+        assert np.all(logged == ((iters >= 150) & (iters % 10 == 0)))
+
+
+def test_async_save_writes_same_history_log(tmpdir):
+    for name, kwargs in [("log", dict(append_only=True)),
+                         ("compacted", dict(append_only=True, compaction_tiers=[(100, None)], keep_raw_iters=300))]:
+        path = str(tmpdir.mkdir(name))
+        _record(path, **kwargs)
+        expected = _load_log(path)
+
+        async_path = str(tmpdir.mkdir("%s-async" % name))
+        assert _record(async_path, async_save=True, **kwargs).save_stats()["num_tasks"] > 0
+        history = _load_log(async_path)
+
+        assert sorted(history.keys()) == sorted(expected.keys())
+        for key in expected:
+            if key in ("time_stamp", "date"):
+                assert len(history[key]) == len(expected[key])
+            else:
+                np.testing.assert_array_equal(history[key], expected[key])
+
+
+def test_async_save_requires_append_only(tmpdir):
+    path = str(tmpdir)
+
+    assert _record(path, async_save=True).save_stats() is None
+    assert len(_load_pickled(path)["loss"]) == 1400
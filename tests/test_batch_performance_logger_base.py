@@ -0,0 +1,38 @@
+import itertools
+
+from keras_callbacks.batch_performance_logger_base import BatchPerformanceLoggerBase
+
+
+class _BatchLogger(BatchPerformanceLoggerBase):
+
+    def _predict_model(self, batch_data):
+        return batch_data
+
+    def _calc_performance(self, generated_batch_data, predicted_batch_data):
+        return {"batch_%s" % self._metrics_name_postfix: predicted_batch_data}
+
+
+def _fit(logger, num_iters):
+    values = []
+    for it in range(num_iters):
+        logs = dict()
+        logger.on_batch_end(it, logs)
+        values.append(logs["batch_validation"])
+
+    logger.on_train_end()
+
+    return values
+
+
+def test_prefetcher_is_closed_at_train_end_and_restarted():
+    logger = _BatchLogger(itertools.count(), metrics_name_postfix="validation", inspect_period=0,
+                          prefetch_batches=4)
+
+    first_values = _fit(logger, 10)
+    assert first_values == list(range(10))
+    assert logger._prefetcher._producers == []
+
+    # Training continues, no batches are lost
+    second_values = _fit(logger, 10)
+    assert second_values == list(range(10, 20))
+    assert logger._prefetcher._producers == []
@@ -0,0 +1,97 @@
+import os
+import time
+import signal
+
+import pytest
+
+from keras_callbacks.batch_prefetcher import BatchPrefetcher
+
+
+def _count(worker_index):
+    for i in range(1000000):
+        yield worker_index, i
+
+
+def _failing_factory(worker_index):
+    raise ValueError("No data for worker %d" % worker_index)
+
+
+def _failing_generator():
+    yield 0
+    raise ValueError("Corrupt batch")
+
+
+def _slow(worker_index):
+    while True:
+        time.sleep(0.01)
+        yield worker_index
+
+
+def test_exhausted_generator_keeps_ending():
+    prefetcher = BatchPrefetcher(iter(range(3)), num_prefetch=2, poll_interval=0.1)
+
+    assert list(prefetcher) == [0, 1, 2]
+    for _i in range(2):
+        with pytest.raises(StopIteration):
+            next(prefetcher)
+
+
+def test_failed_generator_ends_after_error():
+    prefetcher = BatchPrefetcher(_failing_generator(), num_prefetch=2, poll_interval=0.1)
+
+    assert next(prefetcher) == 0
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+
+
+def test_no_batches_lost_when_closed():
+    prefetcher = BatchPrefetcher(iter(range(100)), num_prefetch=4, poll_interval=0.1)
+
+    values = []
+    for _i in range(5):
+        values += [next(prefetcher) for _j in range(7)]
+        # Give the producer time to block on the full queue
+        time.sleep(0.3)
+        prefetcher.close()
+
+    assert values + list(prefetcher) == list(range(100))
+
+
+def test_process_factory_required():
+    with pytest.raises(ValueError):
+        BatchPrefetcher(num_processes=2, mp_context='spawn')
+
+
+def test_failing_process_factory_raises():
+    prefetcher = BatchPrefetcher(generator_factory=_failing_factory, num_processes=2, mp_context='spawn',
+                                 poll_interval=0.1)
+
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
+
+
+def test_killed_producers_raise():
+    prefetcher = BatchPrefetcher(generator_factory=_slow, num_prefetch=2, num_processes=2, mp_context='spawn',
+                                 poll_interval=0.1)
+    next(prefetcher)
+
+    for process in prefetcher._producers:
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+    with pytest.raises(RuntimeError):
+        for _i in range(10):
+            next(prefetcher)
+
+
+def test_processes_interleave_batches():
+    prefetcher = BatchPrefetcher(generator_factory=_count, num_prefetch=4, num_processes=2, mp_context='spawn')
+
+    batches = [next(prefetcher) for _i in range(50)]
+    prefetcher.close()
+
+    for worker_index in range(2):
+        values = [i for index, i in batches if index == worker_index]
+        assert values == list(range(len(values)))
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+
+from keras_callbacks.batch_metric_history import BatchMetricHistory
+from keras_callbacks.checkpoint_policy_simulator import CheckpointPolicySimulator
+from keras_callbacks.model_checkpoint_manager import ModelCheckpointManager
+from keras_callbacks.evaluation_scheduler import EvaluationScheduler
+
+from conftest import perturb
+
+METRIC = "mean_batch_perplexity_validation"
+SETTINGS = dict(metric_monitor_period=50, early_good_model_delta=0.5,
+                create_checkpoint_every=200, archive_last_checkpoint_every=1000)
+
+
+def _train(model, path, num_epochs=2, iters_per_epoch=1500, evaluation_scheduler=None, **history_kwargs):
+    """
+    Runs a ModelCheckpointManager and a BatchMetricHistory on a noisy, improving, metric, that is evaluated at the
+    iterations the evaluation scheduler decides
+
+    :return: ModelCheckpointManager
+    """
+    manager = ModelCheckpointManager(model, model_path=path, base_filename='run', metric_to_monitor=METRIC,
+                                     instrument_io=True, **SETTINGS)
+    history = BatchMetricHistory(model_path=path, base_filename='run', save_period=500, **history_kwargs)
+
+    random = np.random.RandomState(1)
+    for epoch in range(num_epochs):
+        history.on_epoch_begin(epoch)
+        for batch in range(iters_per_epoch):
+            perturb(model)
+
+            it = epoch * iters_per_epoch + batch
+            value = np.float32(max(10. / (1 + it / 300.), 3.) + 0.3 * random.rand())
+
+            logs = {"loss": np.float32(1.)}
+            if (evaluation_scheduler is None) or evaluation_scheduler.should_evaluate():
+                logs[METRIC] = value
+                if evaluation_scheduler is not None:
+                    evaluation_scheduler.evaluated(0.)
+
+            manager.on_batch_end(batch, logs)
+            history.on_batch_end(batch, logs)
+
+        manager.on_epoch_end(epoch)
+        history.on_epoch_end(epoch)
+
+    manager.on_train_end()
+    history.on_train_end()
+
+    return manager
+
+
+def test_history_file_and_log_give_same_simulation(model, tmpdir):
+    results = []
+    for name, kwargs, fname in [("pickle", dict(), "run.history"),
+                                ("columnar", dict(columnar_history=True), "run.history"),
+                                ("log", dict(append_only=True), "run.history-log")]:
+        path = str(tmpdir.mkdir(name))
+        _train(model, path, **kwargs)
+
+        history = CheckpointPolicySimulator.load_history(os.path.join(path, fname))
+        assert METRIC in history
+
+        results.append(CheckpointPolicySimulator('min').simulate(history, METRIC, **SETTINGS))
+
+    assert results[0]["num_monitored"] > 0
+    assert results[0] == results[1] == results[2]
+
+
+def test_simulation_matches_live_manager(model, tmpdir):
+    # With a scheduler, the metric is not available at most monitor iterations
+    for name, evaluation_scheduler in [("every-iteration", None), ("scheduled", EvaluationScheduler(period=7))]:
+        path = str(tmpdir.mkdir(name))
+        manager = _train(model, path, evaluation_scheduler=evaluation_scheduler)
+
+        history = CheckpointPolicySimulator.load_history(os.path.join(path, "run.history"))
+        result = CheckpointPolicySimulator('min').simulate(history, METRIC, **SETTINGS)
+
+        ops = manager.io_stats()["ops"]
+
+        assert result["num_improvements"] > 0
+        assert result["num_temp_saves"] > 0
+        assert result["num_saves"] == ops["save"]["count"]
+        # The checkpoint state file is backed up (copied) before every state save, except the first
+        assert result["num_copies"] + result["num_state_saves"] - 1 == ops["copy"]["count"]
+        assert result["num_deletes"] == ops["remove"]["count"]
+        assert result["num_state_saves"] == ops["state"]["count"]
@@ -0,0 +1,59 @@
+import numpy as np
+
+from keras_callbacks.history_tiers import HistoryCompactor
+
+
+def _history(num_iters):
+    iters = np.arange(num_iters)
+    # Evaluated every 10 iterations, one evaluation diverged
+    values = np.where(iters % 10 == 0, iters.astype('float64'), np.nan)
+    values[50] = np.inf
+
+    return {"global_iter": list(iters), "loss_validation": list(values)}
+
+
+def test_padding_is_counted_as_missing():
+    compactor = HistoryCompactor(keep_raw_iters=0, tiers=((100, None),))
+    compactor.compact(_history(200), 200)
+
+    buckets = compactor.buckets("loss_validation")
+    np.testing.assert_array_equal(buckets["count"], [9, 10])
+    np.testing.assert_array_equal(buckets["num_non_finite"], [1, 0])
+    np.testing.assert_array_equal(buckets["num_missing"], [90, 90])
+    np.testing.assert_array_equal(buckets["max"], [90., 190.])
+
+
+def test_state_is_not_changed_by_later_compaction():
+    compactor = HistoryCompactor(keep_raw_iters=100, tiers=((10, 5), (100, None)))
+    history = _history(300)
+
+    compactor.compact(history, 200)
+    state = compactor.state()
+    counts = [{key: buckets["count"].copy() for key, buckets in tier["buckets"].items()} for tier in state["tiers"]]
+
+    history["global_iter"].extend(range(300, 400))
+    history["loss_validation"].extend([1.] * 100)
+    compactor.compact(history, 400)
+
+    for tier, tier_counts in zip(state["tiers"], counts):
+        for key, buckets in tier["buckets"].items():
+            np.testing.assert_array_equal(buckets["count"], tier_counts[key])
+
+    restored = HistoryCompactor(keep_raw_iters=100, tiers=((10, 5), (100, None)), state=compactor.state())
+    for tier in range(2):
+        for key, values in compactor.buckets("loss_validation", tier).items():
+            np.testing.assert_array_equal(restored.buckets("loss_validation", tier)[key], values)
+
+
+def test_state_without_missing_counts():
+    compactor = HistoryCompactor(keep_raw_iters=0, tiers=((100, None),))
+    compactor.compact(_history(100), 100)
+
+    state = compactor.state()
+    del state["tiers"][0]["buckets"]["loss_validation"]["num_missing"]
+
+    restored = HistoryCompactor(keep_raw_iters=0, tiers=((100, None),), state=state)
+    history = _history(200)
+    restored.compact({key: values[100:] for key, values in history.items()}, 200)
+
+    np.testing.assert_array_equal(restored.buckets("loss_validation")["num_missing"], [0, 90])
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from keras_callbacks.model_checkpoint_manager import ModelCheckpointManager
+from keras_callbacks.weight_snapshot import WeightSnapshot
+
+from conftest import perturb
+
+METRIC = "mean_batch_perplexity_validation"
+
+
+def _read(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+def test_copy_of_file_outside_store_does_not_modify_blob(model, tmpdir):
+    path = str(tmpdir)
+    manager = ModelCheckpointManager(model, model_path=path, base_filename='run', metric_to_monitor=METRIC,
+                                     metric_monitor_period=10, create_checkpoint_every=10,
+                                     archive_last_checkpoint_every=0, link_checkpoints=True)
+
+    for it in range(11):
+        manager.on_batch_end(it, {METRIC: np.float32(10. - it)})
+
+    best_fname = manager.latest_best_model_file_name()
+    latest_fname = manager.latest_model_file_name()
+    assert os.path.samefile(best_fname, latest_fname)
+    content = _read(latest_fname)
+
+    # E.g. a weight file from before the store was used
+    perturb(model)
+    fname = os.path.join(path, 'external.model')
+    WeightSnapshot.take(model).save(fname)
+
+    assert manager._copy_file(fname, best_fname)
+
+    assert _read(best_fname) == _read(fname)
+    assert _read(latest_fname) == content
+    assert not os.path.samefile(best_fname, latest_fname)
@@ -0,0 +1,108 @@
+import numpy as np
+
+from keras_callbacks.default_batch_performance_logger import DefaultBatchPerformanceLogger
+from keras_callbacks.multi_set_batch_performance_logger import MultiSetBatchPerformanceLogger
+
+
+class _SoftmaxModel(object):
+    """
+    Predicts the softmax of the inputs, or of the inputs and their negation for two outputs
+    """
+    def __init__(self, num_outputs=1):
+        self.num_outputs = num_outputs
+        self.num_predicts = 0
+
+    def predict_on_batch(self, inputs):
+        self.num_predicts += 1
+
+        outputs = [self._softmax(inputs), self._softmax(-inputs)]
+
+        return outputs[0] if self.num_outputs == 1 else outputs[:self.num_outputs]
+
+    @staticmethod
+    def _softmax(x):
+        e = np.exp(x - x.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+
+
+def _batches(seed, batch_size, seq_length=5, num_symbols=7):
+    rng = np.random.RandomState(seed)
+    while True:
+        inputs = rng.randn(batch_size, seq_length, num_symbols).astype(np.float32)
+        targets = np.eye(num_symbols, dtype=np.float32)[rng.randint(num_symbols, size=(batch_size, seq_length))]
+        sample_weights = (rng.rand(batch_size, seq_length) > 0.2).astype(np.float32)
+
+        yield inputs, targets, sample_weights
+
+
+def _sets():
+    return {"a": _batches(0, 3), "b": _batches(1, 5)}
+
+
+def _fit(logger, model, num_iters):
+    logger.set_model(model)
+
+    all_logs = []
+    for it in range(num_iters):
+        logs = dict()
+        logger.on_batch_end(it, logs)
+        all_logs.append(logs)
+
+    return all_logs
+
+
+def _accumulated(batch_generator, num_batches):
+    batches = [next(batch_generator) for _i in range(num_batches)]
+
+    return iter([tuple(np.concatenate(arrays, axis=0) for arrays in zip(*batches))])
+
+
+def _assert_logs_equal(logs, expected):
+    assert sorted(logs.keys()) == sorted(expected.keys())
+    for key in expected:
+        np.testing.assert_allclose(logs[key], expected[key], rtol=1e-5)
+
+
+def test_same_metrics_as_separate_sets():
+    for accumulate_batches in [1, 3]:
+        model = _SoftmaxModel()
+        logger = MultiSetBatchPerformanceLogger(None, 5, 7, _sets(), accumulate_batches=accumulate_batches,
+                                                metric_backend='numpy', inspect_period=0)
+        all_logs = _fit(logger, model, 2 * accumulate_batches)
+
+        assert model.num_predicts == 2
+        assert all(len(logs) == 0 for logs in all_logs[:accumulate_batches - 1])
+
+        expected = dict()
+        for pf, batch_generator in _sets().items():
+            for it in range(2):
+                separate = DefaultBatchPerformanceLogger(None, 5, 7, _accumulated(batch_generator, accumulate_batches),
+                                                         metrics_name_postfix=pf, metric_backend='numpy',
+                                                         inspect_period=0)
+                expected.setdefault(it, dict()).update(_fit(separate, _SoftmaxModel(), 1)[0])
+
+        _assert_logs_equal(all_logs[accumulate_batches - 1], expected[0])
+        _assert_logs_equal(all_logs[-1], expected[1])
+
+
+def test_outputs_are_split_per_set():
+    logger = MultiSetBatchPerformanceLogger(None, 5, 7, _sets(), metric_backend='numpy', inspect_period=0)
+    logger.set_model(_SoftmaxModel(num_outputs=2))
+
+    batch_data = logger._generate_batch()
+    predicted = logger._predict_model(batch_data)
+
+    for pf, num_samples in [("a", 3), ("b", 5)]:
+        assert len(predicted[pf]) == 2
+        for output in predicted[pf]:
+            assert output.shape == (num_samples, 5, 7)
+
+    np.testing.assert_allclose(predicted["b"][1], _SoftmaxModel._softmax(-batch_data["b"][0]))
+
+
+def test_single_generator_options_are_ignored():
+    logger = MultiSetBatchPerformanceLogger(None, 5, 3, {"a": iter([]), "b": iter([])}, metric_backend='numpy',
+                                            prefetch_batches=4, prefetch_processes=2, cache_batches=10)
+
+    assert logger.prefetch_stats() is None
+    assert logger.cache_stats() is None
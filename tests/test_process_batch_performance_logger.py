@@ -0,0 +1,45 @@
+import os
+import time
+
+import numpy as np
+
+from keras_callbacks.process_batch_performance_logger import ProcessBatchPerformanceLogger
+
+from conftest import build_model
+
+
+def _batches():
+    while True:
+        yield np.zeros((2, 4), dtype=np.float32)
+
+
+def _crash(model, batch_data):
+    os._exit(1)
+
+
+def _run(logger, model, until, timeout=60.):
+    logger.set_model(model)
+
+    deadline = time.time() + timeout
+    it = 0
+    while not until(logger.stats()) and time.time() < deadline:
+        logger.on_batch_end(it, dict())
+        it += 1
+        time.sleep(0.01)
+
+
+def test_dead_worker_is_detected_and_restarted(model):
+    logger = ProcessBatchPerformanceLogger(build_model, _batches, _crash, metrics_name_postfix="validation",
+                                           evaluation_period=10, max_worker_restarts=1)
+
+    _run(logger, model, until=lambda stats: stats["num_worker_deaths"] == 2)
+    _run(logger, model, until=lambda stats: False, timeout=1.)
+
+    stats = logger.stats()
+    assert stats["num_worker_deaths"] == 2
+    assert stats["num_failed"] == 2
+    assert stats["num_evaluations"] == 0
+    assert not stats["busy"]
+
+    logger.on_train_end()
+    assert logger._process is None
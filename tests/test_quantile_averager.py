@@ -0,0 +1,55 @@
+import numpy as np
+
+from keras_callbacks.quantile_averager import QuantileAverager
+
+
+def _run(averager, values, postfix="validation"):
+    published = []
+    for it, value in enumerate(values):
+        logs = {"loss_%s" % postfix: value}
+        averager.on_batch_end(it, logs)
+        published.append(logs)
+
+    return published
+
+
+def test_quantiles_are_estimated_every_estimate_every_values():
+    averager = QuantileAverager("validation", quantiles=(0.5,), estimate_every=5)
+    published = _run(averager, np.arange(1., 13.))
+
+    medians = [logs["p50_loss_validation"] for logs in published]
+    assert medians[:5] == [medians[0]] * 5
+    assert medians[5:10] == [medians[5]] * 5
+    assert 3 * 0.99 <= medians[5] <= 4 * 1.01
+    assert abs(medians[10] - 6) <= 0.01 * 6
+
+    # The maximum is exact every value
+    assert [logs["max_loss_validation"] for logs in published] == list(np.arange(1., 13., dtype=np.float32))
+
+
+def test_window_rotation():
+    averager = QuantileAverager("validation", quantiles=(0.5,), window_length=10, estimate_every=100)
+    published = _run(averager, np.concatenate([np.full(10, 1.), np.full(10, 100.), np.full(10, 1000.)]))
+
+    # Estimated again at rotation, covering the previous and current window
+    assert abs(published[10]["p50_loss_validation"] - 1.) <= 0.01
+    assert abs(published[20]["p50_loss_validation"] - 100.) <= 1.
+    assert published[20]["max_loss_validation"] == 1000.
+
+    sketch = averager.sketch("loss_validation")
+    assert sketch.count == 20
+    assert sketch.min() == 100.
+
+
+def test_state_round_trip():
+    values = np.random.RandomState(0).lognormal(size=75)
+    averager = QuantileAverager("validation", window_length=20, histogram_range=(0., 10.), estimate_every=1)
+    _run(averager, values)
+
+    restored = QuantileAverager("validation", window_length=20, histogram_range=(0., 10.), estimate_every=1,
+                                sketch_states=averager.get_state())
+    assert restored.get_state() == averager.get_state()
+    assert restored.sketch("loss_validation").count == averager.sketch("loss_validation").count
+
+    more_values = np.random.RandomState(1).lognormal(size=30)
+    assert _run(restored, more_values) == _run(averager, more_values)
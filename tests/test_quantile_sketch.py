@@ -0,0 +1,90 @@
+import numpy as np
+
+from keras_callbacks.quantile_sketch import QuantileSketch
+
+_QUANTILES = [0., 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.]
+
+
+def _assert_accurate(sketch, values, relative_accuracy=0.01, quantiles=_QUANTILES):
+    for q, estimate in zip(quantiles, sketch.quantiles(quantiles)):
+        low = np.quantile(values, q, method='lower')
+        high = np.quantile(values, q, method='higher')
+        tolerance = relative_accuracy * max(abs(low), abs(high)) + 1e-9
+
+        assert low - tolerance <= estimate <= high + tolerance, (q, estimate, low, high)
+
+
+def _sketch(values, **kwargs):
+    sketch = QuantileSketch(**kwargs)
+    for value in values:
+        sketch.add(value)
+
+    return sketch
+
+
+def _values(seed=0):
+    rng = np.random.RandomState(seed)
+
+    return np.concatenate([rng.lognormal(0., 2., 2000), -rng.lognormal(1., 1., 500), np.zeros(100)])
+
+
+def test_quantiles_within_relative_accuracy():
+    values = _values()
+    sketch = _sketch(values)
+
+    _assert_accurate(sketch, values)
+    assert sketch.quantiles(_QUANTILES) == [sketch.quantile(q) for q in _QUANTILES]
+    assert sketch.count == len(values)
+    assert sketch.min() == values.min()
+    assert sketch.max() == values.max()
+
+
+def test_non_finite_values_are_counted_only():
+    sketch = _sketch([1., np.nan, np.inf, 2.])
+
+    assert sketch.count == 2
+    assert sketch.num_non_finite == 2
+    assert QuantileSketch().quantiles([0.5, 0.9]) == [None, None]
+
+
+def test_merge_equals_sketch_of_all_values():
+    values = _values()
+    merged = _sketch(values[::2])
+    merged.merge(_sketch(values[1::2]))
+
+    expected = _sketch(values)
+    assert merged.quantiles(_QUANTILES) == expected.quantiles(_QUANTILES)
+    assert merged.count == expected.count
+    assert (merged.min(), merged.max()) == (expected.min(), expected.max())
+
+
+def test_state_round_trip():
+    sketch = _sketch(_values())
+    restored = QuantileSketch.from_state(sketch.get_state())
+
+    assert restored.get_state() == sketch.get_state()
+    assert restored.quantiles(_QUANTILES) == sketch.quantiles(_QUANTILES)
+
+    copied = sketch.copy()
+    copied.add(1e6)
+    assert copied.count == sketch.count + 1
+
+
+def test_lowest_buckets_are_collapsed():
+    # 1e-6 .. 1e6 needs about 1400 buckets with 1% accuracy
+    values = np.random.RandomState(1).permutation(np.logspace(-6, 6, 5000))
+    sketch = _sketch(values, max_bins=256)
+
+    assert len(sketch._positive.counts) <= 256
+    assert sketch.count == len(values)
+    assert sketch._positive.counts.sum() == len(values)
+    assert sketch.min() == values.min()
+    assert sketch.max() == values.max()
+
+    _assert_accurate(sketch, values, quantiles=[0.9, 0.95, 0.99, 1.])
+
+    # Merging stores with collapsed buckets keeps the counts
+    merged = _sketch(values[:100], max_bins=256)
+    merged.merge(sketch)
+    assert merged._positive.counts.sum() == len(values) + 100
+    assert len(merged._positive.counts) <= 256
@@ -0,0 +1,177 @@
+import os
+import multiprocessing
+
+import numpy as np
+
+from keras_callbacks.model_checkpoint_manager import ModelCheckpointManager
+from keras_callbacks.sharded_weights import ShardedWeights
+from keras_callbacks.weight_snapshot import WeightSnapshot
+
+from conftest import build_model, perturb
+
+METRIC = "mean_batch_perplexity_validation"
+SETTINGS = dict(metric_monitor_period=50, early_good_model_delta=0.5,
+                create_checkpoint_every=200, archive_last_checkpoint_every=1000)
+
+
+def _train(path, num_iters=2000, **manager_kwargs):
+    """
+    Runs a ModelCheckpointManager on a noisy, improving, metric. All workers train the same model.
+    """
+    model = build_model()
+    manager = ModelCheckpointManager(model, model_path=path, base_filename='run', metric_to_monitor=METRIC,
+                                     **dict(SETTINGS, **manager_kwargs))
+
+    np.random.seed(1)
+    random = np.random.RandomState(2)
+    for it in range(num_iters):
+        perturb(model)
+
+        logs = {METRIC: np.float32(max(10. / (1 + it / 300.), 3.) + 0.3 * random.rand())}
+        manager.on_batch_end(it, logs)
+
+    manager.on_train_end()
+
+
+def _weight_files(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.model'))
+
+
+def _temp_weight_files(path):
+    # Temp. models have random names
+    temp_path = os.path.join(path, 'temp-models')
+    return sorted(os.path.join(temp_path, name) for name in os.listdir(temp_path))
+
+
+def _equal_weights(fname, other_fname):
+    values = ShardedWeights.load(fname).values()
+    other_values = ShardedWeights.load(other_fname).values()
+
+    return (len(values) == len(other_values)) and \
+        all(np.array_equal(value, other_value) for value, other_value in zip(values, other_values))
+
+
+def test_sharded_checkpoints_of_multiple_processes(tmpdir):
+    reference_path = str(tmpdir.mkdir("reference"))
+    _train(reference_path)
+
+    path = str(tmpdir.mkdir("sharded"))
+    num_workers = 3
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_train, args=(path,),
+                                 kwargs=dict(worker_rank=rank, num_workers=num_workers, shard_weights=True,
+                                             shard_timeout=60., async_checkpoints=True))
+                 for rank in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(120)
+        assert process.exitcode == 0
+
+    fnames = _weight_files(path)
+    assert fnames == _weight_files(reference_path)
+    assert 'run-best-latest.model' in fnames and 'run-earliest-good.model' in fnames
+
+    for fname in fnames:
+        assert _equal_weights(os.path.join(path, fname), os.path.join(reference_path, fname))
+
+    temp_fnames = _temp_weight_files(path)
+    reference_temp_fnames = _temp_weight_files(reference_path)
+    assert 0 < len(temp_fnames) == len(reference_temp_fnames)
+
+    for temp_fname in temp_fnames:
+        assert any(_equal_weights(temp_fname, reference_fname) for reference_fname in reference_temp_fnames)
+
+    # Models that improved between checkpoints are saved completely
+    manifest_fnames = [fname for fname in [os.path.join(path, fname) for fname in fnames] + temp_fnames
+                       if ShardedWeights.is_manifest(fname)]
+    assert os.path.join(path, 'run-latest.model') in manifest_fnames
+    assert any(fname in manifest_fnames for fname in temp_fnames)
+
+    referenced_shards = set()
+    for manifest_fname in manifest_fnames:
+        shard_fnames = ShardedWeights.shard_file_names(manifest_fname)
+        assert len(shard_fnames) == num_workers
+        assert all(os.path.isfile(shard_fname) for shard_fname in shard_fnames)
+        referenced_shards.update(shard_fnames)
+
+    shard_path = os.path.join(path, 'shards')
+    assert referenced_shards == set(os.path.join(shard_path, name) for name in os.listdir(shard_path))
+
+
+def test_coordinator_time_out_leaves_no_shards(tmpdir):
+    path = str(tmpdir)
+    shard_path = os.path.join(path, 'shards')
+
+    _train(path, num_iters=300, worker_rank=0, num_workers=2, shard_weights=True, shard_timeout=0.2,
+           async_checkpoints=True)
+
+    latest_fname = os.path.join(path, 'run-latest.model')
+    assert os.path.isfile(latest_fname) and not ShardedWeights.is_manifest(latest_fname)
+    assert os.listdir(shard_path) == []
+
+
+def test_late_shards_are_removed_at_next_sharded_save(tmpdir):
+    path = str(tmpdir)
+    shard_path = os.path.join(path, 'shards')
+
+    model = build_model()
+    manager = ModelCheckpointManager(model, model_path=path, base_filename='run', metric_to_monitor=METRIC,
+                                     worker_rank=0, num_workers=2, shard_weights=True, shard_timeout=0.2,
+                                     async_checkpoints=True, **SETTINGS)
+    worker = ShardedWeights(shard_path, 1, 2)
+
+    for it in range(500):
+        perturb(model)
+        if it == 300:
+            # The worker is late for iteration 200, but in time for iteration 400
+            manager.flush()
+            for iteration in [200, 400]:
+                worker.write_shard(WeightSnapshot.take(model, worker.layers(model)), 'run', iteration)
+
+        manager.on_batch_end(it, {METRIC: np.float32(10. - it / 100.)})
+
+    manager.on_train_end()
+
+    latest_fname = os.path.join(path, 'run-latest.model')
+    assert ShardedWeights.is_manifest(latest_fname)
+    assert sorted(os.listdir(shard_path)) == sorted(os.path.basename(fname)
+                                                    for fname in ShardedWeights.shard_file_names(latest_fname))
+
+
+def test_sharding_requires_async_checkpoints(tmpdir):
+    path = str(tmpdir)
+
+    _train(path, num_iters=300, worker_rank=0, num_workers=2, shard_weights=True, shard_timeout=60.)
+
+    assert not ShardedWeights.is_manifest(os.path.join(path, 'run-latest.model'))
+    assert not os.path.exists(os.path.join(path, 'shards'))
+
+
+def test_shards_are_released_with_last_tracked_manifest(tmpdir):
+    path = str(tmpdir)
+    model = build_model()
+
+    shards = ShardedWeights(os.path.join(path, 'shards'), 0, 1)
+    shard_fnames = [shards.write_shard(WeightSnapshot.take(model), 'run', 100)]
+
+    fname = os.path.join(path, 'run-latest.model')
+    assert shards.write_manifest(fname, model, 100, shard_fnames) == []
+
+    temp_path = str(tmpdir.mkdir('temp-models'))
+    copy_fname = os.path.join(temp_path, 'copy.model')
+    assert shards.copy_manifest(fname, copy_fname) == []
+    assert _equal_weights(copy_fname, fname)
+
+    # Manifests of a previous run are tracked as well
+    resumed = ShardedWeights(os.path.join(path, 'shards'), 0, 1)
+    resumed.find_manifests([path, temp_path])
+    assert resumed.manifest_shards(copy_fname) == [os.path.abspath(shard_fnames[0])]
+
+    resumed.release(resumed.forget(fname))
+    assert os.path.isfile(shard_fnames[0])
+
+    os.remove(copy_fname)
+    resumed.release(resumed.forget(copy_fname))
+    assert not os.path.isfile(shard_fnames[0])
@@ -0,0 +1,62 @@
+import os
+import itertools
+
+import numpy as np
+
+from keras_callbacks.batch_prefetcher import BatchPrefetcher
+from keras_callbacks.validation_batch_pool import ValidationBatchPool
+
+
+def _batches(num_batches=None):
+    for i in itertools.islice(itertools.count(), num_batches):
+        yield np.full((2, 3), i), [np.arange(i + 1)]
+
+
+def _first_values(pool, num_batches):
+    return [int(next(pool)[0][0, 0]) for _i in range(num_batches)]
+
+
+def test_generator_with_fewer_batches():
+    pool = ValidationBatchPool(_batches(3), 5)
+
+    assert _first_values(pool, 8) == [0, 1, 2, 0, 1, 2, 0, 1]
+    assert len(pool) == 3
+    assert pool.stats()["num_misses"] == 3
+
+
+def test_empty_generator():
+    pool = ValidationBatchPool(_batches(0), 5)
+
+    assert list(pool) == []
+
+
+def test_complete_pool_closes_prefetcher():
+    prefetcher = BatchPrefetcher(_batches(), num_prefetch=2)
+    pool = ValidationBatchPool(prefetcher, 4, shuffle_seed=1)
+
+    assert _first_values(pool, 4) == [0, 1, 2, 3]
+    assert sorted(_first_values(pool, 4)) == [0, 1, 2, 3]
+    assert prefetcher.stats()["num_batches"] == 4
+
+    # Producing is stopped, and not started again by the pool
+    _first_values(pool, 8)
+    assert prefetcher._producers == []
+    assert prefetcher.stats()["num_batches"] == 4
+
+
+def test_pools_sharing_spill_path(tmpdir):
+    spill_path = str(tmpdir)
+    pools = [ValidationBatchPool(itertools.islice(_batches(), start, None), 3, max_bytes=0, spill_path=spill_path)
+             for start in [0, 10]]
+
+    for pool in pools:
+        _first_values(pool, 3)
+
+    assert _first_values(pools[0], 3) == [0, 1, 2]
+    assert _first_values(pools[1], 3) == [10, 11, 12]
+    assert pools[0].stats()["num_spilled"] == 3
+
+    for pool in pools:
+        pool.close()
+
+    assert os.listdir(spill_path) == []